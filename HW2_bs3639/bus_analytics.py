@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Speeds, gaps, headways and bunching of buses from a history of snapshots
+(e.g. SnapshotStore/DeltaStore/ParquetStore.read(...)), computed over whole
+arrays at once: rows are sorted by vehicle and time (or by position along the
+route) once, and each metric is a difference between neighbouring rows.
+
+df = store.read('B52')
+df = add_speeds(df)
+df = add_gaps(df)
+bunching(df, threshold=250)
+
+Snapshots need RecordedAtTime, VehicleRef, Latitude and Longitude. Gaps along the
+route also need the distances MTA puts in the MonitoredCall extensions; poll with
+the fields of ANALYTICS_FIELDS to get them:
+
+get_bus_info.py --poll --field VehicleRef=VehicleRef --field DirectionRef=DirectionRef \
+	--field CallDistanceAlongRoute=MonitoredCall.Extensions.Distances.CallDistanceAlongRoute \
+	--field DistanceFromCall=MonitoredCall.Extensions.Distances.DistanceFromCall ...
+"""
+from __future__ import print_function
+import sys
+from collections import OrderedDict as odict
+import numpy as np
+import pandas as pd
+
+
+ANALYTICS_FIELDS = odict([
+	('VehicleRef', 'VehicleRef'),
+	('DirectionRef', 'DirectionRef'),
+	('CallDistanceAlongRoute', 'MonitoredCall.Extensions.Distances.CallDistanceAlongRoute'),
+	('DistanceFromCall', 'MonitoredCall.Extensions.Distances.DistanceFromCall'),
+])
+
+EARTH_RADIUS = 6371008.8 # meters
+
+
+def haversine(lat1, lon1, lat2, lon2):
+	'''Great circle distance in meters between arrays of coordinates (degrees)'''
+	lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2)]
+	a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+	return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _seconds(times):
+	'''Unix seconds of a column of numbers, datetimes or date strings'''
+	times = pd.Series(times)
+	if pd.api.types.is_numeric_dtype(times):
+		return times.values.astype(float)
+	times = pd.to_datetime(times, utc=True)
+	return (times - pd.Timestamp(0, tz='UTC')).dt.total_seconds().values
+
+
+def _codes(df, columns):
+	'''One integer per distinct combination of the columns'''
+	columns = [c for c in columns if c in df.columns]
+	if not columns:
+		return np.zeros(len(df), dtype=np.int64)
+	return df.groupby(columns, sort=False, dropna=False).ngroup().values
+
+
+def _numeric(df, column):
+	return pd.to_numeric(df[column], errors='coerce').values # 'N/A' -> NaN
+
+
+def add_speeds(df, vehicle='VehicleRef', time='RecordedAtTime'):
+	'''Add the distance (m), time (s) and speed (m/s) of each vehicle since its previous snapshot
+
+	df (pd.DataFrame): snapshots with vehicle, time, Latitude and Longitude columns
+	Returns a copy of df, sorted by vehicle and time, with Distance, Elapsed and Speed columns
+	(NaN on the first snapshot of each vehicle)
+	Raises KeyError without the vehicle column (the default poll doesn't save it, see ANALYTICS_FIELDS)
+	'''
+	if vehicle not in df.columns:
+		raise KeyError('add_speeds needs a {!r} column to tell the buses apart, poll with --field {}={}'.format(
+			vehicle, vehicle, ANALYTICS_FIELDS.get(vehicle, '<PATH>')))
+	t = _seconds(df[time])
+	v = _codes(df, [vehicle])
+	order = np.lexsort((t, v))
+	df = df.iloc[order].reset_index(drop=True)
+	t, v = t[order], v[order]
+	lat, lon = _numeric(df, 'Latitude'), _numeric(df, 'Longitude')
+
+	same = np.r_[False, v[1:] == v[:-1]] # row follows a row of the same vehicle
+	distance = np.full(len(df), np.nan)
+	elapsed = np.full(len(df), np.nan)
+	distance[1:] = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+	elapsed[1:] = np.diff(t)
+	distance[~same] = elapsed[~same] = np.nan
+
+	df['Distance'] = distance
+	df['Elapsed'] = elapsed
+	with np.errstate(divide='ignore', invalid='ignore'):
+		df['Speed'] = np.where(elapsed > 0, distance / elapsed, np.nan)
+	return df
+
+
+def add_gaps(df, group=('LineRef', 'DirectionRef'), time='RecordedAtTime'):
+	'''Add the gap (m) to the bus ahead and the headway (s) behind it, per line, direction and snapshot.
+
+	With CallDistanceAlongRoute and DistanceFromCall columns, buses are ordered by their distance
+	along the route and the gap is the route distance to the next bus ahead. Without them, the gap
+	is the straight line distance to the nearest bus of the same group.
+	The headway is the time the bus would take to cover the gap at its current Speed (see add_speeds).
+
+	df (pd.DataFrame): snapshots
+	group (list): columns of the buses that share a route (missing columns are ignored)
+	Returns a copy of df with Gap and Headway columns
+	'''
+	df = df.reset_index(drop=True)
+	g = _codes(df, list(group) + [time])
+	gap = np.full(len(df), np.nan)
+
+	if 'CallDistanceAlongRoute' in df.columns and 'DistanceFromCall' in df.columns:
+		along = _numeric(df, 'CallDistanceAlongRoute') - _numeric(df, 'DistanceFromCall')
+		valid = np.where(~np.isnan(along))[0]
+		order = valid[np.lexsort((along[valid], g[valid]))]
+		ahead = np.r_[g[order][1:] == g[order][:-1], False] # next row is a bus ahead on the same route
+		gap[order[:-1][ahead[:-1]]] = np.diff(along[order])[ahead[:-1]]
+	else:
+		# all pairs of buses of the same group: a self join, then the min per bus
+		lat, lon = _numeric(df, 'Latitude'), _numeric(df, 'Longitude')
+		pairs = pd.DataFrame({'g': g, 'i': np.arange(len(df))})
+		pairs = pairs.merge(pairs, on='g')
+		pairs = pairs[pairs.i_x != pairs.i_y]
+		d = haversine(lat[pairs.i_x.values], lon[pairs.i_x.values], lat[pairs.i_y.values], lon[pairs.i_y.values])
+		nearest = pd.Series(d).groupby(pairs.i_x.values).min()
+		gap[nearest.index.values] = nearest.values
+
+	df['Gap'] = gap
+	if 'Speed' in df.columns:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			df['Headway'] = np.where(df['Speed'].values > 0, gap / df['Speed'].values, np.nan)
+	return df
+
+
+def bunching(df, threshold=250., group=('LineRef', 'DirectionRef')):
+	'''Share of snapshots where a bus is within threshold meters of the bus ahead, per line and direction
+
+	df (pd.DataFrame): snapshots with a Gap column (see add_gaps)
+	threshold (float): meters under which two buses are bunched
+	Returns a DataFrame with the number of snapshots, bunched snapshots, and bunched share
+	'''
+	group = [c for c in group if c in df.columns]
+	bunched = (df['Gap'] < threshold).rename('Bunched')
+	if not group:
+		return pd.DataFrame({'Snapshots': [df['Gap'].notnull().sum()], 'Bunched': [bunched.sum()],
+			'Share': [bunched.sum() / max(df['Gap'].notnull().sum(), 1)]})
+	stats = pd.concat([df[group], df['Gap'].notnull().rename('Snapshots'), bunched], axis=1).groupby(group).sum()
+	stats['Share'] = stats['Bunched'] / stats['Snapshots'].clip(lower=1)
+	return stats
+
+
+if __name__ == '__main__':
+	# a day of fleet-wide snapshots: 300 lines x 20 buses, every 30s
+	import time
+	n_lines, n_buses, n_polls = ([int(a) for a in sys.argv[1:4]] + [300, 20, 2880][len(sys.argv[1:4]):])
+	rnd = np.random.RandomState(0)
+	n = n_lines * n_buses
+	along = rnd.uniform(0, 15000, n)
+	rows = []
+	for i in range(n_polls):
+		along = along + rnd.uniform(0, 150, n)
+		rows.append(pd.DataFrame({
+			'RecordedAtTime': 1505916000. + 30 * i,
+			'LineRef': np.repeat(np.arange(n_lines), n_buses),
+			'VehicleRef': np.arange(n),
+			'Latitude': 40.6 + along / 111000.,
+			'Longitude': -73.9 + np.zeros(n),
+			'CallDistanceAlongRoute': along + 100,
+			'DistanceFromCall': 100.,
+		}))
+	df = pd.concat(rows, ignore_index=True)
+	print('{} snapshots'.format(len(df)))
+	for name, func in [('add_speeds', add_speeds), ('add_gaps', add_gaps)]:
+		t0 = time.time()
+		df = func(df)
+		print('{:<12} {:.2f}s'.format(name, time.time() - t0))
+	print(bunching(df).head())
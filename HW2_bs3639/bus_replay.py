@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""
+Offline replay of SIRI responses, to run and benchmark the bus scripts without the MTA.
+
+# record real responses of a few lines, 10 polls 30s apart, to recordings/<LINE>/<time>.json
+python bus_replay.py record --out recordings --count 10 --interval 30 [mta_key] B52,B54
+
+# serve them back (each line cycles through its recordings), 50ms late, at most 20 requests/s (429 above)
+python bus_replay.py serve --recordings recordings --latency 0.05 --server-rate 20 --port 8765
+python get_bus_info.py --url http://localhost:8765/vehicle-monitoring.json xx-xx-xx B52
+
+# or serve synthetic responses of any size
+python bus_replay.py serve --vehicles 5000 --calls 20
+
+# time fetch -> parse -> DataFrame -> write for the scripts against a replay server started in
+# process, and append the result to bench_history.jsonl. A run more than --tolerance slower than
+# the median of the previous runs with the same settings is reported as a regression.
+python bus_replay.py bench --vehicles 200 --lines B1,B2,B3,B4 --rounds 20 --workers 4 --store parquet
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import tempfile
+import threading
+import optparse
+import subprocess
+from collections import defaultdict
+
+# try Python 3 version, fallback to Python 2 version
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+from siri_client import SiriClient, SIRI_URL, RateLimiter, read_lines, fetch_lines
+from siri_fields import synthetic_response
+from bus_store import SnapshotStore, DeltaStore, ParquetStore
+
+
+# Recording
+#######################
+
+def record(client, bus_lines, directory, count=1, interval=30., **params):
+	'''Save the raw responses of lines to <directory>/<LINE>/<YYYYmmddTHHMMSS>.json
+
+	client (SiriClient): the client
+	bus_lines (list): the bus lines
+	count (int): number of polls
+	interval (float): seconds between polls
+	**params: SIRI parameters, e.g. VehicleMonitoringDetailLevel='calls'
+	'''
+	paths = []
+	for i in range(count):
+		if i:
+			time.sleep(interval)
+		stamp = time.strftime('%Y%m%dT%H%M%S')
+		for line in bus_lines:
+			data = client.fetch(line, **params)
+			path = os.path.join(directory, line, stamp + '.json')
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'wb') as f:
+				f.write(data)
+			paths.append(path)
+			print('{}: {} {:.1f}kB saved to {}'.format(time.strftime('%H:%M:%S'), line, len(data) / 1e3, path))
+	return paths
+
+
+def load_recordings(directory):
+	'''Raw responses recorded by record(...), as {line: [bytes in time order]}'''
+	recordings = {}
+	for line_dir in sorted(glob.glob(os.path.join(directory, '*'))):
+		files = sorted(glob.glob(os.path.join(line_dir, '*.json')))
+		if files:
+			recordings[os.path.basename(line_dir).upper()] = [open(f, 'rb').read() for f in files]
+	if not recordings:
+		raise ValueError('No recordings in {}'.format(directory))
+	return recordings
+
+
+def synthetic_payload(n_vehicles=200, n_calls=0, seed=0):
+	'''Raw bytes of a synthetic response (see siri_fields.synthetic_response)'''
+	return json.dumps(synthetic_response(n_vehicles, n_calls, seed)).encode('utf-8')
+
+
+
+# Replay server
+#######################
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class ReplayServer(object):
+
+	def __init__(self, recordings=None, payload=None, latency=0., rate=None, host='127.0.0.1', port=0):
+		'''A local stand-in for the vehicle-monitoring endpoint, over keep-alive HTTP/1.1
+
+		recordings (dict): {line: [bytes]} (see load_recordings). Each line cycles through its
+			responses, and unknown lines get those of the first line
+		payload (bytes): the response to every request, when there are no recordings
+		latency (float): seconds to wait before answering
+		rate (float): max requests per second, answered with 429 above it (default: no limit)
+		port (int): 0 picks a free port
+		'''
+		if recordings is None:
+			recordings = {None: [payload if payload is not None else synthetic_payload()]}
+		self.recordings = recordings
+		self.latency = latency
+		self.rate = rate
+		self.requests = 0
+		self.throttled = 0
+		self._counters = defaultdict(int)
+		self._lock = threading.Lock()
+		self._allowance, self._last = float(rate or 0), time.time()
+
+		replay = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def do_GET(self):
+				status, body = replay.respond(self.path)
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *a):
+				pass
+
+		self.httpd = _ThreadingHTTPServer((host, port), Handler)
+		self._thread = None
+
+	@property
+	def url(self):
+		host, port = self.httpd.server_address[:2]
+		return 'http://{}:{}/api/siri/vehicle-monitoring.json'.format(host, port)
+
+	def _allow(self):
+		'''Token bucket of `rate` requests per second'''
+		if not self.rate:
+			return True
+		with self._lock:
+			now = time.time()
+			self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+			self._last = now
+			if self._allowance < 1:
+				self.throttled += 1
+				return False
+			self._allowance -= 1
+			return True
+
+	def respond(self, path):
+		'''The status and body of a request'''
+		query = parse_qs(urlsplit(path).query)
+		line = query.get('LineRef', [None])[0]
+		line = line.upper() if line else None
+		with self._lock:
+			self.requests += 1
+		if not self._allow():
+			return 429, b'{"error": "Too Many Requests"}'
+		if self.latency:
+			time.sleep(self.latency)
+
+		if line not in self.recordings:
+			line = sorted(self.recordings, key=str)[0]
+		responses = self.recordings[line]
+		with self._lock:
+			i = self._counters[line]
+			self._counters[line] += 1
+		return 200, responses[i % len(responses)]
+
+	def start(self):
+		'''Serve in a background thread'''
+		self._thread = threading.Thread(target=self.httpd.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *a):
+		self.stop()
+
+
+
+# Benchmark
+#######################
+
+def _percentile(values, q):
+	values = sorted(values)
+	if not values:
+		return None
+	return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+def _commit():
+	'''The current git commit, if any'''
+	try:
+		with open(os.devnull, 'w') as null:
+			return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=null,
+				cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run_benchmark(url, bus_lines, rounds=10, workers=4, rate=None, store='csv', stream=False,
+		onward_calls=False, fields=()):
+	'''Poll the lines `rounds` times the way get_bus_info_bs3639 does, and time each stage
+
+	url (str): the vehicle-monitoring endpoint (a ReplayServer)
+	bus_lines (list): the lines fetched each round
+	store (str): where the DataFrames are written: csv (one file per round), snapshots, delta or parquet
+	stream, onward_calls, fields: as the options of get_bus_info_bs3639
+
+	Returns a dict of metrics
+	'''
+	from get_bus_info_bs3639 import make_extractor, build_lines_dataframe
+	from multiprocessing.pool import ThreadPool
+
+	client = SiriClient('replay', url=url)
+	extract = make_extractor(fields, onward_calls, vehicle_ref=store == 'delta')
+	params = {'VehicleMonitoringDetailLevel': 'calls'} if onward_calls else {}
+	directory = tempfile.mkdtemp(prefix='bus_replay_')
+	stores = {
+		'snapshots': lambda: SnapshotStore(directory),
+		'delta': lambda: DeltaStore(directory, key=['VehicleRef', 'Call'] if onward_calls else ['VehicleRef']),
+		'parquet': lambda: ParquetStore(directory, compact_every=None),
+	}
+	sink = stores[store]() if store in stores else None
+
+	pool = ThreadPool(max(1, min(workers, len(bus_lines))))
+	limiter = RateLimiter(rate)
+	latencies, fetch_time, write_time, rows, errors = [], 0., 0., 0, 0
+	try:
+		start = time.time()
+		for i in range(rounds):
+			t0 = time.time()
+			results = fetch_lines(client, bus_lines, extract=extract, pool=pool, limiter=limiter,
+				retries=0, stream=stream, **params)
+			t1 = time.time()
+			latencies += [r['latency'] for r in results if r['latency'] is not None]
+			errors += sum(r['df'] is None for r in results)
+
+			df = build_lines_dataframe(results, extract)
+			if sink is None:
+				df.to_csv(os.path.join(directory, '{}.csv'.format(i)))
+			else:
+				for line_ref, line_df in df.groupby('LineRef'):
+					sink.append(line_df.drop('LineRef', axis=1), line_ref, t0)
+			fetch_time += t1 - t0
+			write_time += time.time() - t1
+			rows += len(df)
+		elapsed = time.time() - start
+		size = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(directory) for f in fs)
+	finally:
+		pool.close()
+		client.close()
+		shutil.rmtree(directory, ignore_errors=True)
+
+	requests = rounds * len(bus_lines)
+	return {
+		'requests': requests,
+		'errors': errors,
+		'rows': rows,
+		'seconds': elapsed,
+		'requests_per_s': requests / elapsed,
+		'rows_per_s': rows / elapsed,
+		'fetch_parse_s': fetch_time,
+		'write_s': write_time,
+		'latency_p50': _percentile(latencies, 50),
+		'latency_p95': _percentile(latencies, 95),
+		'bytes_written': size,
+	}
+
+
+def check_history(history, params, metrics, tolerance=0.2, key='rows_per_s'):
+	'''Compare a run with the median of the previous runs of the same params in a history file.
+	Returns (median, ratio) or None if there are no previous runs.'''
+	previous = []
+	if os.path.isfile(history):
+		with open(history) as f:
+			for line in f:
+				run = json.loads(line)
+				if run['params'] == params and run['metrics'].get(key):
+					previous.append(run['metrics'][key])
+	if not previous:
+		return None
+	median = _percentile(previous, 50)
+	return median, metrics[key] / median
+
+
+def append_history(history, params, metrics):
+	'''Append a run to a JSON lines history file'''
+	with open(history, 'a') as f:
+		f.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _commit(),
+			'params': params, 'metrics': metrics}, sort_keys=True) + '\n')
+
+
+
+# Command line
+#######################
+
+def parse_args(argv):
+	parser = optparse.OptionParser(usage='bus_replay.py record|serve|bench [options] [mta_key] [bus_line(s)]')
+	parser.add_option('--out', default='recordings', type='string',
+		help='record: directory of the recordings (default: recordings)')
+	parser.add_option('--count', default=1, type='int',
+		help='record: number of polls (default: 1)')
+	parser.add_option('--interval', default=30., type='float',
+		help='record: seconds between polls (default: 30)')
+	parser.add_option('--url', default=SIRI_URL, type='string',
+		help='record: vehicle-monitoring endpoint (default: MTA Bus Time)')
+	parser.add_option('--recordings', default=None, type='string',
+		help='serve/bench: directory of recordings to replay (default: synthetic responses)')
+	parser.add_option('--vehicles', default=200, type='int',
+		help='serve/bench: buses in each synthetic response (default: 200)')
+	parser.add_option('--calls', default=0, type='int',
+		help='serve/bench: onward calls of each synthetic bus (default: 0)')
+	parser.add_option('--latency', default=0., type='float',
+		help='serve/bench: seconds the server waits before answering (default: 0)')
+	parser.add_option('--server-rate', default=None, type='float',
+		help='serve/bench: requests per second the server answers, 429 above (default: no limit)')
+	parser.add_option('--port', default=8765, type='int',
+		help='serve: port (default: 8765)')
+	parser.add_option('--lines', default='B52', type='string',
+		help='bench: lines fetched each round, comma separated or @file (default: B52)')
+	parser.add_option('--rounds', default=10, type='int',
+		help='bench: number of polls (default: 10)')
+	parser.add_option('--workers', default=4, type='int',
+		help='bench: lines fetched at the same time (default: 4)')
+	parser.add_option('--rate', default=None, type='float',
+		help='bench: client side max requests per second (default: no limit)')
+	parser.add_option('--store', default='csv', type='choice', choices=['csv', 'snapshots', 'delta', 'parquet'],
+		help='bench: where the rows are written: csv, snapshots, delta or parquet (default: csv)')
+	parser.add_option('--stream', default=False, action='store_true',
+		help='bench: parse the responses off the socket')
+	parser.add_option('--onward-calls', default=False, action='store_true',
+		help='bench: one row per onward call')
+	parser.add_option('--history', default='bench_history.jsonl', type='string',
+		help='bench: JSON lines file the results are appended to (default: bench_history.jsonl)')
+	parser.add_option('--tolerance', default=0.2, type='float',
+		help='bench: slowdown vs the median of previous runs reported as a regression (default: 0.2)')
+	return parser.parse_args(argv)
+
+
+def _server(options, port=0):
+	if options.recordings:
+		return ReplayServer(load_recordings(options.recordings), latency=options.latency,
+			rate=options.server_rate, port=port)
+	return ReplayServer(payload=synthetic_payload(options.vehicles, options.calls), latency=options.latency,
+		rate=options.server_rate, port=port)
+
+
+def main(argv):
+	options, args = parse_args(argv)
+	if not args or args[0] not in ('record', 'serve', 'bench'):
+		raise ValueError('Please choose record, serve or bench. e.g. bus_replay.py record xx...xx B52')
+	command, args = args[0], args[1:]
+
+	if command == 'record':
+		if len(args) == 1:
+			mta_key, bus_line = os.getenv('MTAKEY'), args[0]
+			if not mta_key:
+				raise ValueError('Missing MTA key. Please specify your key as the first command line argument or use the MTAKEY environmental variable.')
+		elif len(args) == 2:
+			mta_key, bus_line = args
+		else:
+			raise ValueError('Please enter both your MTA key and the bus line. e.g. bus_replay.py record xx...xx B52')
+		client = SiriClient(mta_key, url=options.url)
+		try:
+			record(client, read_lines(bus_line), options.out, options.count, options.interval)
+		finally:
+			client.close()
+
+	elif command == 'serve':
+		server = _server(options, options.port)
+		print('Serving SIRI responses at {}'.format(server.url))
+		try:
+			server.httpd.serve_forever()
+		except KeyboardInterrupt:
+			print('{} requests, {} throttled.'.format(server.requests, server.throttled))
+		finally:
+			server.httpd.server_close()
+
+	else:
+		params = dict(recordings=options.recordings, vehicles=None if options.recordings else options.vehicles,
+			calls=None if options.recordings else options.calls, latency=options.latency,
+			server_rate=options.server_rate, lines=read_lines(options.lines), rounds=options.rounds,
+			workers=options.workers, rate=options.rate, store=options.store, stream=options.stream,
+			onward_calls=options.onward_calls)
+		with _server(options) as server:
+			metrics = run_benchmark(server.url, params['lines'], options.rounds, options.workers, options.rate,
+				options.store, options.stream, options.onward_calls)
+
+		for k in sorted(metrics):
+			value = metrics[k]
+			print('{:<16} {}'.format(k, '{:.4f}'.format(value) if isinstance(value, float) else value))
+		previous = check_history(options.history, params, metrics)
+		if previous:
+			median, ratio = previous
+			print('rows/s vs median of previous runs: {:.2f}x'.format(ratio))
+			if ratio < 1 - options.tolerance:
+				print('REGRESSION: {:.0f} rows/s, previous median {:.0f} rows/s'.format(metrics['rows_per_s'], median))
+		append_history(options.history, params, metrics)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
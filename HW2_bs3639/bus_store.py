@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+On-disk history of bus snapshots.
+
+SnapshotStore appends every snapshot to a csv partitioned by line and time:
+
+	<directory>/<LineRef>/<YYYY-MM-DD>/<HH>.csv
+
+so a day of polling is a folder of small files that can be appended to, read
+back one hour at a time, or deleted by date.
+
+DeltaStore only records what changed for each vehicle since the previous
+snapshot, as one json line per snapshot in one file per line and day:
+
+	<directory>/<LineRef>/<YYYY-MM-DD>.jsonl
+
+	{"t":1505916000.0,"keyframe":true,"columns":["Latitude","Longitude","Stop Name"],
+	 "set":{"MTA NYCT_4000":{"0":40.61,"1":-73.92,"2":"AV J/E 16 ST"},...}}
+	{"t":1505916030.0,"set":{"MTA NYCT_4000":{"0":40.62}}}
+	{"t":1505916060.0,"set":{...},"del":["MTA NYCT_4000"]}
+
+Fields are numbered by their position in the keyframe's columns. Each file starts
+with a keyframe, so any snapshot can be rebuilt from its day's file alone.
+
+ParquetStore (needs pyarrow) writes columnar files partitioned by date and line:
+
+	<directory>/date=<YYYY-MM-DD>/line=<LineRef>/part-*.parquet
+
+Each append is a small file; compact() merges the small files of a partition into
+one, sorted by time with row group statistics, so reading a time window of a route
+only opens that route's partitions for those days and skips the row groups outside it.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import glob
+import uuid
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+
+class SnapshotStore(object):
+	partition = os.path.join('%Y-%m-%d', '%H') + '.csv'
+
+	def __init__(self, directory, partition=None):
+		'''
+		directory (str): root directory of the store
+		partition (str): strftime pattern of the file a snapshot goes to, relative to the line folder
+		'''
+		self.directory = directory
+		self.partition = partition or self.partition
+
+	def path(self, line_ref, timestamp):
+		'''The file holding the snapshots of a line at a time (unix seconds)'''
+		return os.path.join(self.directory, line_ref, time.strftime(self.partition, time.localtime(timestamp)))
+
+	def append(self, df, line_ref, timestamp=None):
+		'''Append a snapshot, stamped with the time it was recorded at
+
+		df (pd.DataFrame): the snapshot
+		line_ref (str): the bus line
+		timestamp (float): unix seconds (default: now)
+
+		Returns the file it was written to
+		'''
+		timestamp = time.time() if timestamp is None else timestamp
+		path = self.path(line_ref, timestamp)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+		df = df.copy()
+		df.insert(0, 'RecordedAtTime', timestamp)
+		is_new = not os.path.isfile(path)
+		with open(path, 'a') as f:
+			df.to_csv(f, header=is_new, index=False)
+		return path
+
+	def read(self, line_ref, start=None, end=None):
+		'''All the snapshots of a line, optionally between two times (unix seconds)'''
+		files = sorted(
+			os.path.join(root, f)
+			for root, _, names in os.walk(os.path.join(self.directory, line_ref))
+			for f in names if f.endswith('.csv'))
+		df = pd.concat([pd.read_csv(f) for f in files], ignore_index=True) if files else pd.DataFrame()
+		if start is not None:
+			df = df[df.RecordedAtTime >= start]
+		if end is not None:
+			df = df[df.RecordedAtTime < end]
+		return df
+
+
+
+class DeltaStore(object):
+
+	def __init__(self, directory, key=('VehicleRef',)):
+		'''
+		directory (str): root directory of the store
+		key (list): the columns identifying a row across snapshots
+		'''
+		self.directory = directory
+		self.key = list(key)
+		self._last = {} # line -> (file, previous snapshot indexed by key)
+
+	def path(self, line_ref, timestamp):
+		'''The file holding the changes of a line on the day of a time (unix seconds)'''
+		return os.path.join(self.directory, line_ref, time.strftime('%Y-%m-%d', time.localtime(timestamp)) + '.jsonl')
+
+	def _id(self, key):
+		'''json key of a row key'''
+		return json.dumps(_json(list(key))) if len(self.key) > 1 else str(key)
+
+	def _unid(self, i):
+		return tuple(json.loads(i)) if len(self.key) > 1 else (i,)
+
+	def append(self, df, line_ref, timestamp=None):
+		'''Record the fields that changed since the previous snapshot of the line
+
+		df (pd.DataFrame): the snapshot, with the key columns
+		line_ref (str): the bus line
+		timestamp (float): unix seconds (default: now)
+
+		Returns the file it was written to
+		'''
+		timestamp = time.time() if timestamp is None else timestamp
+		path = self.path(line_ref, timestamp)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+		current = df.drop_duplicates(self.key).set_index(self.key)
+		columns = list(current.columns)
+		last_path, previous = self._last.get(line_ref, (None, None))
+		record = {'t': timestamp}
+
+		# new file, nothing to diff against (e.g. after a restart) or new columns: write it all
+		if previous is None or last_path != path or list(previous.columns) != columns:
+			record.update(keyframe=True, columns=columns)
+			changed = pd.DataFrame(True, index=current.index, columns=columns)
+		else:
+			prev = previous.reindex(current.index)
+			changed = (current != prev) & ~(current.isnull() & prev.isnull())
+			gone = previous.index[~previous.index.isin(current.index)]
+			if len(gone):
+				record['del'] = [self._id(key) for key in gone]
+
+		rows = changed.values.any(axis=1)
+		values, changed = current.values[rows], changed.values[rows]
+		if rows.any():
+			record['set'] = {
+				self._id(key): {str(i): _json(v) for i, v in enumerate(row) if change[i]}
+				for key, row, change in zip(current.index[rows], values, changed)
+			}
+
+		with open(path, 'a') as f:
+			f.write(json.dumps(record, separators=(',', ':')) + '\n')
+		self._last[line_ref] = path, current
+		return path
+
+	def _replay(self, path, end=None):
+		'''Yield (time, columns, snapshot) for each snapshot of a file, up to (excluding) time end'''
+		state, columns = {}, []
+		with open(path) as f:
+			for line in f:
+				r = json.loads(line)
+				if end is not None and r['t'] >= end:
+					return
+				if r.get('keyframe'):
+					state, columns = {}, r['columns']
+				for i in r.get('del', []):
+					state.pop(i, None)
+				for i, values in r.get('set', {}).items():
+					state.setdefault(i, {}).update(values)
+				yield r['t'], columns, state
+
+	def _frame(self, columns, state, t=None):
+		'''DataFrame of a replayed snapshot'''
+		ids = list(state)
+		df = pd.DataFrame(
+			[[state[i].get(str(c)) for c in range(len(columns))] for i in ids], columns=columns)
+		keys = pd.DataFrame([self._unid(i) for i in ids], columns=self.key)
+		df = pd.concat([keys, df], axis=1)
+		if t is not None:
+			df.insert(0, 'RecordedAtTime', t)
+		return df
+
+	def at(self, line_ref, timestamp):
+		'''The full table of a line as of a time (unix seconds): the last snapshot at or before it'''
+		path = self.path(line_ref, timestamp)
+		columns, state = [], {}
+		if os.path.isfile(path):
+			for _, columns, state in self._replay(path, end=timestamp + 1e-6):
+				pass
+		return self._frame(columns, state)
+
+	def read(self, line_ref, start=None, end=None):
+		'''All the snapshots of a line, optionally between two times (unix seconds), rebuilt in full'''
+		folder = os.path.join(self.directory, line_ref)
+		files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.jsonl')) if os.path.isdir(folder) else []
+		dfs = [
+			self._frame(columns, state, t)
+			for path in files
+			for t, columns, state in self._replay(path, end)
+			if start is None or t >= start
+		]
+		return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+
+def _json(v):
+	'''json-able version of a value'''
+	if isinstance(v, list):
+		return [_json(x) for x in v]
+	if isinstance(v, np.generic):
+		v = v.item()
+	if isinstance(v, float) and v != v:
+		return None # NaN
+	return v
+
+
+class ParquetStore(object):
+	# types of the known numeric columns, so a snapshot where they are all missing
+	# doesn't write them as strings (files of one partition must share a schema)
+	TYPES = {'RecordedAtTime': 'float64', 'Latitude': 'float64', 'Longitude': 'float64', 'Bearing': 'float64'}
+
+	def __init__(self, directory, row_group_size=50000, compact_every=None, na_values=('N/A',), types=None):
+		'''
+		directory (str): root directory of the store
+		row_group_size (int): rows per row group of compacted files
+		compact_every (int): compact a partition when it has this many small files (default: never automatically)
+		na_values (list): values written as nulls, so numeric columns stay numeric
+		types (dict): arrow types of columns, e.g. {'Speed': 'float64'} (added to TYPES)
+		'''
+		if pa is None:
+			raise ImportError('ParquetStore depends on pyarrow, which could not be loaded.')
+		self.directory = directory
+		self.row_group_size = row_group_size
+		self.compact_every = compact_every
+		self.na_values = list(na_values)
+		self.types = dict(self.TYPES, **(types or {}))
+
+	def partition(self, line_ref, date):
+		'''The folder of a line on a date (YYYY-MM-DD)'''
+		return os.path.join(self.directory, 'date=' + date, 'line=' + line_ref)
+
+	def _date(self, timestamp):
+		return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+	def _table(self, df):
+		'''Arrow table of a snapshot. The columns in self.types get their type, the other columns
+		of only nulls (and large strings) are typed as strings so files stay compatible.'''
+		if self.na_values:
+			df = df.replace(self.na_values, None)
+		table = pa.Table.from_pandas(df, preserve_index=False)
+		schema = pa.schema([
+			pa.field(f.name, pa.type_for_alias(self.types[f.name])) if f.name in self.types else
+			pa.field(f.name, pa.string()) if pa.types.is_null(f.type) or pa.types.is_large_string(f.type) else f
+			for f in table.schema])
+		return table.cast(schema)
+
+	def append(self, df, line_ref, timestamp=None):
+		'''Write a snapshot, stamped with the time it was recorded at
+
+		df (pd.DataFrame): the snapshot
+		line_ref (str): the bus line
+		timestamp (float): unix seconds (default: now)
+
+		Returns the file it was written to (the merged file if the append triggered a compaction),
+		or None for an empty snapshot, which isn't written
+		'''
+		if not len(df):
+			return None
+		timestamp = time.time() if timestamp is None else timestamp
+		folder = self.partition(line_ref, self._date(timestamp))
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+		df = df.copy()
+		df.insert(0, 'RecordedAtTime', timestamp)
+		path = os.path.join(folder, 'part-{:.0f}-{}.parquet'.format(timestamp * 1000, uuid.uuid4().hex[:8]))
+		pq.write_table(self._table(df), path)
+
+		if self.compact_every and len(glob.glob(os.path.join(folder, 'part-*.parquet'))) >= self.compact_every:
+			path = self.compact(line_ref, self._date(timestamp))[0]
+		return path
+
+	def compact(self, line_ref=None, date=None):
+		'''Merge the small files of partitions into one file per partition, sorted by time
+
+		line_ref (str): only this line (default: all)
+		date (str): only this date, YYYY-MM-DD (default: all)
+		Returns the merged files
+		'''
+		merged = []
+		pattern = self.partition(line_ref or '*', date or '*')
+		for folder in glob.glob(pattern):
+			parts = sorted(glob.glob(os.path.join(folder, 'part-*.parquet')))
+			if len(parts) < 2:
+				continue
+			table = _read(parts).sort_by('RecordedAtTime')
+			first, last = table['RecordedAtTime'][0].as_py(), table['RecordedAtTime'][-1].as_py()
+			name = 'data-{:.0f}-{:.0f}-{}.parquet'.format(first * 1000, last * 1000, uuid.uuid4().hex[:8])
+			tmp = os.path.join(folder, '.' + name)
+			pq.write_table(table, tmp, row_group_size=self.row_group_size, write_statistics=True)
+			os.rename(tmp, os.path.join(folder, name)) # the merged file is complete before the parts go
+			for f in parts:
+				os.remove(f)
+			merged.append(os.path.join(folder, name))
+		return merged
+
+	def files(self, line_ref, start=None, end=None):
+		'''The files of a line, only in the date partitions between two times (unix seconds)'''
+		dates = [os.path.basename(d)[len('date='):] for d in glob.glob(os.path.join(self.directory, 'date=*'))]
+		if start is not None:
+			dates = [d for d in dates if d >= self._date(start)]
+		if end is not None:
+			dates = [d for d in dates if d <= self._date(end)]
+		return sorted(f for d in dates for f in glob.glob(os.path.join(self.partition(line_ref, d), '*.parquet')))
+
+	def read(self, line_ref, start=None, end=None, columns=None):
+		'''All the snapshots of a line, optionally between two times (unix seconds)
+
+		columns (list): only read these columns
+		'''
+		files = self.files(line_ref, start, end)
+		if not files:
+			return pd.DataFrame()
+		where = None
+		if start is not None:
+			where = ds.field('RecordedAtTime') >= start
+		if end is not None:
+			before = ds.field('RecordedAtTime') < end
+			where = before if where is None else where & before
+		return _read(files, columns=columns, filter=where).to_pandas()
+
+
+def _read(files, **kw):
+	'''Read parquet files with possibly different (but compatible) schemas as one table'''
+	schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+	return ds.dataset(files, schema=schema, format='parquet').to_table(**kw)
+
+
+if __name__ == '__main__':
+	# size of a simulated day of polling in both stores
+	import shutil
+	import tempfile
+	from siri_fields import synthetic_response, FieldExtractor, BUS_FIELDS
+
+	n_polls, n_vehicles = [int(a) for a in sys.argv[1:3]] or [120, 50]
+	fields = BUS_FIELDS.copy()
+	fields.update([('VehicleRef', 'VehicleRef'), ('Destination', 'DestinationName.0'),
+		('Direction', 'DirectionRef'), ('Bearing', 'Bearing'), ('Progress', 'ProgressRate')])
+	extract = FieldExtractor(fields)
+	df = extract(a['MonitoredVehicleJourney'] for a in
+		synthetic_response(n_vehicles)['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'][0]['VehicleActivity'])
+
+	directory = tempfile.mkdtemp()
+	try:
+		stores = [SnapshotStore(os.path.join(directory, 'csv')), DeltaStore(os.path.join(directory, 'delta'))]
+		rnd = np.random.RandomState(0)
+		t0 = time.mktime((2017, 9, 20, 10, 0, 0, 0, 0, -1))
+		snapshots = []
+		for i in range(n_polls):
+			# buses move every poll, and get to their next stop every ~5 polls
+			df['Latitude'] = (df['Latitude'] + rnd.normal(0, 1e-4, len(df))).round(6)
+			df['Longitude'] = (df['Longitude'] + rnd.normal(0, 1e-4, len(df))).round(6)
+			arrived = rnd.rand(len(df)) < 0.2
+			df.loc[arrived, 'Stop Name'] = ['STOP {}'.format(j) for j in rnd.randint(0, 1000, arrived.sum())]
+			for store in stores:
+				store.append(df, 'B52', t0 + 30 * i)
+			snapshots.append(df.assign(RecordedAtTime=t0 + 30 * i))
+
+		for name in ['csv', 'delta']:
+			size = sum(os.path.getsize(os.path.join(root, f))
+				for root, _, files in os.walk(os.path.join(directory, name)) for f in files)
+			print('{:<6} {:>10.1f}KB'.format(name, size / 1e3))
+		expected = pd.concat(snapshots, ignore_index=True)
+		rebuilt = stores[1].read('B52')[expected.columns]
+		print('rebuilt the same snapshots:', rebuilt.equals(expected))
+	finally:
+		shutil.rmtree(directory)
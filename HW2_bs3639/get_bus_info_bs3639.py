@@ -2,16 +2,16 @@
 from __future__ import print_function
 import sys
 import os
-import json
+import time
+import random
+import optparse
 import pandas as pd
 
-# try Python 3 version, fallback to Python 2 version
-try:
-    from urllib.request import urlopen
-    from urllib.parse import urlencode
-except ImportError:
-    from urllib import urlopen
-    from urllib import urlencode
+from multiprocessing.pool import ThreadPool
+from siri_client import SiriClient, SIRI_URL, vehicle_activity, read_lines, fetch_lines, print_latency_report, RateLimiter
+from bus_store import SnapshotStore, DeltaStore, ParquetStore
+from siri_fields import FieldExtractor, BUS_FIELDS, _NA_
+from stop_index import StopIndex, fill_stop_names
 
 
 """
@@ -19,21 +19,50 @@ except ImportError:
 python get_bus_info.py [mta_key] [bus_line] [output_filename]
 
 # or you can leave out the output file
-python get_bus_info.py [mta_key] [bus_line] 
+python get_bus_info.py [mta_key] [bus_line]
 	[output_filename=<bus_line>.csv]
 
 # and if you have your mta key saved as an environmental variable you can leave that out too
-python get_bus_info.py [bus_line] 
+python get_bus_info.py [bus_line]
 	[mta_key=os.getenv('MTAKEY')]
 	[output_filename=<bus_line>.csv]
 
 # the case where your mta key is an env var, but you want a different output filename is not covered. Sorry.
+
+# to keep tracking the line, poll every 30s (+/- 5s) and append each snapshot to
+# <store>/<bus_line>/<date>/<hour>.csv until you hit Ctrl-C
+python get_bus_info.py --poll --interval 30 --jitter 5 --store bus_snapshots [mta_key] [bus_line]
+
+# with --delta, only the fields that changed for each vehicle since the previous poll are written,
+# to <store>/<bus_line>/<date>.jsonl (see bus_store.DeltaStore to read them back)
+python get_bus_info.py --poll --delta [mta_key] [bus_line]
+
+# with --parquet, snapshots are written as parquet to <store>/date=<date>/line=<bus_line>/,
+# compacted every --compact-every polls (needs pyarrow). Without --poll, the one snapshot goes there too
+python get_bus_info.py --poll --parquet [mta_key] [bus_line]
+
+# --url points the script at another endpoint, e.g. a local stand-in serving canned SIRI json
+
+# several lines can be fetched concurrently, either comma separated or from a file (one line per row).
+# They are saved to one csv with a LineRef column (default: bus_info.csv)
+python get_bus_info.py --workers 16 --rate 20 [mta_key] B52,B54,M15 [output_filename]
+python get_bus_info.py [mta_key] @lines.txt [output_filename]
+
+# the columns are configurable as name=path into a MonitoredVehicleJourney (integers index lists)
+python get_bus_info.py --field "Vehicle=VehicleRef" --field "Destination=DestinationName.0" [mta_key] [bus_line]
+
+# --onward-calls requests VehicleMonitoringDetailLevel=calls and saves one row per onward call of each bus
+
+# --stream parses the buses one at a time as the response comes in, for big (calls level, all lines) responses
+
+# --stops fills the stop names SIRI left out with the stop nearest to the bus, from a GTFS stops.txt (or feed zip)
+python get_bus_info.py --stops google_transit_brooklyn.zip [mta_key] [bus_line]
 """
 
 
 def get_mta_key(require=True):
 	'''Attempts to retrieve an MTA key from the MTAKEY environmental variable
-	
+
 	require (bool): throw an error if key is missing (default: True)
 	'''
 	mta_key = os.getenv('MTAKEY')
@@ -49,67 +78,78 @@ def get_mta_key(require=True):
 # Parse Args
 #######################
 
+def parse_args(argv):
+	'''Returns the options and the mta key, bus lines, and output csv'''
+	parser = optparse.OptionParser(usage='get_bus_info.py [options] [mta_key] bus_line(s) [output_csv]')
+	parser.add_option('--poll', default=False, action='store_true',
+		help='keep polling the line and append each snapshot to the store')
+	parser.add_option('--interval', default=30., type='float',
+		help='seconds between polls (default: 30)')
+	parser.add_option('--jitter', default=5., type='float',
+		help='random +/- seconds added to each poll time (default: 5)')
+	parser.add_option('--store', default='bus_snapshots', type='string',
+		help='directory of the snapshot store (default: bus_snapshots)')
+	parser.add_option('--delta', default=False, action='store_true',
+		help='only store the fields that changed for each vehicle since the previous poll')
+	parser.add_option('--parquet', default=False, action='store_true',
+		help='store the snapshots as parquet partitioned by date and line (needs pyarrow)')
+	parser.add_option('--compact-every', default=120, type='int',
+		help='with --parquet, merge the small files of a partition every N polls (default: 120)')
+	parser.add_option('--url', default=SIRI_URL, type='string',
+		help='vehicle-monitoring endpoint (default: MTA Bus Time)')
+	parser.add_option('--workers', default=8, type='int',
+		help='number of lines fetched at the same time (default: 8)')
+	parser.add_option('--rate', default=None, type='float',
+		help='max requests per second (default: no limit)')
+	parser.add_option('--retries', default=3, type='int',
+		help='retries of a failed request, with exponential backoff (default: 3)')
+	parser.add_option('--field', default=[], action='append', type='string', dest='fields',
+		help='extra column as name=path into the journey, e.g. Vehicle=VehicleRef (repeatable)')
+	parser.add_option('--onward-calls', default=False, action='store_true',
+		help='one row per onward call of each bus (requests VehicleMonitoringDetailLevel=calls)')
+	parser.add_option('--stream', default=False, action='store_true',
+		help='parse the buses one at a time off the socket instead of loading the whole response')
+	parser.add_option('--stops', default=None, type='string',
+		help='GTFS stops.txt (or feed zip) used to fill missing stop names with the nearest stop')
+	options, args = parser.parse_args(argv)
+
+	# check command line arguments
+	if len(args) == 1:
+		bus_line, = args
+
+		# check environmental variables for mta key
+		mta_key = get_mta_key()
+		output_csv = None
+
+	elif len(args) == 2:
+		mta_key, bus_line = args
+
+		# Assume that MTA key has > 2 '-' separated parts
+		if len(mta_key.split('-')) <= 2:
+			mta_key, bus_line, output_csv = get_mta_key(), mta_key, bus_line
+		else:
+			output_csv = None
+
+	elif len(args) == 3:
+		mta_key, bus_line, output_csv = args
 
-# check command line arguments
-if len(sys.argv) == 2:
-	_, bus_line = sys.argv
-
-	# check environmental variables for mta key
-	mta_key = get_mta_key()
-	output_csv = '{}.csv'.format(bus_line)
-
-elif len(sys.argv) == 3:
-	_, mta_key, bus_line = sys.argv
-
-	# Assume that MTA key has > 2 '-' separated parts
-	if len(mta_key.split('-')) <= 2:
-		mta_key, bus_line, output_csv = get_mta_key(), mta_key, bus_line
 	else:
-		output_csv = '{}.csv'.format(bus_line)
-
-elif len(sys.argv) == 4:
-	_, mta_key, bus_line, output_csv = sys.argv
-
-else:
-	raise ValueError('Please enter both your MTA key and the bus line. e.g. show_bus_locations.py xx...xx B52')
+		raise ValueError('Please enter both your MTA key and the bus line. e.g. show_bus_locations.py xx...xx B52')
 
-# make cli arg case-insensitive
-bus_line = bus_line.upper()
+	# make cli arg case-insensitive
+	bus_lines = read_lines(bus_line)
+	if not output_csv:
+		output_csv = '{}.csv'.format(bus_lines[0]) if len(bus_lines) == 1 else 'bus_info.csv'
+	return options, mta_key, bus_lines, output_csv
 
 
 
-# Get Request
+# Build DataFrame
 #######################
 
-# build the request
-url = 'http://bustime.mta.info/api/siri/vehicle-monitoring.json'
-url += '?' + urlencode({
-	'key': mta_key,
-	'version': 2,
-	# 'VehicleMonitoringDetailLevel': 'calls',
-	'LineRef': bus_line
-})
-
-# get the response
-response = json.loads(urlopen(url).read().decode('utf-8'))
-# with open('data.json', 'r') as f: # cached
-# 	response = json.load(f)
-
-
-# Get the list of bus data
-vehicle_journeys = [
-	act['MonitoredVehicleJourney'] 
-	for act in response['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'][0]['VehicleActivity']
-]
-
-
-# Used to fill in any missing values
-_NA_ = 'N/A'
-
-
 def try_to_get(data, keys, default=_NA_):
 	'''Attempts to drill into a list/dict. If that fails, it returns a default argument
-	
+
 	data (list/dict): the object you want to drill into
 	keys (list): the list of keys to use sequentially
 	default (any): the value you want returned on failure
@@ -122,29 +162,165 @@ def try_to_get(data, keys, default=_NA_):
 		return default
 
 
-# Build dataframe
-df = pd.DataFrame([
-	[
-		journey['VehicleLocation'].get('Latitude', _NA_),
-		journey['VehicleLocation'].get('Longitude', _NA_),
-		try_to_get(journey, ['MonitoredCall', 'StopPointName', 0]),
-		try_to_get(journey, ['MonitoredCall', 'ArrivalProximityText']),
-		# try_to_get(journey, ['OnwardCalls', 'OnwardCall', 0, 'StopPointName', 0]), # alternate
-		# try_to_get(journey, ['OnwardCalls', 'OnwardCall', 0, 'ArrivalProximityText'])
-	]
-	for journey in vehicle_journeys
-], columns=['Latitude', 'Longitude', 'Stop Name', 'Stop Status'])
+def get_vehicle_journeys(response):
+	'''Get the list of bus data'''
+	return [act['MonitoredVehicleJourney'] for act in vehicle_activity(response)]
+
+
+# One row per bus: its location and next stop
+_extract = FieldExtractor(BUS_FIELDS)
+
+
+def make_extractor(fields=(), onward_calls=False, vehicle_ref=False):
+	'''The FieldExtractor for the bus fields plus extra `name=path` fields (and VehicleRef)'''
+	columns = BUS_FIELDS.copy()
+	if vehicle_ref:
+		columns['VehicleRef'] = 'VehicleRef'
+	columns.update(f.split('=', 1) for f in fields)
+	return FieldExtractor(columns, explode='OnwardCalls.OnwardCall' if onward_calls else None)
+
+
+def build_dataframe(vehicle_journeys, extract=None):
+	'''Flatten the journeys, one row per bus by default'''
+	return (extract or _extract).dataframe(vehicle_journeys)
+
 
+def build_lines_dataframe(results, extract=None):
+	'''One dataframe for the fetch_lines results of many lines, with a LineRef column.
+	Results are either already flattened (fetched with extract) or responses.'''
+	extract = extract or _extract
+	dfs = []
+	for r in results:
+		df = r.get('df')
+		if df is None and r['response'] is not None:
+			df = build_dataframe(get_vehicle_journeys(r['response']), extract)
+		if df is not None:
+			df = df.copy()
+			df.insert(0, 'LineRef', r['LineRef'])
+			dfs.append(df)
+	if not dfs:
+		return pd.DataFrame(columns=['LineRef'] + extract.columns)
+	return pd.concat(dfs, ignore_index=True)
 
-# Output Results to File
-##########################
 
-df.to_csv(output_csv)
 
-print('Bus information saved to {}.'.format(output_csv))
+# Polling
+#######################
+
+def poll(client, bus_lines, store, interval=30., jitter=5., count=None, extract=None, workers=8, rate=None, stops=None, **kw):
+	'''Fetch lines every `interval` seconds and append the snapshots to the store
+
+	client (SiriClient): reused for every request, so the connections stay open
+	bus_lines (list): the bus lines
+	store (SnapshotStore): where the snapshots go
+	interval (float): seconds between polls. Polls are scheduled on a fixed grid so they don't drift
+	jitter (float): each poll time is moved by a random amount in [-jitter, jitter] seconds
+	count (int): number of polls (default: until interrupted)
+	extract (FieldExtractor): how journeys are flattened
+	workers (int): number of lines fetched at the same time
+	rate (float): max requests per second
+	stops (StopIndex): fills the missing stop names with the nearest stop
+	**kw: passed to fetch_lines (retries, stream)
+	'''
+	# the same threads (and so the same connections) are used for every poll
+	pool = ThreadPool(max(1, min(workers, len(bus_lines))))
+	limiter = RateLimiter(rate)
+	try:
+		start = time.time()
+		i = 0
+		while count is None or i < count:
+			for r in fetch_lines(client, bus_lines, extract=extract or _extract, pool=pool, limiter=limiter, **kw):
+				try:
+					df = r['df']
+					if df is None:
+						raise IOError(r['error'])
+					if stops is not None:
+						df = fill_stop_names(df, stops)
+					path = store.append(df, r['LineRef'])
+					if path is None:
+						print('{}: no {} buses'.format(time.strftime('%H:%M:%S'), r['LineRef']))
+					else:
+						print('{}: {} {} buses saved to {}'.format(time.strftime('%H:%M:%S'), len(df), r['LineRef'], path))
+				except (IOError, ValueError, KeyError) as e: # keep polling through network/API errors
+					print('{}: {} request failed - {}'.format(time.strftime('%H:%M:%S'), r['LineRef'], e))
+
+			i += 1
+			if count is not None and i >= count:
+				break
+			next_time = start + i * interval + random.uniform(-jitter, jitter)
+			time.sleep(max(0, next_time - time.time()))
+	finally:
+		pool.close()
+
+
+
+def main(argv):
+	options, mta_key, bus_lines, output_csv = parse_args(argv)
+	client = SiriClient(mta_key, url=options.url)
+	fetch_kw = dict(workers=options.workers, rate=options.rate, retries=options.retries)
+	params = {'VehicleMonitoringDetailLevel': 'calls'} if options.onward_calls else {}
+	fetch_kw.update(params, stream=options.stream)
+	extract = make_extractor(options.fields, options.onward_calls, vehicle_ref=options.delta)
+	stops = StopIndex.from_gtfs(options.stops) if options.stops else None
+
+	if options.parquet:
+		store = ParquetStore(options.store, compact_every=options.compact_every)
+	elif options.delta:
+		store = DeltaStore(options.store, key=['VehicleRef', 'Call'] if options.onward_calls else ['VehicleRef'])
+	else:
+		store = SnapshotStore(options.store)
+
+	if options.poll:
+		try:
+			poll(client, bus_lines, store, options.interval, options.jitter,
+				extract=extract, stops=stops, **fetch_kw)
+		except KeyboardInterrupt:
+			print('Stopped polling.')
+		finally:
+			client.close()
+		return
+
+	if len(bus_lines) > 1:
+		results = fetch_lines(client, bus_lines, extract=extract, **fetch_kw)
+		print_latency_report(results)
+		df = build_lines_dataframe(results, extract)
+		if stops is not None:
+			df = fill_stop_names(df, stops)
+		if options.parquet:
+			for line_ref, line_df in df.groupby('LineRef'):
+				store.append(line_df.drop('LineRef', axis=1), line_ref)
+			print('Information on {} buses of {} lines saved to {}.'.format(len(df), len(bus_lines), options.store))
+			return
+		df.to_csv(output_csv)
+		print('Information on {} buses of {} lines saved to {}.'.format(len(df), len(bus_lines), output_csv))
+		return
+
+	# Get Request
+	#######################
+
+	if options.stream:
+		df = build_dataframe(client.journeys(bus_lines[0], stream=True, **params), extract)
+	else:
+		# get the response
+		response = client.get(bus_lines[0], **params)
+		# offline: record responses and serve them back with bus_replay.py, then pass --url
+
+		df = build_dataframe(get_vehicle_journeys(response), extract)
+	client.close()
+	if stops is not None:
+		df = fill_stop_names(df, stops)
+
 
-# with open('data.json', 'w') as f: # cache
-# 	json.dump(response, f)
+	# Output Results to File
+	##########################
+
+	if options.parquet:
+		output_csv = store.append(df, bus_lines[0])
+	else:
+		df.to_csv(output_csv)
 
+	print('Bus information saved to {}.'.format(output_csv))
 
 
+if __name__ == '__main__':
+	main(sys.argv[1:])
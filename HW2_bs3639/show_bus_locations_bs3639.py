@@ -3,84 +3,101 @@ from __future__ import print_function
 import pandas as pd
 import sys
 import os
-import json
+import optparse
 
-# try Python 3 version, fallback to Python 2 version
-try:
-    from urllib.request import urlopen
-    from urllib.parse import urlencode
-except ImportError:
-    from urllib import urlopen
-    from urllib import urlencode
+from siri_client import SiriClient, SIRI_URL, vehicle_activity, read_lines, fetch_lines, print_latency_report
 
 
-# Parse Args
-#######################
+"""
+python show_bus_locations.py [mta_key] [bus_line]
 
-# check command line arguments
-if len(sys.argv) == 2:
-	_, bus_line = sys.argv
+# several lines are fetched concurrently, either comma separated or from a file (one line per row)
+python show_bus_locations.py --workers 16 --rate 20 [mta_key] B52,B54,M15
+python show_bus_locations.py [mta_key] @lines.txt
+"""
 
-	# check environmental variables for mta key
-	print('Checking for MTA key in environmental variables')
-	
-	mta_key = os.getenv('MTAKEY')
-	if not mta_key:
-		raise ValueError('Missing MTA key. Please specify your key as the first command line argument or use the MTAKEY environmental variable.')
-	
-	print('Found!')
 
-elif len(sys.argv) == 3:
-	_, mta_key, bus_line = sys.argv
+# Parse Args
+#######################
 
-else:
-	raise ValueError('Please enter both your MTA key and the bus line. e.g. show_bus_locations.py xx...xx B52')
+def parse_args(argv):
+	'''Returns the options and the mta key and bus lines'''
+	parser = optparse.OptionParser(usage='show_bus_locations.py [options] [mta_key] bus_line(s)')
+	parser.add_option('--url', default=SIRI_URL, type='string',
+		help='vehicle-monitoring endpoint (default: MTA Bus Time)')
+	parser.add_option('--workers', default=8, type='int',
+		help='number of lines fetched at the same time (default: 8)')
+	parser.add_option('--rate', default=None, type='float',
+		help='max requests per second (default: no limit)')
+	parser.add_option('--retries', default=3, type='int',
+		help='retries of a failed request, with exponential backoff (default: 3)')
+	options, args = parser.parse_args(argv)
 
-# make cli arg case-insensitive
-bus_line = bus_line.upper()
+	# check command line arguments
+	if len(args) == 1:
+		bus_line, = args
 
+		# check environmental variables for mta key
+		print('Checking for MTA key in environmental variables')
 
+		mta_key = os.getenv('MTAKEY')
+		if not mta_key:
+			raise ValueError('Missing MTA key. Please specify your key as the first command line argument or use the MTAKEY environmental variable.')
 
+		print('Found!')
 
+	elif len(args) == 2:
+		mta_key, bus_line = args
 
-# Get Request
-#######################
+	else:
+		raise ValueError('Please enter both your MTA key and the bus line. e.g. show_bus_locations.py xx...xx B52')
 
-# build the request
-url = 'http://bustime.mta.info/api/siri/vehicle-monitoring.json'
-url += '?' + urlencode({
-	'key': mta_key,
-	'version': 2,
-	'LineRef': bus_line
-})
+	# make cli arg case-insensitive
+	return options, mta_key, read_lines(bus_line)
 
-# get the response
-response = json.loads(urlopen(url).read().decode('utf-8'))
-# with open('data.json', 'r') as f: # cached
-# 	response = json.load(f)
 
 
+# Output Results
+#######################
 
+def print_locations(bus_line, response):
+	'''Print the location of every bus of a line'''
+	# Get the list of buses
+	vehicles = vehicle_activity(response)
 
+	# Print results
+	print('')
+	print('Bus Line: {}'.format(bus_line))
+	print('Number of Active Buses: {}'.format(len(vehicles)))
 
-# Output Results
-#######################
+	for i, act in enumerate(vehicles):
+		loc = act['MonitoredVehicleJourney']['VehicleLocation']
+		print('Bus {} is at {} latitude and {} longitude'.format(i, loc['Latitude'], loc['Longitude']))
 
-# Get the list of buses
-vehicle_activity = response['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'][0]['VehicleActivity']
 
-# Print results
-print('')
-print('Bus Line: {}'.format(bus_line))
-print('Number of Active Buses: {}'.format(len(vehicle_activity)))
+def main(argv):
+	options, mta_key, bus_lines = parse_args(argv)
+	client = SiriClient(mta_key, url=options.url)
 
-for i, act in enumerate(vehicle_activity):
-	loc = act['MonitoredVehicleJourney']['VehicleLocation']
-	print('Bus {} is at {} latitude and {} longitude'.format(i, loc['Latitude'], loc['Longitude']))
+	# Get Request
+	#######################
 
-# with open('data.json', 'w') as f: # cache
-# 	json.dump(response, f)
+	if len(bus_lines) > 1:
+		results = fetch_lines(client, bus_lines, workers=options.workers, rate=options.rate, retries=options.retries)
+		for r in results:
+			if r['response'] is not None:
+				print_locations(r['LineRef'], r['response'])
+		print('')
+		print_latency_report(results)
+		return
 
+	# get the response
+	response = client.get(bus_lines[0])
+	client.close()
+	# offline: record responses and serve them back with bus_replay.py, then pass --url
 
+	print_locations(bus_lines[0], response)
 
 
+if __name__ == '__main__':
+	main(sys.argv[1:])
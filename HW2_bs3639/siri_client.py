@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+"""
+A small client for the MTA Bus Time SIRI vehicle-monitoring API that keeps its
+HTTP connection open between requests, so polling doesn't pay for a new
+connection every time.
+
+client = SiriClient(mta_key)
+response = client.get('B52')
+vehicle_activity(response)
+
+Pass url to point it somewhere else, e.g. a local stand-in serving canned SIRI json.
+
+To fetch many lines at once, fetch_lines runs the requests in a thread pool,
+each thread with its own connection, under a global rate limit:
+
+results = fetch_lines(client, ['B52', 'B54', 'M15'], workers=8, rate=10)
+
+For big responses (all lines, VehicleMonitoringDetailLevel=calls), iter_activity
+parses the VehicleActivity items one at a time as they come off the socket,
+instead of holding the raw bytes, the decoded text and the whole parsed tree:
+
+for activity in client.iter_activity(VehicleMonitoringDetailLevel='calls'):
+	...
+
+When many consumers (dashboards, threads) ask for the same line within a few
+seconds, CachingSiriClient answers repeated requests from a TTL cache, and
+concurrent identical requests share one upstream call:
+
+client = CachingSiriClient(mta_key, ttl=10)
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import codecs
+import io
+import random
+import threading
+from multiprocessing.pool import ThreadPool
+
+# try Python 3 version, fallback to Python 2 version
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlencode, urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib import urlencode
+    from urlparse import urlsplit
+
+
+SIRI_URL = 'http://bustime.mta.info/api/siri/vehicle-monitoring.json'
+
+
+class SiriError(IOError):
+	'''A request answered with an HTTP error status'''
+	def __init__(self, status, message):
+		IOError.__init__(self, message)
+		self.status = status
+
+	@property
+	def retryable(self):
+		'''Rate limited or a server error. Client errors (bad key, unknown path) won't get better.'''
+		return self.status == 429 or self.status >= 500
+
+
+class SiriClient(object):
+
+	def __init__(self, mta_key, url=SIRI_URL, timeout=30):
+		'''
+		mta_key (str): your MTA Bus Time key
+		url (str): the vehicle-monitoring endpoint
+		timeout (float): socket timeout in seconds
+		'''
+		self.mta_key = mta_key
+		self.url = url
+		self.timeout = timeout
+
+		parts = urlsplit(url)
+		self._connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+		self._netloc = parts.netloc
+		self._path = parts.path
+		self._local = threading.local() # http connections can't be shared across threads
+
+	def connection(self):
+		'''The open connection of the current thread, connecting if needed'''
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = self._local.conn = self._connection_class(self._netloc, timeout=self.timeout)
+		return conn
+
+	def close(self):
+		'''Close the connection of the current thread'''
+		conn = getattr(self._local, 'conn', None)
+		if conn is not None:
+			conn.close()
+			self._local.conn = None
+
+	def request_url(self, line_ref=None, **params):
+		'''The path and query string of a request'''
+		query = {'key': self.mta_key, 'version': 2}
+		if line_ref:
+			query['LineRef'] = line_ref
+		query.update(params)
+		return self._path + '?' + urlencode(query)
+
+	def open(self, line_ref=None, **params):
+		'''Send a request and return the response object, without reading it.
+		The connection can't be reused until the response has been read.
+
+		line_ref (str): the bus line, e.g. B52 (default: all lines)
+		**params: any other SIRI parameters, e.g. VehicleMonitoringDetailLevel='calls'
+		'''
+		path = self.request_url(line_ref, **params)
+		# a kept-alive connection may have been dropped by the server since the last request, retry once
+		for attempt in range(2):
+			conn = self.connection()
+			try:
+				conn.request('GET', path, headers={'Accept-Encoding': 'identity'})
+				response = conn.getresponse()
+				break
+			except (HTTPException, IOError):
+				self.close()
+				if attempt:
+					raise
+		if response.status != 200:
+			body = response.read()
+			raise SiriError(response.status, 'SIRI request failed ({} {}): {}'.format(response.status, response.reason, body[:200]))
+		return response
+
+	def fetch(self, line_ref=None, **params):
+		'''Raw bytes of a response. See open(...) for arguments.'''
+		return self.open(line_ref, **params).read()
+
+	def get(self, line_ref=None, **params):
+		'''Parsed json of a response. See open(...) for arguments.'''
+		return json.loads(self.fetch(line_ref, **params).decode('utf-8'))
+
+	def iter_activity(self, line_ref=None, chunk_size=65536, **params):
+		'''Yield the VehicleActivity items of a response as they are parsed off the socket.
+		See open(...) for arguments.'''
+		response = self.open(line_ref, **params)
+		done = False
+		try:
+			for activity in iter_vehicle_activity(response, chunk_size):
+				yield activity
+			response.read() # drain the end of the response so the connection can be reused
+			done = True
+		finally:
+			if not done: # stopped halfway, the connection can't be reused
+				self.close()
+
+	def journeys(self, line_ref=None, stream=False, **params):
+		'''The MonitoredVehicleJourney of each bus. With stream, a generator parsing them
+		one at a time. See open(...) for arguments.'''
+		if stream:
+			return (act['MonitoredVehicleJourney'] for act in self.iter_activity(line_ref, **params))
+		return [act['MonitoredVehicleJourney'] for act in vehicle_activity(self.get(line_ref, **params))]
+
+
+class _Call(object):
+	'''A request in flight, that other threads asking for the same thing wait on'''
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = self.error = None
+
+
+class CachingSiriClient(SiriClient):
+
+	def __init__(self, mta_key, url=SIRI_URL, timeout=30, ttl=10., max_entries=1024):
+		'''
+		mta_key, url, timeout: see SiriClient
+		ttl (float): seconds a response is reused for
+		max_entries (int): max number of responses kept
+		'''
+		SiriClient.__init__(self, mta_key, url, timeout)
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self._cache = {} # request -> (expiry time, response bytes)
+		self._calls = {} # request -> _Call in flight
+		self._lock = threading.Lock()
+		self.stats = {'hits': 0, 'coalesced': 0, 'upstream': 0}
+
+	def open(self, line_ref=None, **params):
+		'''A file-like object over the (possibly cached) response. See SiriClient.open(...)'''
+		key = self.request_url(line_ref, **params)
+		return io.BytesIO(self._cached(key, lambda: SiriClient.open(self, line_ref, **params).read()))
+
+	def _cached(self, key, fetch):
+		'''The cached bytes of a request, or the bytes of the request already in flight,
+		or fetch them (once, however many threads are asking)'''
+		with self._lock:
+			now = time.time()
+			entry = self._cache.get(key)
+			if entry is not None and entry[0] > now:
+				self.stats['hits'] += 1
+				return entry[1]
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+				self.stats['upstream'] += 1
+			else:
+				self.stats['coalesced'] += 1
+
+		if not leader:
+			call.done.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result
+
+		try:
+			call.result = fetch()
+			with self._lock:
+				self._store(key, call.result)
+			return call.result
+		except Exception as e:
+			call.error = e # the waiting threads get the same error
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+
+	def _store(self, key, data):
+		'''Cache a response, dropping expired (then oldest) entries when full'''
+		now = time.time()
+		if len(self._cache) >= self.max_entries:
+			for k in [k for k, (expiry, _) in self._cache.items() if expiry <= now]:
+				del self._cache[k]
+		while len(self._cache) >= self.max_entries:
+			del self._cache[min(self._cache, key=lambda k: self._cache[k][0])]
+		self._cache[key] = (now + self.ttl, data)
+
+	def clear(self):
+		'''Forget the cached responses'''
+		with self._lock:
+			self._cache.clear()
+
+
+def vehicle_activity(response):
+	'''The list of VehicleActivity of a parsed SIRI response'''
+	return response['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'][0].get('VehicleActivity', [])
+
+
+_decoder = json.JSONDecoder()
+
+def iter_vehicle_activity(fp, chunk_size=65536, key='VehicleActivity'):
+	'''Incrementally parse the items of the VehicleActivity array of a SIRI json stream.
+	Only the current chunk and the item being parsed are held in memory.
+
+	fp (file-like): binary stream of the response
+	chunk_size (int): bytes read at a time
+	key (str): the key of the array
+	'''
+	decode = codecs.getincrementaldecoder('utf-8')().decode
+	buf, eof = '', False
+
+	def more(buf):
+		data = fp.read(chunk_size)
+		return buf + decode(data, final=not data), not data
+
+	# find the start of the array
+	token = '"{}"'.format(key)
+	while True:
+		i = buf.find(token)
+		if i >= 0:
+			buf = buf[i + len(token):]
+			break
+		if eof:
+			return # no vehicles
+		buf = buf[-len(token):] # the token may straddle two chunks
+		buf, eof = more(buf)
+
+	pos, started = 0, False
+	while True:
+		# skip to the next item: whitespace, the ':' and '[' before the first one, ',' between them
+		while pos < len(buf) and buf[pos] in ' \t\r\n:,[' and not (started and buf[pos] == '['):
+			started = started or buf[pos] == '['
+			pos += 1
+		if pos == len(buf):
+			if eof:
+				raise ValueError('Truncated SIRI response')
+			buf, pos = buf[pos:], 0
+			buf, eof = more(buf)
+			continue
+		if buf[pos] == ']':
+			return
+
+		try:
+			item, end = _decoder.raw_decode(buf, pos)
+		except ValueError: # item not complete yet
+			if eof:
+				raise
+			buf, pos = buf[pos:], 0
+			buf, eof = more(buf)
+			continue
+		yield item
+		buf, pos = buf[end:], 0
+
+
+
+# Many lines at once
+#######################
+
+class RateLimiter(object):
+	'''Lets at most `rate` calls per second through, across all threads'''
+
+	def __init__(self, rate=None):
+		self.rate = rate
+		self._lock = threading.Lock()
+		self._next = time.time()
+
+	def wait(self):
+		'''Block until the next call is allowed'''
+		if not self.rate:
+			return
+		with self._lock:
+			now = time.time()
+			wait, self._next = self._next - now, max(self._next, now) + 1. / self.rate
+		if wait > 0:
+			time.sleep(wait)
+
+
+def read_lines(bus_lines):
+	'''Parse a list of lines: either comma separated (B52,M15) or @file with one line per row'''
+	if bus_lines.startswith('@'):
+		with open(bus_lines[1:]) as f:
+			bus_lines = ','.join(l.split('#')[0] for l in f)
+	return [l.strip().upper() for l in bus_lines.split(',') if l.strip()]
+
+
+def fetch_line(client, line_ref, limiter=None, retries=3, backoff=1., extract=None, stream=False, **params):
+	'''Fetch a line, retrying failed requests with exponential backoff. Only connection errors,
+	bad responses, 429 and 5xx are retried; other HTTP errors (403 bad key, 404) fail at once.
+
+	client (SiriClient): the client
+	line_ref (str): the bus line
+	limiter (RateLimiter): shared rate limit
+	retries (int): number of retries after the first attempt
+	backoff (float): seconds before the first retry. It doubles (+/- 50%) every retry.
+	extract (FieldExtractor): flatten the journeys into a DataFrame instead of keeping the response
+	stream (bool): with extract, parse the journeys one at a time off the socket
+
+	Returns a dict with the line, response or df (None if it failed), latency (seconds of
+	the successful request), attempts and error
+	'''
+	result = {'LineRef': line_ref, 'response': None, 'df': None, 'latency': None, 'attempts': 0, 'error': None}
+	for attempt in range(retries + 1):
+		if attempt:
+			time.sleep(backoff * 2**(attempt - 1) * random.uniform(0.5, 1.5))
+		if limiter is not None:
+			limiter.wait()
+		result['attempts'] += 1
+		t0 = time.time()
+		try:
+			if extract is not None:
+				result['df'] = extract.dataframe(client.journeys(line_ref, stream, **params))
+			else:
+				result['response'] = client.get(line_ref, **params)
+			result['latency'] = time.time() - t0
+			result['error'] = None
+			break
+		except (IOError, ValueError, HTTPException) as e:
+			result['error'] = '{}: {}'.format(type(e).__name__, e)
+			if isinstance(e, SiriError) and not e.retryable:
+				break
+	return result
+
+
+def fetch_lines(client, lines, workers=8, rate=None, retries=3, backoff=1., extract=None, stream=False,
+		pool=None, limiter=None, **params):
+	'''Fetch many lines concurrently. See fetch_line(...) for the other arguments.
+
+	lines (list): the bus lines
+	workers (int): number of threads
+	rate (float): max requests per second across all threads (default: no limit)
+	pool (ThreadPool): threads to reuse across calls, so their connections stay open (default: a new
+		pool, whose connections are closed when it's done)
+	limiter (RateLimiter): rate limit to share across calls (default: a new one with `rate`)
+
+	Returns the list of fetch_line results, in the order of lines
+	'''
+	limiter = limiter or RateLimiter(rate)
+	own_pool = pool is None
+	if own_pool:
+		pool = ThreadPool(max(1, min(workers, len(lines))))
+	opened = {} # the connection of each thread of our own pool
+
+	def fetch(line):
+		try:
+			return fetch_line(client, line, limiter, retries, backoff, extract, stream, **params)
+		finally:
+			if own_pool:
+				opened[threading.current_thread()] = getattr(client._local, 'conn', None)
+
+	try:
+		return pool.map(fetch, lines)
+	finally:
+		if own_pool:
+			pool.close()
+			pool.join()
+			for conn in opened.values():
+				if conn is not None:
+					conn.close()
+
+
+def print_latency_report(results):
+	'''Print the latency, attempts and errors of each line'''
+	print('{:<10} {:>10} {:>9}  {}'.format('LineRef', 'latency', 'attempts', 'error'))
+	for r in results:
+		latency = '{:.3f}s'.format(r['latency']) if r['latency'] is not None else '-'
+		print('{:<10} {:>10} {:>9}  {}'.format(r['LineRef'], latency, r['attempts'], r['error'] or ''))
+
+
+
+if __name__ == '__main__':
+	# peak memory of parsing a big response whole vs streaming it
+	import io
+	import tracemalloc
+	from siri_fields import synthetic_response, FieldExtractor
+
+	n_vehicles, n_calls = [int(a) for a in sys.argv[1:3]] or [5000, 20]
+	payload = json.dumps(synthetic_response(n_vehicles, n_calls)).encode('utf-8')
+	extract = FieldExtractor()
+	print('{} vehicles, {} onward calls each: {:.1f}MB response'.format(n_vehicles, n_calls, len(payload) / 1e6))
+
+	for name, parse in [
+			('json.loads', lambda fp: [a['MonitoredVehicleJourney'] for a in vehicle_activity(json.loads(fp.read().decode('utf-8')))]),
+			('stream', lambda fp: (a['MonitoredVehicleJourney'] for a in iter_vehicle_activity(fp)))]:
+		fp = io.BytesIO(payload) # the socket
+		tracemalloc.start()
+		t0 = time.time()
+		df = extract.dataframe(parse(fp))
+		elapsed = time.time() - t0
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print('{:<12} {:.3f}s  peak {:.1f}MB  {} rows'.format(name, elapsed, peak / 1e6, len(df)))
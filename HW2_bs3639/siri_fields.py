@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Flattening of SIRI MonitoredVehicleJourney payloads into DataFrames.
+
+The fields to extract are declared once as dotted paths into a journey (integers
+index lists), and compiled into a single python function that pulls a whole row
+with plain indexing. Missing values fall back to a default instead of raising.
+
+extract = FieldExtractor(odict([
+	('Latitude', 'VehicleLocation.Latitude'),
+	('Stop Name', 'MonitoredCall.StopPointName.0'),
+]))
+df = extract.dataframe(journeys)
+
+With VehicleMonitoringDetailLevel=calls, explode gives one row per onward call
+instead of one per bus, with call_fields relative to each call:
+
+extract = FieldExtractor(BUS_FIELDS, explode='OnwardCalls.OnwardCall', call_fields=CALL_FIELDS)
+"""
+from __future__ import print_function
+import os
+import sys
+import random
+from collections import OrderedDict as odict
+import pandas as pd
+
+
+# Used to fill in any missing values
+_NA_ = 'N/A'
+
+BUS_FIELDS = odict([
+	('Latitude', 'VehicleLocation.Latitude'),
+	('Longitude', 'VehicleLocation.Longitude'),
+	('Stop Name', 'MonitoredCall.StopPointName.0'),
+	('Stop Status', 'MonitoredCall.ArrivalProximityText'),
+])
+
+CALL_FIELDS = odict([
+	('Onward Stop Name', 'StopPointName.0'),
+	('Onward Stop Status', 'ArrivalProximityText'),
+	('Onward Expected Arrival', 'ExpectedArrivalTime'),
+])
+
+
+def parse_path(path):
+	'''Split a dotted path into keys, with integers as list indices'''
+	if not isinstance(path, str):
+		return list(path)
+	return [int(k) if k.lstrip('-').isdigit() else k for k in path.split('.')]
+
+
+def _lookup(var, path):
+	'''Source of the indexing expression of a path'''
+	return var + ''.join('[{!r}]'.format(k) for k in parse_path(path))
+
+
+def compile_row(paths, name='row'):
+	'''Compile a list of paths into a function returning a tuple of their values.
+	Every value is looked up with plain indexing in its own try block.
+	'''
+	lines = ['def {}(data, default):'.format(name)]
+	for i, path in enumerate(paths):
+		lines += [
+			'\ttry: v{} = {}'.format(i, _lookup('data', path)),
+			'\texcept (KeyError, IndexError, TypeError): v{} = default'.format(i),
+		]
+	lines.append('\treturn ({}{})'.format(', '.join('v{}'.format(i) for i in range(len(paths))), ',' if paths else ''))
+	namespace = {}
+	exec('\n'.join(lines), namespace)
+	return namespace[name]
+
+
+class FieldExtractor(object):
+
+	def __init__(self, fields=BUS_FIELDS, explode=None, call_fields=CALL_FIELDS, default=_NA_):
+		'''
+		fields (odict): column name -> path into a MonitoredVehicleJourney
+		explode (str): path of a list in the journey to make one row per item of, e.g. 'OnwardCalls.OnwardCall'
+		call_fields (odict): column name -> path into each item of the exploded list
+		default (any): value of missing fields
+		'''
+		self.fields = odict(fields)
+		self.explode = explode
+		self.call_fields = odict(call_fields) if explode else odict()
+		self.default = default
+
+		self._row = compile_row(list(self.fields.values()))
+		if explode:
+			self._calls = compile_row([explode], 'calls')
+			self._call_row = compile_row(list(self.call_fields.values()), 'call_row')
+
+	@property
+	def columns(self):
+		return list(self.fields) + (['Call'] + list(self.call_fields) if self.explode else [])
+
+	def rows(self, journeys):
+		'''The tuple of values of each row'''
+		row, default = self._row, self.default
+		if not self.explode:
+			return [row(j, default) for j in journeys]
+
+		calls, call_row = self._calls, self._call_row
+		missing = (default,) * len(self.call_fields)
+		rows = []
+		for j in journeys:
+			values = row(j, default)
+			items = calls(j, None)[0]
+			if not items:
+				rows.append(values + (default,) + missing)
+				continue
+			for i, call in enumerate(items):
+				rows.append(values + (i,) + call_row(call, default))
+		return rows
+
+	def dataframe(self, journeys):
+		'''Flatten journeys into a DataFrame'''
+		return pd.DataFrame.from_records(self.rows(journeys), columns=self.columns)
+
+	__call__ = dataframe
+
+
+
+# Synthetic payloads and benchmark
+###################################
+
+def synthetic_response(n_vehicles=5000, n_calls=0, seed=0):
+	'''A SIRI vehicle-monitoring response shaped like a real one, with n_vehicles buses
+	and n_calls onward calls each (as with VehicleMonitoringDetailLevel=calls)'''
+	rnd = random.Random(seed)
+
+	def call(line, k):
+		return {
+			'StopPointRef': 'MTA_{}'.format(300000 + k),
+			'StopPointName': ['{} AV/{} ST'.format(line, k)],
+			'ExpectedArrivalTime': '2017-09-20T10:{:02d}:00.000-04:00'.format(k % 60),
+			'ArrivalProximityText': '{} stops away'.format(k),
+			'DistanceFromStop': rnd.randint(0, 5000),
+			'Extensions': {'Distances': {'PresentableDistance': '{} stops away'.format(k), 'StopsFromCall': k}},
+		}
+
+	activity = []
+	for i in range(n_vehicles):
+		line = 'B{}'.format(i % 300)
+		calls = [call(line, k) for k in range(n_calls)]
+		journey = {
+			'LineRef': 'MTA NYCT_' + line,
+			'DirectionRef': str(i % 2),
+			'PublishedLineName': [line],
+			'OperatorRef': 'MTA NYCT',
+			'DestinationName': ['{} TERMINAL'.format(line)],
+			'VehicleRef': 'MTA NYCT_{}'.format(4000 + i),
+			'Bearing': rnd.uniform(0, 360),
+			'ProgressRate': 'normalProgress',
+			'VehicleLocation': {'Latitude': rnd.uniform(40.5, 40.9), 'Longitude': rnd.uniform(-74.2, -73.7)},
+		}
+		if i % 10: # some buses are between trips and have no calls
+			journey['MonitoredCall'] = calls[0] if calls else call(line, 0)
+			if calls:
+				journey['OnwardCalls'] = {'OnwardCall': calls}
+		activity.append({
+			'RecordedAtTime': '2017-09-20T10:00:{:02d}.000-04:00'.format(i % 60),
+			'MonitoredVehicleJourney': journey,
+		})
+
+	return {'Siri': {'ServiceDelivery': {
+		'ResponseTimestamp': '2017-09-20T10:00:30.000-04:00',
+		'VehicleMonitoringDelivery': [{'VehicleActivity': activity}],
+	}}}
+
+
+def benchmark(n_vehicles=5000, n_calls=20, repeat=3):
+	'''Times the compiled extractor against the try_to_get row building of get_bus_info'''
+	from get_bus_info_bs3639 import try_to_get
+
+	journeys = [a['MonitoredVehicleJourney'] for a in
+		synthetic_response(n_vehicles, n_calls)['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'][0]['VehicleActivity']]
+
+	def try_to_get_rows():
+		return pd.DataFrame([
+			[
+				try_to_get(j, ['VehicleLocation', 'Latitude']),
+				try_to_get(j, ['VehicleLocation', 'Longitude']),
+				try_to_get(j, ['MonitoredCall', 'StopPointName', 0]),
+				try_to_get(j, ['MonitoredCall', 'ArrivalProximityText']),
+			]
+			for j in journeys
+		], columns=list(BUS_FIELDS))
+
+	def try_to_get_calls():
+		return pd.DataFrame([
+			[
+				try_to_get(j, ['VehicleLocation', 'Latitude']),
+				try_to_get(j, ['VehicleLocation', 'Longitude']),
+				try_to_get(j, ['MonitoredCall', 'StopPointName', 0]),
+				try_to_get(j, ['MonitoredCall', 'ArrivalProximityText']),
+				i,
+				try_to_get(c, ['StopPointName', 0]),
+				try_to_get(c, ['ArrivalProximityText']),
+				try_to_get(c, ['ExpectedArrivalTime']),
+			]
+			for j in journeys
+			for i, c in enumerate(try_to_get(j, ['OnwardCalls', 'OnwardCall'], []))
+		])
+
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+	import timing
+	best = lambda func: timing.best(func, repeat)
+
+	print('{} vehicles, {} onward calls each'.format(n_vehicles, n_calls))
+	print('one row per bus:')
+	print('  try_to_get:         {:.4f}s'.format(best(try_to_get_rows)))
+	print('  FieldExtractor:     {:.4f}s'.format(best(lambda: FieldExtractor()(journeys))))
+	print('one row per onward call:')
+	print('  try_to_get:         {:.4f}s'.format(best(try_to_get_calls)))
+	extract = FieldExtractor(explode='OnwardCalls.OnwardCall')
+	print('  FieldExtractor:     {:.4f}s'.format(best(lambda: extract(journeys))))
+	with_calls = [j for j in journeys if 'OnwardCalls' in j] # json_normalize can't skip missing records
+	print('  pd.json_normalize:  {:.4f}s'.format(best(lambda: pd.json_normalize(
+		with_calls, record_path=['OnwardCalls', 'OnwardCall'], meta=['VehicleRef']))))
+
+
+if __name__ == '__main__':
+	benchmark(*[int(a) for a in sys.argv[1:3]])
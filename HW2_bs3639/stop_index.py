@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Nearest bus stop of arrays of positions, for when SIRI leaves out the MonitoredCall.
+
+Stops come from the stops.txt of the MTA GTFS feeds (http://web.mta.info/developers/developer-data-terms.html),
+either the file itself or the feed zip. Positions are projected to meters around the
+center of the stops and indexed in a scipy KD tree (or a grid of `cell` meter squares
+without scipy). The stop arrays are cached next to stops.txt as <stops.txt>.npz and
+reloaded as long as stops.txt doesn't change.
+
+index = StopIndex.from_gtfs('google_transit_brooklyn.zip')
+i, dist = index.query(df.Latitude, df.Longitude, max_distance=100)
+index.names[i[i >= 0]]
+
+df = fill_stop_names(df, index) # only fills the 'N/A' stop names
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None # falls back on a grid
+
+
+EARTH_RADIUS = 6371008.8 # meters
+
+
+def _floats(values):
+	'''Float array of values, with NaN for anything that isn't a number (like 'N/A')'''
+	try:
+		return np.asarray(values, dtype=float).ravel()
+	except (ValueError, TypeError):
+		return pd.to_numeric(pd.Series(np.asarray(values).ravel()), errors='coerce').values.astype(float)
+
+
+class StopIndex(object):
+
+	def __init__(self, stop_ids, names, lats, lons, cell=250.):
+		'''
+		stop_ids (array): id of each stop
+		names (array): name of each stop
+		lats, lons (array): coordinates of each stop, in degrees
+		cell (float): size of the grid cells in meters, when scipy isn't there
+		'''
+		self.stop_ids = np.asarray(stop_ids)
+		self.names = np.asarray(names)
+		self.lats = np.asarray(lats, dtype=float)
+		self.lons = np.asarray(lons, dtype=float)
+		self.cell = float(cell)
+
+		self._lat0 = np.radians(self.lats.mean()) if len(self.lats) else 0.
+		self._xy = self.project(self.lats, self.lons)
+		if cKDTree is not None:
+			self._tree = cKDTree(self._xy)
+		else:
+			self._tree = None
+			self._build_grid()
+
+	def __len__(self):
+		return len(self.stop_ids)
+
+	def project(self, lats, lons):
+		'''(n, 2) array of meters east/north, equirectangular around the stops (good to a few cm over a city)'''
+		lats = np.radians(np.asarray(lats, dtype=float))
+		lons = np.radians(np.asarray(lons, dtype=float))
+		return np.column_stack([lons * np.cos(self._lat0), lats]) * EARTH_RADIUS
+
+
+	# Grid fallback
+	##################
+
+	def _cells(self, xy):
+		return np.floor(xy / self.cell).astype(np.int64)
+
+	def _key(self, cx, cy):
+		return cx * (1 << 32) + cy
+
+	def _build_grid(self):
+		'''Stops sorted by cell, and the sorted cell keys to binary search'''
+		c = self._cells(self._xy)
+		keys = self._key(c[:, 0], c[:, 1])
+		self._order = np.argsort(keys, kind='stable')
+		self._keys = keys[self._order]
+
+	def _scan(self, xy, c, rows, dx, dy, best, best_i):
+		'''Compare the points of rows with the stops of the cells dx, dy away from theirs'''
+		k = self._key(c[rows, 0] + dx, c[rows, 1] + dy)
+		start = np.searchsorted(self._keys, k, 'left')
+		end = np.searchsorted(self._keys, k, 'right')
+		# walk the stops of every cell at once, the j-th stop of each cell per step
+		for j in range(int((end - start).max()) if len(rows) else 0):
+			has = start + j < end
+			i = self._order[np.minimum(start + j, len(self._order) - 1)]
+			d = np.hypot(*(xy[rows] - self._xy[i]).T)
+			better = has & (d < best[rows])
+			best[rows[better]], best_i[rows[better]] = d[better], i[better]
+
+	def _query_grid(self, xy):
+		'''Nearest stop, searching rings of cells around each point: once the rings out to r cells
+		away are done, any stop closer than r cells has been seen.'''
+		n = len(xy)
+		best = np.full(n, np.inf)
+		best_i = np.full(n, -1, dtype=np.int64)
+		c = self._cells(xy)
+		span = np.ptp(self._cells(self._xy), axis=0).max() + 1
+		rows, r = np.arange(n), 0
+		while len(rows) and r <= span:
+			for dx in range(-r, r + 1):
+				for dy in ([-r, r] if abs(dx) < r else range(-r, r + 1)):
+					self._scan(xy, c, rows, dx, dy, best, best_i)
+			rows = rows[best[rows] > r * self.cell]
+			r += 1
+
+		# points far out of the grid are compared with all the stops
+		for chunk in np.array_split(rows, max(1, len(rows) * len(self) // 10**7)):
+			if len(chunk):
+				d = np.hypot(*(xy[chunk, None, :] - self._xy[None, :, :]).transpose(2, 0, 1))
+				best_i[chunk] = d.argmin(axis=1)
+				best[chunk] = d[np.arange(len(chunk)), best_i[chunk]]
+		return best, best_i
+
+
+	# Queries
+	##################
+
+	def query(self, lats, lons, max_distance=None):
+		'''Nearest stop of each position
+
+		lats, lons (array): positions in degrees. NaN (or 'N/A') positions get no stop
+		max_distance (float): positions farther than this many meters from any stop get no stop
+		Returns (indices, distances): the index of the stop (-1 for no stop) and its distance in meters
+		'''
+		lats, lons = _floats(lats), _floats(lons)
+		idx = np.full(len(lats), -1, dtype=np.int64)
+		dist = np.full(len(lats), np.inf)
+		valid = ~(np.isnan(lats) | np.isnan(lons))
+		if not len(self) or not valid.any():
+			return idx, dist
+
+		xy = self.project(lats[valid], lons[valid])
+		if self._tree is not None:
+			d, i = self._tree.query(xy, distance_upper_bound=np.inf if max_distance is None else max_distance)
+			i[np.isinf(d)] = -1
+		else:
+			d, i = self._query_grid(xy)
+			if max_distance is not None:
+				i[d > max_distance], d[d > max_distance] = -1, np.inf
+		idx[valid], dist[valid] = i, d
+		return idx, dist
+
+	def nearest_names(self, lats, lons, max_distance=None, default='N/A'):
+		'''Name of the nearest stop of each position (default for no stop)'''
+		i, _ = self.query(lats, lons, max_distance)
+		return np.where(i >= 0, self.names[np.maximum(i, 0)] if len(self) else default, default)
+
+
+	# Loading
+	##################
+
+	@classmethod
+	def read_stops(cls, path):
+		'''The stops DataFrame of a GTFS stops.txt or feed zip'''
+		if zipfile.is_zipfile(path):
+			with zipfile.ZipFile(path) as z:
+				with z.open('stops.txt') as f:
+					return pd.read_csv(f, dtype={'stop_id': str})
+		return pd.read_csv(path, dtype={'stop_id': str})
+
+	@classmethod
+	def from_gtfs(cls, path, cache=True, **kw):
+		'''Load the stops of a GTFS stops.txt or feed zip, from the npz cache if it is up to date
+
+		path (str): stops.txt or the GTFS zip
+		cache (bool/str): cache file (default: <path>.npz), or False to always parse the csv
+		**kw: passed to StopIndex
+		'''
+		cache_path = cache if isinstance(cache, str) else path + '.npz'
+		if cache and os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+			with np.load(cache_path, allow_pickle=False) as z:
+				return cls(z['stop_ids'], z['names'], z['lats'], z['lons'], **kw)
+
+		stops = cls.read_stops(path)
+		if 'location_type' in stops.columns: # stations and entrances aren't stops
+			stops = stops[stops.location_type.fillna(0).astype(int) == 0]
+		stop_ids = np.asarray(stops.stop_id, dtype=str)
+		names = np.asarray(stops.stop_name, dtype=str)
+		lats, lons = stops.stop_lat.values.astype(float), stops.stop_lon.values.astype(float)
+		if cache:
+			np.savez(cache_path, stop_ids=stop_ids, names=names, lats=lats, lons=lons)
+			if not cache_path.endswith('.npz') and os.path.isfile(cache_path + '.npz'):
+				os.rename(cache_path + '.npz', cache_path) # np.savez appends .npz
+		return cls(stop_ids, names, lats, lons, **kw)
+
+
+def fill_stop_names(df, index, column='Stop Name', max_distance=200., missing='N/A'):
+	'''Fill the missing stop names of a bus DataFrame with the nearest stop to the bus
+
+	df (pd.DataFrame): with Latitude and Longitude columns
+	index (StopIndex): the stops
+	column (str): the stop name column
+	max_distance (float): buses farther than this many meters from any stop keep the missing value
+	missing (str): value of a missing stop name
+	'''
+	df = df.copy()
+	todo = (df[column] == missing).values | df[column].isnull().values if column in df.columns else np.ones(len(df), bool)
+	names = index.nearest_names(df.Latitude.values[todo], df.Longitude.values[todo], max_distance, missing)
+	if column not in df.columns:
+		df[column] = missing
+	df.loc[todo, column] = names
+	return df
+
+
+if __name__ == '__main__':
+	# stops.txt (or a GTFS zip) as argument, or 16000 stops spread over NYC
+	if len(sys.argv) > 1:
+		index = StopIndex.from_gtfs(sys.argv[1])
+	else:
+		rnd = np.random.RandomState(0)
+		n = 16000
+		index = StopIndex(np.arange(n).astype(str), ['stop {}'.format(i) for i in range(n)],
+			rnd.uniform(40.5, 40.9, n), rnd.uniform(-74.2, -73.7, n))
+
+	rnd = np.random.RandomState(1)
+	lats = rnd.uniform(index.lats.min(), index.lats.max(), 100000)
+	lons = rnd.uniform(index.lons.min(), index.lons.max(), 100000)
+	for name, tree in [('cKDTree', index._tree), ('grid', None)]:
+		if name == 'cKDTree' and tree is None:
+			continue
+		index._tree = tree
+		if tree is None:
+			index._build_grid()
+		for n in (1000, 100000):
+			times = []
+			for _ in range(5):
+				t0 = time.time()
+				index.query(lats[:n], lons[:n])
+				times.append(time.time() - t0)
+			print('{:<8} {} stops, {:>6} points: {:.3f}ms per 1000 points'.format(
+				name, len(index), n, min(times) * 1000 * 1000 / n))
@@ -0,0 +1,68 @@
+'''
+Tests of the bus snapshot stores
+
+python -m pytest test_bus_store.py  (or python test_bus_store.py)
+'''
+from __future__ import print_function
+import shutil
+import tempfile
+import threading
+import unittest
+
+from bus_store import ParquetStore, pa
+from get_bus_info_bs3639 import poll, build_dataframe
+
+
+class FakeClient(object):
+	'''Answers the polls with the given lists of journeys, one list per poll'''
+	def __init__(self, polls):
+		self.polls = list(polls)
+		self._local = threading.local()
+
+	def journeys(self, line_ref=None, stream=False, **params):
+		return self.polls.pop(0)
+
+
+def journey(i, location=True):
+	j = {'VehicleRef': 'MTA NYCT_{}'.format(4000 + i),
+		'MonitoredCall': {'StopPointName': ['AV J/E 16 ST'], 'ArrivalProximityText': 'at stop'}}
+	if location:
+		j['VehicleLocation'] = {'Latitude': 40.6 + i * 0.01, 'Longitude': -73.9}
+	return j
+
+
+@unittest.skipIf(pa is None, 'needs pyarrow')
+class TestParquetStore(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_empty_poll(self):
+		'''An empty poll and a poll without locations don't break reading or compacting the line'''
+		store = ParquetStore(self.directory, compact_every=3)
+		client = FakeClient([
+			[journey(0), journey(1)],
+			[], # no buses on the line
+			[journey(0, location=False)], # Latitude and Longitude are all N/A
+			[journey(1)],
+		])
+		poll(client, ['B52'], store, interval=0, jitter=0, count=4)
+
+		df = store.read('B52')
+		self.assertEqual(len(df), 4)
+		self.assertEqual(str(df['Latitude'].dtype), 'float64')
+		self.assertEqual(df['Latitude'].isnull().sum(), 1)
+		store.compact()
+		self.assertEqual(len(store.read('B52')), 4)
+
+	def test_empty_snapshot_is_not_written(self):
+		store = ParquetStore(self.directory)
+		self.assertIsNone(store.append(build_dataframe([]), 'B52'))
+		self.assertEqual(store.files('B52'), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
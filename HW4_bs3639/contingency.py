@@ -0,0 +1,174 @@
+'''
+Contingency tables of two categorical variables, counted a chunk of rows at a time
+so files larger than memory can be tested with evalChisq.
+
+    table = ContingencyTable.from_csv('201701-citibike-tripdata.csv', 'gender', weekend)
+    table = from_csvs(monthly_paths, 'gender', weekend, processes=4) # one process per file
+    table.chisq()
+'''
+from __future__ import print_function, division
+import numpy as np
+import pandas as pd
+from itertools import islice
+
+from evalChisq import evalChisq, evalChisq_batch
+
+
+class ContingencyTable(object):
+    '''Integer counts of two categorical variables, accumulated chunk by chunk
+    so a month of trips never has to be in memory at once.
+
+    Memory only depends on the number of categories, not on the number of rows.
+    Partial tables (e.g. one per worker or per file) add up with `merge` or `+`.
+
+    Usage:
+    table = ContingencyTable('gender', weekend)
+    for chunk in pd.read_csv('201701-citibike-tripdata.csv', chunksize=100000):
+        table.update(chunk)
+    table.chisq()
+    '''
+
+    def __init__(self, row, col, rows=None, cols=None):
+        '''
+        Arguments:
+            row, col: the two variables. A column name, or a function taking a chunk
+                (DataFrame) and returning one value per row (e.g. weekday vs weekend)
+            rows, cols (list, optional): the categories, if known up front. Otherwise they
+                are added as they are found, in order of appearance
+        '''
+        self.row, self.col = row, col
+        self.rows, self.cols = list(rows or []), list(cols or [])
+        self.counts = np.zeros((len(self.rows), len(self.cols)), dtype=np.int64)
+
+    def _codes(self, values, levels):
+        '''Category positions of the values, adding new categories to levels'''
+        known = set(levels)
+        levels.extend(v for v in pd.unique(values) if v not in known)
+        return pd.Index(levels).get_indexer(values)
+
+    def _values(self, chunk, var):
+        return var(chunk) if callable(var) else chunk[var]
+
+    def update(self, chunk):
+        '''Add the counts of a DataFrame chunk
+        Returns self (chainable)
+        '''
+        return self._update(np.asarray(self._values(chunk, self.row)),
+                            np.asarray(self._values(chunk, self.col)))
+
+    def update_rows(self, pairs, batch=100000):
+        '''Add the counts of an iterable of (row, col) value pairs, e.g. from csv.reader,
+        batch pairs at a time
+        Returns self (chainable)
+        '''
+        pairs = iter(pairs)
+        while True:
+            block = list(islice(pairs, batch))
+            if not block:
+                return self
+            rows, cols = zip(*block)
+            self._update(np.array(rows, dtype=object), np.array(cols, dtype=object))
+
+    def _update(self, rows, cols):
+        '''Count the pairs where neither value is missing'''
+        keep = ~(pd.isnull(rows) | pd.isnull(cols))
+        return self.update_codes(self._codes(rows[keep], self.rows),
+                                 self._codes(cols[keep], self.cols))
+
+    def update_codes(self, r, c):
+        '''Add counts from arrays of category positions'''
+        self._grow()
+        nr, nc = self.counts.shape
+        self.counts += np.bincount(r * nc + c, minlength=nr * nc).reshape(nr, nc)
+        return self
+
+    def _grow(self):
+        '''Pad the counts with zeros for newly found categories'''
+        nr, nc = len(self.rows), len(self.cols)
+        if self.counts.shape != (nr, nc):
+            counts = np.zeros((nr, nc), dtype=np.int64)
+            counts[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+            self.counts = counts
+
+
+    # Merging partial tables
+
+    def merge(self, other):
+        '''Add the counts of another table, aligning their categories
+        Returns self (chainable)
+        '''
+        r = self._codes(np.array(other.rows, dtype=object), self.rows)
+        c = self._codes(np.array(other.cols, dtype=object), self.cols)
+        self._grow()
+        np.add.at(self.counts, (r[:, None], c[None, :]), other.counts)
+        return self
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def copy(self):
+        table = ContingencyTable(self.row, self.col, self.rows, self.cols)
+        table.counts = self.counts.copy()
+        return table
+
+
+    # Results
+
+    @property
+    def table(self):
+        '''The counts as a DataFrame'''
+        return pd.DataFrame(self.counts, index=self.rows, columns=self.cols)
+
+    def chisq(self):
+        '''Chi sq of the table. evalChisq for 2x2 tables, evalChisq_batch otherwise'''
+        if self.counts.shape == (2, 2):
+            return evalChisq(self.counts.astype(float))
+        return evalChisq_batch(self.counts)[0][0]
+
+    def __repr__(self):
+        return '<ContingencyTable {} x {}, {} counts>\n{}'.format(
+            self.row, self.col, self.counts.sum(), self.table)
+
+
+    # Loading
+
+    @classmethod
+    def from_csv(cls, path, row, col, chunksize=100000, **kw):
+        '''Accumulate a table from a csv, chunksize rows at a time
+        Arguments:
+            path (str): path or url of the csv
+            row, col: see __init__
+            chunksize (int): rows per chunk
+            **kw: passed to pd.read_csv (e.g. usecols, parse_dates)
+        '''
+        table = cls(row, col)
+        for chunk in pd.read_csv(path, chunksize=chunksize, **kw):
+            table.update(chunk)
+        return table
+
+
+def _table_from_csv(args):
+    path, row, col, kw = args
+    return ContingencyTable.from_csv(path, row, col, **kw)
+
+
+def from_csvs(paths, row, col, processes=None, **kw):
+    '''Accumulate one table per csv in a pool of processes and merge them.
+    row and col must be picklable (a column name or a module level function)
+    Arguments:
+        paths (list): csv paths or urls (e.g. one per month)
+        row, col: see ContingencyTable
+        processes (int): number of worker processes (default: one per cpu)
+        **kw: passed to ContingencyTable.from_csv
+    '''
+    from multiprocessing import Pool
+
+    pool = Pool(processes)
+    try:
+        tables = pool.map(_table_from_csv, [(path, row, col, kw) for path in paths])
+    finally:
+        pool.close()
+    table = ContingencyTable(row, col)
+    for t in tables:
+        table.merge(t)
+    return table
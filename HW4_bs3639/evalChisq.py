@@ -19,3 +19,58 @@ def evalChisq(values):
                         (values).sum())
     return ((values - E)**2 / E).sum()
 
+
+
+def evalChisq_batch(tables):
+    '''Evaluates the chi sq of many contingency tables at once
+    Arguments:
+    tables: (N, r, c) array or list, N contingency tables of the same shape
+            (a single (r, c) table is also accepted)
+    Returns the chi sq statistics (N array), the degrees of freedom and the p-values (N array)
+    '''
+    from scipy.stats import chi2
+
+    values = np.asarray(tables, dtype=float)
+    if values.ndim == 2:
+        values = values[np.newaxis]
+    if values.ndim != 3:
+        raise ValueError("must pass an (N, r, c) array of contingency tables")
+
+    # expected counts: outer product of the margins over the total
+    rows = values.sum(axis=2)
+    cols = values.sum(axis=1)
+    total = rows.sum(axis=1)
+    E = rows[:, :, np.newaxis] * cols[:, np.newaxis, :] / total[:, np.newaxis, np.newaxis]
+
+    # cells with no expected counts (empty row/column) don't contribute
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chisq = np.where(E > 0, (values - E)**2 / E, 0).sum(axis=(1, 2))
+    dof = (values.shape[1] - 1) * (values.shape[2] - 1)
+    return chisq, dof, chi2.sf(chisq, dof)
+
+
+def benchmark(N=2000, shape=(2, 2), repeat=3):
+    '''Times evalChisq_batch against looping over evalChisq and scipy.stats.chi2_contingency
+    on N random tables'''
+    import os
+    import sys
+    from scipy.stats import chi2_contingency
+
+    tables = np.random.RandomState(0).randint(5, 500, size=(N,) + shape)
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+    import timing
+    best = lambda func: timing.best(func, repeat)
+
+    print ("%d tables of shape %s" % (N, shape))
+    print ("evalChisq_batch:   %.4fs" % best(lambda: evalChisq_batch(tables)))
+    if shape == (2, 2):
+        print ("evalChisq loop:    %.4fs" % best(lambda: [evalChisq(t.astype(float)) for t in tables]))
+    print ("chi2_contingency:  %.4fs" % best(lambda: [chi2_contingency(t, correction=False) for t in tables]))
+
+
+if __name__ == '__main__':
+    import sys
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    benchmark(N)
+    benchmark(N, shape=(4, 7))
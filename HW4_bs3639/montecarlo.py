@@ -0,0 +1,142 @@
+'''
+Monte-Carlo p-values for the chi sq of a contingency table, for when the chi sq
+assumptions fail (small expected counts).
+
+Resampled tables are generated `batch` at a time as one (batch, r, c) array and
+scored with evalChisq_batch. Every batch has its own RNG stream spawned from the
+seed, so the result only depends on the seed and the batch size, not on how many
+processes ran it.
+
+    result = chisq_test(table, n_resamples=100000, seed=42, processes=4, tol=0.001)
+    result.pvalue, result.ci
+'''
+from __future__ import print_function, division
+from collections import namedtuple
+import numpy as np
+
+from evalChisq import evalChisq_batch
+
+
+MonteCarloResult = namedtuple('MonteCarloResult', ['statistic', 'pvalue', 'ci', 'n_resamples'])
+
+# max number of labels held at once by a permutation batch
+_MAX_LABELS = 10**7
+
+
+def _labels(table):
+    '''Row and column label of every observation of a table'''
+    nr, nc = table.shape
+    cells = np.repeat(np.arange(nr * nc), table.ravel())
+    return cells // nc, cells % nc
+
+
+def permuted_tables(table, size, rng):
+    '''Tables with the same margins, shuffling which column each observation falls in
+    (independence, conditional on both margins)
+    Arguments:
+        table (array): r x c contingency table of integer counts
+        size (int): number of tables
+        rng (np.random.Generator): random stream
+    Returns a (size, r, c) array
+    '''
+    nr, nc = table.shape
+    rows, cols = _labels(table)
+    cols = rng.permuted(np.tile(cols, (size, 1)), axis=1)
+    flat = (np.arange(size)[:, None] * nr + rows) * nc + cols
+    return np.bincount(flat.ravel(), minlength=size * nr * nc).reshape(size, nr, nc)
+
+
+def bootstrap_tables(table, size, rng):
+    '''Tables of the same total drawn from the product of the margins
+    (independence, parametric bootstrap)
+    Arguments: see permuted_tables
+    Returns a (size, r, c) array
+    '''
+    n = table.sum()
+    p = np.outer(table.sum(axis=1), table.sum(axis=0)).ravel() / n**2
+    return rng.multinomial(n, p, size=size).reshape((size,) + table.shape)
+
+
+METHODS = {
+    'permutation': permuted_tables,
+    'bootstrap': bootstrap_tables,
+}
+
+
+def _count_batch(args):
+    '''Number of resampled tables of a batch at least as extreme as the observed statistic'''
+    method, table, size, seed, statistic = args
+    rng = np.random.default_rng(seed)
+    tables = METHODS[method](table, size, rng)
+    return (evalChisq_batch(tables)[0] >= statistic).sum()
+
+
+def _ci(k, m, alpha):
+    '''Clopper-Pearson interval of k successes out of m'''
+    from scipy.stats import beta
+    lo = beta.ppf(alpha / 2, k, m - k + 1) if k > 0 else 0.
+    hi = beta.isf(alpha / 2, k + 1, m - k) if k < m else 1.
+    return lo, hi
+
+
+def chisq_test(table, n_resamples=10000, method='permutation', batch=1000, seed=None,
+               processes=1, tol=None, alpha=0.05):
+    '''Monte-Carlo p-value of the chi sq of a contingency table
+    Arguments:
+        table (array): r x c contingency table of integer counts
+        n_resamples (int): max number of resampled tables
+        method (str): 'permutation' (fixed margins) or 'bootstrap' (fixed total)
+        batch (int): resampled tables per batch
+        seed (int): seed of the RNG streams (default: random)
+        processes (int): number of worker processes the batches are spread across
+        tol (float): stop early once the half width of the p-value confidence interval
+            is below tol (default: run all n_resamples)
+        alpha (float): the confidence interval is 1 - alpha
+    Returns a MonteCarloResult(statistic, pvalue, ci, n_resamples)
+    '''
+    table = np.asarray(table, dtype=np.int64)
+    if method not in METHODS:
+        raise ValueError('method must be one of {}'.format(sorted(METHODS)))
+    if method == 'permutation':
+        batch = max(1, min(batch, _MAX_LABELS // max(table.sum(), 1)))
+
+    statistic = evalChisq_batch(table)[0][0]
+    # don't let float round off decide ties
+    threshold = statistic - 1e-9 * max(statistic, 1)
+
+    sizes = [batch] * (n_resamples // batch) + ([n_resamples % batch] if n_resamples % batch else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(method, table, size, s, threshold) for size, s in zip(sizes, seeds)]
+
+    pool = None
+    if processes > 1:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        counts = pool.imap(_count_batch, tasks) # in order, so early stopping is reproducible
+    else:
+        counts = (_count_batch(task) for task in tasks)
+
+    k = m = 0
+    try:
+        for size, count in zip(sizes, counts):
+            k, m = k + count, m + size
+            if tol is not None:
+                lo, hi = _ci(k, m, alpha)
+                if (hi - lo) / 2 < tol:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return MonteCarloResult(statistic, (k + 1) / (m + 1), _ci(k, m, alpha), m)
+
+
+if __name__ == '__main__':
+    import time
+    table = np.array([[3, 1, 6], [2, 8, 1]])
+    for method in sorted(METHODS):
+        for processes in (1, 4):
+            t0 = time.time()
+            result = chisq_test(table, 200000, method=method, seed=0, processes=processes)
+            print (method, processes, result, '%.2fs' % (time.time() - t0))
+    print ('early stopping:', chisq_test(table, 10**7, seed=0, tol=0.001))
@@ -6,6 +6,7 @@ import pylab as pl
 import optparse
 import matplotlib as mpl
 import numpy as np
+import hashlib
 
 DEBUG = True
 DEBUG = False
@@ -24,19 +25,232 @@ def discrete_cmap(N, base_cmap=None):
     N : number of colors
     base_cmap : a pylab cmap name (string) or pylab cmap object'''
     # Note that if base_cmap is a string or None, you can simply do
-    #    return plt.cm.get_cmap(base_cmap, N)
+    #    return mpl.colormaps[base_cmap].resampled(N)
     # The following works for string, None, or a colormap instance:
 
+    try:
+        return _CMAP_CACHE[(N, base_cmap)]
+    except (KeyError, TypeError):
+        pass
+
     from matplotlib.colors import LinearSegmentedColormap
-    base = pl.cm.get_cmap(base_cmap)
+    if isinstance(base_cmap, mpl.colors.Colormap):
+        base = base_cmap
+    elif hasattr(mpl, 'colormaps'): # pl.cm.get_cmap is gone in matplotlib >= 3.9
+        base = mpl.colormaps[base_cmap or mpl.rcParams['image.cmap']]
+    else:
+        base = pl.cm.get_cmap(base_cmap)
     color_list = base(np.linspace(0, 1, N))
     cmap_name = base.name + str(N)
-    return LinearSegmentedColormap.from_list(cmap_name, color_list, N)
+    cmap = LinearSegmentedColormap.from_list(cmap_name, color_list, N)
+    try:
+        _CMAP_CACHE[(N, base_cmap)] = cmap
+    except TypeError: # unhashable cmap object
+        pass
+    return cmap
+
+_CMAP_CACHE = {}
+
+
+# classification schemes. Each returns the upper bounds of the k classes,
+# like pysal/mapclassify: class i holds breaks[i-1] < value <= breaks[i]
+
+def quantile_breaks(values, k):
+    '''Upper bounds of k classes holding the same number of values'''
+    return np.unique(np.percentile(values, np.linspace(0, 100, k + 1)[1:]))
+
+
+def equal_interval_breaks(values, k):
+    '''Upper bounds of k classes of the same width'''
+    return np.linspace(values.min(), values.max(), k + 1)[1:]
+
+
+def fisher_jenks_breaks(values, k, sample=2000, seed=0):
+    '''Upper bounds of the k classes minimizing the within class sum of squared deviations.
+    The exact dynamic program is quadratic in the number of values, so it runs on a
+    random sample of the values (the min and max are always kept)
+    Arguments:
+    values : 1D array of finite values
+    k : number of classes
+    sample : number of values to run the optimization on (int, None uses all of them)
+    seed : seed of the sampling (int)
+    '''
+    x = np.unique(values) if sample is None else values
+    if sample is not None and len(x) > sample:
+        x = np.random.RandomState(seed).choice(x, sample - 2, replace=False)
+        x = np.concatenate([x, [values.min(), values.max()]])
+    x = np.sort(x)
+    n = len(x)
+    if n <= k:
+        return np.unique(x)
+
+    # sum of squared deviations of x[i:j+1] for all i <= j, from the prefix sums
+    s1 = np.concatenate([[0], np.cumsum(x)])
+    s2 = np.concatenate([[0], np.cumsum(x ** 2)])
+    i, j = np.arange(n)[:, None], np.arange(n)[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssd = (s2[j + 1] - s2[i]) - (s1[j + 1] - s1[i]) ** 2 / (j - i + 1)
+    ssd[i > j] = np.inf
+
+    # cost[j] is the best cost of x[:j+1] in c+1 classes; start[c, j] where its last class starts
+    cost = ssd[0].copy()
+    start = np.zeros((k, n), dtype=np.int64)
+    for c in range(1, k):
+        total = cost[:-1, None] + ssd[1:] # last class starting at 1..n-1
+        start[c] = total.argmin(axis=0) + 1
+        cost = total[start[c] - 1, np.arange(n)]
+
+    breaks, j = [], n - 1
+    for c in range(k - 1, -1, -1):
+        breaks.append(x[j])
+        j = start[c, j] - 1
+    return np.unique(breaks)
+
+
+SCHEMES = {
+    'quantiles': quantile_breaks,
+    'equal_interval': equal_interval_breaks,
+    'fisher_jenks': fisher_jenks_breaks,
+}
+
+# breaks already computed, keyed by (column hash, scheme, k)
+_BREAKS_CACHE = {}
+
+def classify(values, scheme='quantiles', k=5):
+    '''Bins values with one of the built in SCHEMES. Breaks are memoized per column content and k
+    Arguments:
+    values : 1D array or Series of numbers (NaN are left unclassified)
+    scheme : 'quantiles', 'equal_interval' or 'fisher_jenks' (case insensitive)
+    k : number of classes
+    Returns the class of each value (-1 for NaN) and the upper bounds of the classes
+    '''
+    values = np.asarray(values, dtype=float)
+    scheme = scheme.lower()
+    key = (hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest(), scheme, k)
+    finite = np.isfinite(values)
+    if key not in _BREAKS_CACHE:
+        _BREAKS_CACHE[key] = SCHEMES[scheme](values[finite], k)
+    breaks = _BREAKS_CACHE[key]
+
+    classes = np.searchsorted(breaks, values, side='left')
+    classes = np.minimum(classes, len(breaks) - 1)
+    classes[~finite] = -1
+    return classes, breaks
+
+
+def benchmark_schemes(n=100000, k=10, repeat=3):
+    '''Times the built in classification schemes against mapclassify (the pysal
+    classifiers geopandas uses for df.plot(scheme=...)) on n lognormal values'''
+    values = np.random.RandomState(0).lognormal(size=n)
+    try:
+        import mapclassify
+        pysal = {'quantiles': mapclassify.Quantiles,
+                 'equal_interval': mapclassify.EqualInterval,
+                 'fisher_jenks': mapclassify.FisherJenksSampled}
+    except ImportError:
+        pysal = {}
+        print ("mapclassify can't be loaded, only timing the built in schemes")
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+    import timing
+    best = lambda func: timing.best(func, repeat)
+
+    print ('%d values, k=%d' % (n, k))
+    print ('%-16s %12s %12s %12s' % ('scheme', 'numpy (s)', 'memoized (s)', 'pysal (s)'))
+    for scheme in sorted(SCHEMES):
+        t_np = best(lambda: SCHEMES[scheme](values, k))
+        t_memo = best(lambda: classify(values, scheme, k))
+        t_ps = best(lambda: pysal[scheme](values, k=k)) if scheme in pysal else np.nan
+        print ('%-16s %12.4f %12.4f %12.4f' % (scheme, t_np, t_memo, t_ps))
+
+
+# rasterized layers, keyed by (layer, resolution). Each entry is the
+# grid of row positions into the layer plus the imshow extent
+_RASTER_CACHE = {}
+
+def _geometry_rings(geom):
+    '''Returns the (exterior, [interiors]) coordinate arrays of a Polygon or MultiPolygon'''
+    polys = geom.geoms if hasattr(geom, 'geoms') else [geom]
+    return [(np.asarray(p.exterior.coords), [np.asarray(i.coords) for i in p.interiors])
+            for p in polys if hasattr(p, 'exterior')]
+
+
+def _geometry_key(df):
+    '''Returns a digest of the geometries of a GeoDataFrame, in row order'''
+    digest = hashlib.md5()
+    for wkb in df.geometry.to_wkb().values:
+        digest.update(wkb if wkb is not None else b'')
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def rasterize(df, res=None, layer=None, npix=1000):
+    '''Burns the polygons of a GeoDataFrame into a grid of row positions, once per layer and resolution
+    Arguments:
+    df : a GeoDataFrame
+    res : pixel size in the units of the df crs (float, optional, default fits npix pixels across the layer)
+    layer : name to cache the grid under (string, optional, default is a hash of the geometries in row order.
+            A name skips hashing, and is trusted to stand for the same geometries in the same order)
+    npix : number of pixels along the long side when res is not given (int, default 1000)
+    Returns the grid (-1 where no polygon falls) and the extent for imshow
+    '''
+    from matplotlib.path import Path
+
+    xmin, ymin, xmax, ymax = df.total_bounds
+    if res is None:
+        res = max(xmax - xmin, ymax - ymin) / float(npix)
+    if layer is None:
+        layer = _geometry_key(df)
+    key = (layer, res)
+    if key in _RASTER_CACHE:
+        return _RASTER_CACHE[key]
+
+    nx = int(np.ceil((xmax - xmin) / res)) or 1
+    ny = int(np.ceil((ymax - ymin) / res)) or 1
+    grid = -np.ones((ny, nx), dtype=np.int64)
+    # pixel centers
+    xc = xmin + (np.arange(nx) + 0.5) * res
+    yc = ymin + (np.arange(ny) + 0.5) * res
+
+    for pos, geom in enumerate(df.geometry.values):
+        if geom is None or geom.is_empty:
+            continue
+        for exterior, interiors in _geometry_rings(geom):
+            # only test the pixels inside the bounding box of the ring
+            i0, i1 = np.searchsorted(xc, [exterior[:, 0].min(), exterior[:, 0].max()])
+            j0, j1 = np.searchsorted(yc, [exterior[:, 1].min(), exterior[:, 1].max()])
+            if i0 == i1 or j0 == j1:
+                continue
+            xx, yy = np.meshgrid(xc[i0:i1], yc[j0:j1])
+            pts = np.column_stack([xx.ravel(), yy.ravel()])
+            inside = Path(exterior).contains_points(pts)
+            for hole in interiors:
+                inside &= ~Path(hole).contains_points(pts)
+            block = grid[j0:j1, i0:i1]
+            block[inside.reshape(block.shape)] = pos
+
+    extent = (xmin, xmin + nx * res, ymin, ymin + ny * res)
+    _RASTER_CACHE[key] = grid, extent
+    return grid, extent
+
+
+def raster_values(df, column, grid):
+    '''Colors a rasterized layer by a column: an array lookup, no polygon is redrawn
+    Arguments:
+    df : the GeoDataFrame the grid was built from
+    column : a column name
+    grid : the grid returned by rasterize
+    Returns a masked array of the column values
+    '''
+    values = np.asarray(df[column].values, dtype=float)
+    image = values[grid]
+    return np.ma.masked_where((grid < 0) | ~np.isfinite(image), image)
 
 
 def choroplethNYC(df, column=None, cmap='viridis', ax=None,
                   cb=True, kind='continuous', alpha=1, color=None, edgecolor=None,
-                  scheme=None, k=10, spacing=False, lw=1, width=None, side=False, **kw):
+                  scheme=None, k=10, spacing=False, lw=1, width=None, side=False,
+                  res=None, layer=None, **kw):
     '''creates a choroplath from a dataframe column - NYC tuned
     Arguments:
     df : a GeoDataFrame
@@ -44,11 +258,17 @@ def choroplethNYC(df, column=None, cmap='viridis', ax=None,
     cmap : colorman name (string optional)
     ax : axis in figure object (string, optiona, is None a figure is created)
     cb : put the color bar. Bool, default is True
-    kind : 
+    scheme : classification scheme. 'quantiles', 'equal_interval' and 'fisher_jenks' are computed
+             here with numpy (memoized), any other is passed on to geopandas/pysal
+    k : number of classes of the scheme (int, default 10)
+    kind : 'continuous', 'discrete' or 'raster' (burns the polygons into a grid once and draws it with imshow,
+           for very large layers. The grid is cached, so recoloring by another column is cheap)
     spacing : the spacing for the colorbar (bool, optional)
     lw : line width (float, optional, default is 1)
     width : with width of the color bar (figure frction, float)
     side : default False is left (west), True switches to right (east). If a float is passed that is the location
+    res : raster pixel size in the units of the df crs (float, optional, only for kind='raster')
+    layer : name to cache the raster under (string, optional, only for kind='raster')
     Returns the figure and the axis, for further manipulation
     '''
     if ax == None:
@@ -58,6 +278,29 @@ def choroplethNYC(df, column=None, cmap='viridis', ax=None,
             ax = df.plot(cmap=cmap, alpha=alpha, ax=ax, linewidth=lw, **kw)
         else:
             ax = df.plot(alpha=alpha, ax=ax, linewidth=lw, color=color, edgecolor=edgecolor, **kw)
+    elif not scheme == None and scheme.lower() in SCHEMES:
+        classes, breaks = classify(df[column].values, scheme, k)
+        scmap = discrete_cmap(len(breaks), base_cmap=cmap)
+        if kind == 'raster':
+            grid, extent = rasterize(df, res=res, layer=layer)
+            image = np.ma.masked_less(np.where(grid < 0, -1, classes[grid]), 0)
+            ax.imshow(image, extent=extent, origin='lower', cmap=scmap, alpha=alpha,
+                      vmin=-0.5, vmax=len(breaks) - 0.5, interpolation='nearest', **kw)
+            ax.set_aspect('equal')
+        else:
+            valid = classes >= 0
+            ax = df[valid].plot(column=classes[valid], edgecolor=edgecolor,
+                                cmap=scmap, alpha=alpha, ax=ax, linewidth=lw,
+                                vmin=-0.5, vmax=len(breaks) - 0.5, **kw)
+
+        lower = np.concatenate([[np.nanmin(df[column].values.astype(float))], breaks[:-1]])
+        handles = [mpl.patches.Patch(color=scmap(i), label='%.2f - %.2f' % (lo, hi))
+                   for i, (lo, hi) in enumerate(zip(lower, breaks))]
+        ax.legend(handles=handles, loc=2)
+        ax.axis('off')
+        leg = ax.get_legend()
+        leg.set_bbox_to_anchor((0.35, 0.95, 0, 0))
+        return None, ax, leg
     elif not scheme == None:
         ax = df.plot(column=column, edgecolor=edgecolor,
                      cmap=cmap, alpha=alpha, ax=ax,
@@ -71,6 +314,13 @@ def choroplethNYC(df, column=None, cmap='viridis', ax=None,
 
         fig = ax.get_figure()
         return None, ax, leg                     
+    elif kind == 'raster':
+        grid, extent = rasterize(df, res=res, layer=layer)
+        image = raster_values(df, column, grid)
+        im = ax.imshow(image, extent=extent, origin='lower', cmap=cmap, alpha=alpha,
+                  interpolation='nearest', **kw)
+        ax.set_aspect('equal')
+        vmin, vmax = image.min(), image.max()
     else:
         if kind == 'continuous' and not isinstance(df[column].values[0], (int, float)):
             try:
@@ -108,6 +358,10 @@ def choroplethNYC(df, column=None, cmap='viridis', ax=None,
 
         cax = fig.add_axes([x0, 0.41, width, 0.44])
 
+        if kind == 'raster': # the image is the mappable of the colorbar
+            cb = fig.colorbar(im, cax=cax)
+            return fig, ax, cb
+
         if kind is 'discrete':
             sm = mpl.colorbar.ColorbarBase(ax=cax, cmap=cmap,
                                 norm=pl.Normalize(vmin=vmin - .5,
@@ -136,6 +390,10 @@ if __name__ == '__main__':
     parser = optparse.OptionParser(usage="choroplathNYC <path to shapefile> <column>", conflict_handler="resolve")
     parser.add_option('-d', '--discrete', default=False, action="store_true",
 	                      help='discrete steps color bar')
+    parser.add_option('-r', '--raster', default=False, action="store_true",
+	                      help='rasterize the polygons (for very large layers)')
+    parser.add_option('--res', default=None, type='float',
+	                      help='raster pixel size in the units of the shapefile crs')
     parser.add_option('-m', '--cmap', default='viridis', type='string',
 	                      help='matplotlib colormap name')
     parser.add_option('-t', '--title', default=None, type='string',
@@ -147,6 +405,12 @@ if __name__ == '__main__':
 	                      help='''clobber output file''')
     parser.add_option('--noshow', default=False, action="store_true",
 	                      help='do not show figure (default)')
+    parser.add_option('-s', '--scheme', default=None, type='string',
+	                      help='classification scheme (e.g. quantiles, equal_interval, fisher_jenks)')
+    parser.add_option('-k', default=10, type='int',
+	                      help='number of classes of the scheme')
+    parser.add_option('--benchmark', default=False, action="store_true",
+	                      help='time the built in classification schemes against pysal and exit')
     parser.add_option('--debug', default=False, action="store_true",
 	                      help='print debug statements')
 
@@ -157,6 +421,10 @@ if __name__ == '__main__':
     if DEBUG:
         print (options)
         print (args)
+
+    if options.benchmark:
+        benchmark_schemes(k=options.k)
+        sys.exit(0)
     
     if len(args) == 0:
         options, args = parser.parse_args(args=['--help'])
@@ -171,6 +439,8 @@ if __name__ == '__main__':
     kind = 'continous'
     if options.discrete:
         kind = 'discrete'
+    if options.raster:
+        kind = 'raster'
 
     if len(args)>1:
         if args[1] in gdf.columns:
@@ -182,7 +452,10 @@ if __name__ == '__main__':
             gdf.columns)
                 sys.exit()
             fig, ax, cb = choroplethNYC(gdf, args[1], cmap=options.cmap,
-                                    kind=kind)
+                                    kind=kind, res=options.res,
+                                    scheme=options.scheme, k=options.k)
+            if fig is None:
+                fig = ax.get_figure()
         else:
             print ("column", args[1], "not in file. Available columns:",
             gdf.columns)
@@ -0,0 +1,518 @@
+'''
+Benchmarks of puidata.
+
+    python bench_puidata.py startup
+    python bench_puidata.py hooks
+
+    # offline loader benchmarks: synthetic csv, zipped csv, xlsx and shapefile fixtures of each
+    # size are served from a local http server, and loaded cold (download + save to an empty
+    # cache) and warm (from the cache). One JSON line per run is appended to --out.
+    python bench_puidata.py loaders --sizes 1000,100000 --repeat 3 --out bench_puidata.jsonl
+
+    # csvLoader.read(parallel=N) against a single pd.read_csv on one big file
+    python bench_puidata.py parallel --sizes 2000000
+
+    # extracting and reading a zip of 12 monthly csvs, serially and with a pool
+    python bench_puidata.py zip --sizes 200000
+
+'''
+from __future__ import print_function
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import tempfile
+import threading
+import subprocess
+
+# try Python 3 version, fallback to Python 2 version
+try:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run_time(args, repeat=5):
+    '''Best wall time of running a command `repeat` times'''
+    times = []
+    with open(os.devnull, 'w') as null:
+        for _ in range(repeat):
+            t0 = time.time()
+            subprocess.check_call(args, stdout=null, cwd=HERE)
+            times.append(time.time() - t0)
+    return min(times)
+
+
+def benchmark_startup(repeat=5, limit=1.):
+    '''Time `python puidata.py list`, which shouldn't import pandas or geopandas,
+    next to the time it takes to import them.
+    Arguments:
+        repeat (int): runs of each command, the best one is kept
+        limit (float): max seconds `list` may take
+    Returns a dict of seconds
+    '''
+    results = {
+        'python': _run_time([sys.executable, '-c', 'pass'], repeat),
+        'puidata list': _run_time([sys.executable, 'puidata.py', 'list'], repeat),
+        'import pandas': _run_time([sys.executable, '-c', 'import pandas'], repeat),
+    }
+    try:
+        results['import geopandas'] = _run_time([sys.executable, '-c', 'import geopandas'], repeat)
+    except subprocess.CalledProcessError:
+        pass
+
+    for name, seconds in results.items():
+        print('{:<20} {:.3f}s'.format(name, seconds))
+    assert results['puidata list'] < limit, (
+        'puidata.py list took {:.2f}s (limit {:.2f}s)'.format(results['puidata list'], limit))
+    return results
+
+
+def benchmark_hooks(n=100000):
+    '''Overhead of the instrumentation of a loader stage, without and with a hook'''
+    import timeit
+    import puidata
+
+    class nullLoader(puidata.csvLoader):
+        @puidata.instrument('read')
+        def read(self, file, **kw):
+            pass
+
+    dl = nullLoader(filename='x.csv')
+    plain = min(timeit.repeat(lambda: nullLoader.read.__wrapped__(dl, None), number=n, repeat=3))
+    disabled = min(timeit.repeat(lambda: dl.read(None), number=n, repeat=3))
+    with puidata.profile():
+        enabled = min(timeit.repeat(lambda: dl.read(None), number=n, repeat=3))
+    for name, seconds in [('plain', plain), ('no hooks', disabled), ('with Stats', enabled)]:
+        print('{:<20} {:.2f}us per call'.format(name, seconds / n * 1e6))
+
+
+
+
+# Loader benchmarks
+#######################
+
+def make_table(rows, seed=0):
+    '''A DataFrame with a mix of int, float, string and date columns'''
+    import numpy as np
+    import pandas as pd
+    rnd = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'borough': rnd.choice(['Manhattan', 'Brooklyn', 'Queens', 'Bronx', 'Staten Island'], rows),
+        'count': rnd.randint(0, 1000, rows),
+        'value': rnd.rand(rows).round(6),
+        'date': pd.Timestamp('2017-01-01') + pd.to_timedelta(rnd.randint(0, 365 * 24, rows), unit='h'),
+        'latitude': rnd.uniform(40.5, 40.9, rows).round(6),
+        'longitude': rnd.uniform(-74.2, -73.7, rows).round(6),
+    })
+
+
+def make_fixtures(directory, sizes, xlsx_max=20000, shp_max=100000):
+    '''Write the fixtures of each size to directory
+    Arguments:
+        sizes (list): number of rows of each fixture
+        xlsx_max, shp_max (int): largest xlsx and shapefile fixtures (they are slow to write)
+    Returns the list of cases: dicts of name, loader, rows, file, filename, kw
+    '''
+    cases = []
+    for rows in sizes:
+        df = make_table(rows)
+        csv = 'table_{}.csv'.format(rows)
+        df.to_csv(os.path.join(directory, csv), index=False)
+        cases.append(dict(name='csv', loader='csvLoader', rows=rows, file=csv, filename=csv, kw={}))
+        cases.append(dict(name='custom', loader='customLoader', rows=rows, file=csv, filename=csv, kw={}))
+        cases.append(dict(name='custom.text', loader='customLoader', rows=rows, file=csv, filename=csv, kw={}))
+        cases.append(dict(name='custom.stream', loader='customLoader', rows=rows, file=csv, filename=csv, kw={}))
+
+        zipped = 'table_{}.zip'.format(rows)
+        with zipfile.ZipFile(os.path.join(directory, zipped), 'w', zipfile.ZIP_DEFLATED) as z:
+            z.write(os.path.join(directory, csv), csv)
+        cases.append(dict(name='csv.zip', loader='csvLoader', rows=rows, file=zipped, filename=csv, kw={'is_zip': True}))
+
+        if rows <= xlsx_max:
+            xlsx = 'table_{}.xlsx'.format(rows)
+            try:
+                df.to_excel(os.path.join(directory, xlsx), sheet_name='Sheet1', index=False)
+                cases.append(dict(name='xlsx', loader='xlsxLoader', rows=rows, file=xlsx, filename=xlsx, kw={}))
+            except ImportError as e:
+                print('No xlsx fixture:', e)
+
+        if rows <= shp_max:
+            shp = 'shapes_{}'.format(rows)
+            try:
+                import geopandas as gpd
+                gdf = gpd.GeoDataFrame(df.drop('date', axis=1),
+                    geometry=gpd.points_from_xy(df.longitude, df.latitude), crs='EPSG:4326')
+                folder = os.path.join(directory, shp)
+                os.mkdir(folder)
+                gdf.to_file(os.path.join(folder, shp + '.shp'))
+                with zipfile.ZipFile(os.path.join(directory, shp + '.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+                    for f in os.listdir(folder):
+                        z.write(os.path.join(folder, f), f)
+                cases.append(dict(name='shp.zip', loader='shpLoader', rows=rows, file=shp + '.zip', filename=shp + '.shp', kw={}))
+            except ImportError as e:
+                print('No shapefile fixture:', e)
+    return cases
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory):
+    '''Serve a directory over http in a background thread. Returns the server and its url'''
+    root = os.path.abspath(directory)
+
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(root, path.split('?')[0].lstrip('/'))
+
+        def log_message(self, *a):
+            pass
+
+    httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+
+
+class _quiet(object):
+    '''Silence the loaders' cache messages'''
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def __exit__(self, *a):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def _load(case, url):
+    '''Run the loader of a case, the way a notebook would'''
+    import puidata
+    if case['name'] == 'custom':
+        @puidata.customLoader.parser
+        def parse(file):
+            return puidata.pd.read_csv(file)
+        return parse(url=url, filename=case['filename'], **case['kw'])
+    if case['name'] == 'custom.text': # the docstring way: read, decode, split
+        @puidata.customLoader.parser
+        def parse(file):
+            lines = file.read().decode('utf-8').split('\n')
+            table = [line.split(',') for line in lines if line]
+            return puidata.pd.DataFrame(table[1:], columns=table[0])
+        return parse(url=url, filename=case['filename'], **case['kw'])
+    if case['name'] == 'custom.stream':
+        @puidata.customLoader.stream_parser(header=True)
+        def parse(lines):
+            for line in lines:
+                yield line.split(',')
+        return parse(url=url, filename=case['filename'], **case['kw'])
+    loader = getattr(puidata, case['loader'])
+    return loader.load(url=url, filename=case['filename'], **case['kw'])
+
+
+def _timed(func, trace=False):
+    '''Seconds and (with trace) peak traced MB of a call'''
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+    t0 = time.time()
+    try:
+        func()
+        return time.time() - t0, (tracemalloc.get_traced_memory()[1] / 1e6 if trace else None)
+    finally:
+        if trace:
+            tracemalloc.stop()
+
+
+def run_case(case, base_url, directory, repeat=3):
+    '''Cold and warm load times (best of repeat), throughput and peak memory of a case'''
+    url = base_url + case['file']
+    size = os.path.getsize(os.path.join(directory, case['file']))
+    result = dict(loader=case['loader'], format=case['name'], rows=case['rows'], bytes=size, error=None)
+
+    def cold_and_warm(trace=False):
+        cache = tempfile.mkdtemp(prefix='puidata_cache_')
+        os.environ['PUIDATA'] = cache
+        try:
+            with _quiet():
+                cold = _timed(lambda: _load(case, url), trace)
+                warm = _timed(lambda: _load(case, url), trace)
+        finally:
+            shutil.rmtree(cache, ignore_errors=True)
+        return cold, warm
+
+    try:
+        runs = [cold_and_warm() for _ in range(repeat)]
+        cold = min(r[0][0] for r in runs)
+        warm = min(r[1][0] for r in runs)
+        (_, cold_peak), (_, warm_peak) = cold_and_warm(trace=True)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+
+    result.update(
+        cold_s=cold, warm_s=warm,
+        cold_MBps=size / 1e6 / cold, warm_MBps=size / 1e6 / warm,
+        cold_rows_per_s=case['rows'] / cold, warm_rows_per_s=case['rows'] / warm,
+        cold_peak_MB=cold_peak, warm_peak_MB=warm_peak)
+    return result
+
+
+def benchmark_loaders(sizes=(1000, 100000), repeat=3, out=None, only=None):
+    '''Benchmark every loader on every fixture size
+    Arguments:
+        sizes (list): rows of the fixtures
+        repeat (int): cold/warm runs of each case, the best one is kept
+        out (str): JSON lines file the run is appended to
+        only (list): formats to run (csv, csv.zip, custom, custom.text, custom.stream, xlsx, shp.zip)
+    Returns the list of results
+    '''
+    import pandas as pd
+    directory = tempfile.mkdtemp(prefix='puidata_fixtures_')
+    previous = os.environ.get('PUIDATA')
+    httpd = None
+    try:
+        cases = [c for c in make_fixtures(directory, sizes) if not only or c['name'] in only]
+        httpd, base_url = serve(directory)
+        results = []
+        print('{:<13} {:<13} {:>8} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+            'loader', 'format', 'rows', 'MB', 'cold s', 'warm s', 'cold peak', 'warm peak'))
+        for case in cases:
+            r = run_case(case, base_url, directory, repeat)
+            results.append(r)
+            if r['error']:
+                print('{:<13} {:<13} {:>8}  {}'.format(r['loader'], r['format'], r['rows'], r['error']))
+                continue
+            print('{:<13} {:<13} {:>8} {:>9.2f} {:>9.3f} {:>9.3f} {:>8.1f}MB {:>8.1f}MB'.format(
+                r['loader'], r['format'], r['rows'], r['bytes'] / 1e6, r['cold_s'], r['warm_s'],
+                r['cold_peak_MB'], r['warm_peak_MB']))
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+        if previous is None:
+            os.environ.pop('PUIDATA', None)
+        else:
+            os.environ['PUIDATA'] = previous
+
+    if out:
+        with open(out, 'a') as f:
+            f.write(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                'pandas': pd.__version__, 'repeat': repeat, 'results': results}, sort_keys=True) + '\n')
+    return results
+
+
+def benchmark_parallel(rows=2000000, processes=(1, 2, 4, 8), repeat=3):
+    '''Time csvLoader.read on one big csv with each number of processes'''
+    import puidata
+    directory = tempfile.mkdtemp(prefix='puidata_parallel_')
+    try:
+        path = os.path.join(directory, 'table.csv')
+        make_table(rows).to_csv(path, index=False)
+        print('{} rows, {:.0f}MB, {} cpus'.format(rows, os.path.getsize(path) / 1e6, os.cpu_count() if hasattr(os, 'cpu_count') else '?'))
+        results = {}
+        for n in processes:
+            dl = puidata.csvLoader(filename='table.csv')
+            results[n] = min(_timed(lambda: dl.read(path, parallel=n))[0] for _ in range(repeat))
+            print('parallel={:<3} {:.3f}s  {:.2f}x'.format(n, results[n], results[processes[0]] / results[n]))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchmark_zip(rows=200000, members=12, workers=(1, 4, 8), repeat=3):
+    '''Time zipfile.extractall against BaseLoader.extract, and load_members, on a zip of monthly csvs'''
+    import puidata
+    directory = tempfile.mkdtemp(prefix='puidata_zip_')
+    previous = os.environ.get('PUIDATA')
+    try:
+        path = os.path.join(directory, 'bundle.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+            for m in range(members):
+                z.writestr('2017-{:02d}.csv'.format(m + 1), make_table(rows, m).to_csv(index=False))
+        print('{} members of {} rows, {:.0f}MB zipped'.format(members, rows, os.path.getsize(path) / 1e6))
+
+        def fresh(name):
+            out = os.path.join(directory, name)
+            shutil.rmtree(out, ignore_errors=True)
+            return out
+
+        z = zipfile.ZipFile(path)
+        print('{:<24} {:.3f}s'.format('extractall', min(
+            _timed(lambda: z.extractall(fresh('all')))[0] for _ in range(repeat))))
+        for n in workers:
+            print('{:<24} {:.3f}s'.format('extract workers={}'.format(n), min(
+                _timed(lambda: puidata.csvLoader().extract(z, fresh('pool'), workers=n))[0] for _ in range(repeat))))
+        for n in workers:
+            def load():
+                os.environ['PUIDATA'] = fresh('cache')
+                with _quiet():
+                    puidata.csvLoader().load_members(path, workers=n)
+            print('{:<24} {:.3f}s'.format('load_members workers={}'.format(n), min(_timed(load)[0] for _ in range(repeat))))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if previous is None:
+            os.environ.pop('PUIDATA', None)
+        else:
+            os.environ['PUIDATA'] = previous
+
+
+_CONVERT_CASE = """
+import resource, sys, time
+import puidata
+src, dst, mode, chunksize = sys.argv[1:5]
+t0 = time.time()
+if mode == 'convert':
+    puidata.convert(src, dst, int(chunksize))
+else:
+    loader = puidata.BaseLoader.loader_class(src)(filename=src).from_cache()
+    loader.to(puidata.BaseLoader.loader_class(dst)).save_cache(dst, overwrite=True)
+try: # ru_maxrss carries over from the parent on linux, VmHWM is this process only
+    peak = [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmHWM')][0]
+except (IOError, OSError, IndexError):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(time.time() - t0, peak)
+"""
+
+
+def benchmark_convert(rows=1000000, chunksize=100000, repeat=1):
+    '''Time and peak memory (in a fresh process) of csv -> parquet -> csv, loading the
+    whole table (from_cache + to + save_cache) against convert(...) a chunk at a time'''
+    directory = tempfile.mkdtemp(prefix='puidata_convert_')
+    env = dict(os.environ, PUIDATA=directory)
+    try:
+        make_table(rows).to_csv(os.path.join(directory, 'table.csv'), index=False)
+        print('{} rows, {:.0f}MB csv'.format(rows, os.path.getsize(os.path.join(directory, 'table.csv')) / 1e6))
+        for src, dst in [('table.csv', 'table.parquet'), ('table.parquet', 'table2.csv')]:
+            for mode in ('load + save', 'convert'):
+                runs = []
+                for _ in range(repeat):
+                    out = subprocess.check_output([sys.executable, '-c', _CONVERT_CASE, src, dst, mode, str(chunksize)],
+                                                  cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+                    runs.append([float(v) for v in out.decode().split()[-2:]])
+                seconds, rss = min(runs)
+                print('{:<22} {:<12} {:.3f}s {:>8.0f}MB peak'.format(
+                    '{} -> {}'.format(os.path.splitext(src)[1], os.path.splitext(dst)[1]), mode, seconds, rss / 1024.))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class _SlowFile(object):
+    '''A file that reads at most `mbps` MB/s, like a busy spinning disk or a network share'''
+    def __init__(self, f, mbps):
+        self.f, self.mbps = f, mbps
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        time.sleep(len(data) / (self.mbps * 1e6))
+        return data
+
+    read1 = read
+
+    def readinto(self, buffer):
+        n = self.f.readinto(buffer)
+        time.sleep(n / (self.mbps * 1e6))
+        return n
+
+    readinto1 = readinto
+
+    def readable(self):
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.f.close()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def benchmark_compression(rows=1000000, disks=(None, 100, 30), repeat=1):
+    '''Size, write time and read time of a trip table cached as a raw csv and compressed with each
+    codec, reading from disks of `disks` MB/s (None: the page cache, no throttle)'''
+    import puidata
+    import pandas as pd
+    directory = tempfile.mkdtemp(prefix='puidata_compression_')
+    try:
+        df = make_table(rows)
+        raw_size = None
+        print('{} rows'.format(rows))
+        print('{:<6} {:>8} {:>6} {:>8}'.format('codec', 'MB', 'ratio', 'write') + ''.join(
+            ' {:>14}'.format('read {}'.format('{}MB/s'.format(d) if d else 'cached')) for d in disks))
+        for codec in [None] + list(puidata.CODECS):
+            module = puidata.CODECS[codec][1] if codec else None
+            if module is not None and not module.available():
+                print('{:<6} needs {}'.format(codec, module._name.split('.')[0]))
+                continue
+            path = os.path.join(directory, 'trips.csv' + (puidata.CODECS[codec][0] if codec else ''))
+            loader = puidata.csvLoader(df=df)
+            write = min(_timed(lambda: loader.save(path))[0] for _ in range(repeat))
+            size = os.path.getsize(path)
+            raw_size = raw_size or size
+
+            reads = []
+            for mbps in disks:
+                def read():
+                    with io.open(path, 'rb') as f:
+                        f = _SlowFile(f, mbps) if mbps else f
+                        with puidata.open_compressed(f, 'rb', compression=codec) as c:
+                            pd.read_csv(c)
+                reads.append(min(_timed(read)[0] for _ in range(repeat)))
+            print('{:<6} {:>8.1f} {:>6.2f} {:>7.2f}s'.format(codec or 'raw', size / 1e6, raw_size / float(size), write) +
+                  ''.join(' {:>6.2f}s {:>3.0f}MB/s'.format(t, raw_size / 1e6 / t) for t in reads))
+        print('(MB/s is csv text read per second)')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='bench_puidata.py startup|hooks|loaders|parallel|zip|convert|compression [options]')
+    parser.add_option('--sizes', default='1000,100000', type='string',
+                      help='loaders: comma separated rows of the fixtures (default: 1000,100000)')
+    parser.add_option('--repeat', default=3, type='int',
+                      help='loaders: runs of each case, the best is kept (default: 3)')
+    parser.add_option('--only', default=None, type='string',
+                      help='loaders: comma separated formats to run (csv, csv.zip, custom, custom.text, custom.stream, xlsx, shp.zip)')
+    parser.add_option('--out', default=None, type='string',
+                      help='loaders: JSON lines file the results are appended to')
+    options, args = parser.parse_args()
+    command = args[0] if args else 'startup'
+
+    if command == 'startup':
+        benchmark_startup()
+
+    if command == 'hooks':
+        benchmark_hooks()
+
+    if command == 'loaders':
+        benchmark_loaders([int(n) for n in options.sizes.split(',')], options.repeat, options.out,
+                          options.only.split(',') if options.only else None)
+
+    if command == 'parallel':
+        benchmark_parallel(int(options.sizes.split(',')[-1]), repeat=options.repeat)
+
+    if command == 'zip':
+        benchmark_zip(int(options.sizes.split(',')[-1]), repeat=options.repeat)
+
+    if command == 'convert':
+        benchmark_convert(int(options.sizes.split(',')[-1]), repeat=options.repeat)
+
+    if command == 'compression':
+        benchmark_compression(int(options.sizes.split(',')[-1]), repeat=options.repeat)
@@ -2,14 +2,17 @@ from __future__ import print_function
 import io
 import os
 import sys
+import json
 import glob
+import gzip
+import hashlib
 import zipfile
-
-import pandas as pd
-try:
-    import geopandas as gpd
-except:
-    print("Geopandas can't be loaded. shpLoader is not available.")
+import shutil
+import tempfile
+import time
+import codecs
+import importlib
+import threading
 
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict as odict
@@ -20,6 +23,50 @@ try:
 except ImportError:
     import urllib.request as urllib
 
+try:
+    import fcntl
+except ImportError: # windows: cache locks only hold within the process
+    fcntl = None
+
+
+class _LazyModule(object):
+    '''Stands in for a module, and only imports it the first time one of its
+    attributes is used. pandas and geopandas (shapely, fiona, pyproj, ...) take
+    seconds to import, which things like `python puidata.py list` don't need.
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def available(self):
+        '''Whether the module can be imported'''
+        try:
+            self._load()
+            return True
+        except ImportError:
+            return False
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module {!r}{}>'.format(self._name, '' if self._module is None else ' (loaded)')
+
+pd = _LazyModule('pandas')
+gpd = _LazyModule('geopandas')
+pa = _LazyModule('pyarrow')
+pq = _LazyModule('pyarrow.parquet')
+zstandard = _LazyModule('zstandard')
+lz4frame = _LazyModule('lz4.frame')
+
 '''
 
 PUI Data
@@ -32,6 +79,7 @@ Current Supported File Types:
 * csv
 * Excel
 * Shapefile
+* Parquet (and GeoParquet)
 * *custom*
 
 They all can handle being extracted from a zip archive, as well as loading from
@@ -161,12 +209,79 @@ df = loader(
     url='https://github.com/bensteers/PUI2017_bs3639/raw/master/HW5_bs3639/data-pvLFI.csv'
 ).df
 
+## Streaming Custom Loader
+Reading the whole file, then decoding it, then splitting it holds the data three
+times over. A stream parser gets the lines (or byte chunks with lines=False) as
+they come in, and yields records (lists, tuples or dicts) or DataFrame chunks.
+The records are put together `batch` at a time, and each chunk is appended to the
+cache file as soon as it is ready.
+
+@customLoader.stream_parser(header=True)
+def loader(lines):
+    for line in lines:
+        yield line.split('\t') # a record
+
+df = loader(
+    url='https://github.com/bensteers/PUI2017_bs3639/raw/master/HW5_bs3639/data-pvLFI.csv'
+).df
+
+# byte chunks
+@customLoader.stream_parser(lines=False, chunk_size=2**20)
+def loader(chunks):
+    for chunk in chunks:
+        yield pd.DataFrame(...) # a DataFrame chunk
+
 ## The Proper way to load a .tsv
 df = csvLoader.load(
     url='https://github.com/bensteers/PUI2017_bs3639/raw/master/HW5_bs3639/data-pvLFI.csv',
     filename='data-pvLFI.csv', sep='\t' #**
 ).df
 
+# Converting
+Files are converted between formats (by extension) a chunk at a time, so only one
+chunk is ever in memory: csv <-> parquet <-> xlsx (one sheet) <-> shapefile, and
+GeoDataFrames to GeoParquet.
+
+convert('API_SP.POP.TOTL_DS2_en_csv_v2.csv', 'API_SP.POP.TOTL_DS2_en_csv_v2.parquet', chunksize=100000)
+
+# the cached file of a loader, without loading it
+pq_loader = csvLoader(filename='data.csv').convert_cache('parquet')
+
+# or from the command line, for one file or every cached file matching a pattern
+python puidata.py convert data.csv data.parquet
+python puidata.py convert '*.csv' .parquet
+
+# Compressed csv cache
+Cached csvs can be stored compressed (zstd and lz4 need the zstandard and lz4
+packages), and are decompressed transparently by from_cache/load/convert:
+
+df = csvLoader.load(url=url, compression='zstd').df  # cached as data.csv.zst
+csvLoader(filename='data.csv').from_cache().save_cache(compression='lz4', overwrite=True)
+
+# Sharing a cache
+Several kernels/workers can load the same file at once: cache files are written
+under a temporary name and renamed once complete, and load(...) holds a lock on
+`.locks/<file>.lock` (next to the file) while it downloads, so the other callers
+wait and then load the cached file instead of downloading it again.
+
+# Prefetching
+`python puidata.py prefetch manifest.yaml [workers] [--force]` refreshes the cache
+files of a list of datasets in parallel, e.g. from cron before the morning jobs
+(`0 5 * * * cd ~/notebooks && python puidata.py prefetch manifest.yaml`).
+A dataset is only downloaded again when its ETag/Last-Modified (or size/mtime for
+local files) changed since the last prefetch, which are kept in `<file>.meta.json`.
+The manifest is YAML (needs PyYAML) or JSON:
+
+datasets:
+  - name: citibike-2017-09
+    loader: csv                 # csv, xlsx, shp, parquet, custom (default: by filename)
+    url: https://s3.amazonaws.com/tripdata/201709-citibike-tripdata.csv.zip
+    filename: 201709-citibike-tripdata.csv
+    is_zip: true
+    options: {compression: zstd} # loader properties
+    read: {parse_dates: [starttime, stoptime]}
+    derived: [parquet]          # caches converted from it, rebuilt when it changes
+
 # Alternative Syntax
 
 ### This is identical to the first csv example.
@@ -200,6 +315,200 @@ Loaders to add:
 
 
 
+'''
+Instrumentation
+################
+Every loader stage (open_file, open_zip, read, save, from_cache) can report what
+it did to hooks: functions that get one dict per call with
+    loader, stage, seconds, bytes, rows, cache ('hit'/'miss' for from_cache),
+    filename, url, error
+When no hook is registered the stages run as is, without any timing.
+
+with profile() as stats:
+    df = csvLoader.load(url=url, filename=fn, is_zip=True).df
+stats.report()
+
+# or any function
+add_hook(lambda event: print(event['stage'], event['seconds']))
+'''
+
+_hooks = []
+
+def add_hook(func):
+    '''Register a function called with the event dict of every loader stage. Returns func.'''
+    _hooks.append(func)
+    return func
+
+def remove_hook(func):
+    '''Unregister a hook'''
+    if func in _hooks:
+        _hooks.remove(func)
+
+
+def _nbytes(stage, loader, result, a):
+    '''Best guess at the number of bytes a stage moved'''
+    try:
+        if stage == 'open_file':
+            length = getattr(result, 'headers', {}).get('Content-Length')
+            return int(length) if length is not None else os.fstat(result.fileno()).st_size
+        if stage == 'open_zip':
+            return sum(i.compress_size for i in result.infolist())
+        if stage in ('read', 'save') and a and isinstance(a[0], str) and os.path.isfile(a[0]):
+            return os.path.getsize(a[0])
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pass
+    return None
+
+def _nrows(loader):
+    if loader.df is not None:
+        return len(loader.df)
+    dfs = loader.dfs.values() if isinstance(loader.dfs, dict) else loader.dfs
+    return sum(len(df) for df in dfs) if len(dfs) else None
+
+def instrument(stage):
+    '''Decorator of a loader method that reports each call to the hooks as `stage`'''
+    def decorator(method):
+        def wrapper(self, *a, **kw):
+            if not _hooks:
+                return method(self, *a, **kw)
+
+            event = {'loader': self.__class__.__name__, 'stage': stage, 'bytes': None, 'rows': None,
+                     'cache': None, 'error': None}
+            t0 = time.time()
+            try:
+                result = method(self, *a, **kw)
+            except Exception as e:
+                event['error'] = '{}: {}'.format(type(e).__name__, e)
+                raise
+            else:
+                event['bytes'] = _nbytes(stage, self, result, a)
+                if stage in ('read', 'from_cache'):
+                    event['rows'] = _nrows(self)
+                if stage == 'from_cache':
+                    event['cache'] = 'hit' if self.has_df() else 'miss'
+                return result
+            finally:
+                event.update(seconds=time.time() - t0, filename=self.filename, url=self.url)
+                for hook in list(_hooks):
+                    hook(event)
+        wrapper.__name__, wrapper.__doc__ = method.__name__, method.__doc__
+        wrapper.__wrapped__ = method
+        return wrapper
+    return decorator
+
+
+class Stats(object):
+    '''A hook that adds up the events of each loader and stage'''
+    fields = ('calls', 'seconds', 'bytes', 'rows', 'hits', 'misses', 'errors')
+
+    def __init__(self):
+        self.events = []
+        self.totals = odict()
+
+    def __call__(self, event):
+        self.events.append(event)
+        total = self.totals.setdefault((event['loader'], event['stage']), dict.fromkeys(self.fields, 0))
+        total['calls'] += 1
+        total['seconds'] += event['seconds']
+        total['bytes'] += event['bytes'] or 0
+        total['rows'] += event['rows'] or 0
+        total['hits'] += event['cache'] == 'hit'
+        total['misses'] += event['cache'] == 'miss'
+        total['errors'] += event['error'] is not None
+
+    def report(self, file=None):
+        '''Print a table of the totals per loader and stage'''
+        file = file or sys.stdout
+        print('{:<14} {:<11} {:>6} {:>9} {:>12} {:>10} {:>9} {:>6}'.format(
+            'loader', 'stage', 'calls', 'seconds', 'MB', 'rows', 'hit/miss', 'errors'), file=file)
+        for (loader, stage), t in self.totals.items():
+            print('{:<14} {:<11} {:>6} {:>9.3f} {:>12.3f} {:>10} {:>9} {:>6}'.format(
+                loader, stage, t['calls'], t['seconds'], t['bytes'] / 1e6, t['rows'],
+                '{}/{}'.format(t['hits'], t['misses']) if stage == 'from_cache' else '', t['errors']), file=file)
+
+
+class profile(object):
+    '''Context manager collecting Stats of the loaders used inside it'''
+    def __init__(self, stats=None):
+        self.stats = stats or Stats()
+
+    def __enter__(self):
+        add_hook(self.stats)
+        return self.stats
+
+    def __exit__(self, *a):
+        remove_hook(self.stats)
+
+
+
+# Cache locking
+#################
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+class cache_lock(object):
+    '''Context manager holding an exclusive lock on a cache file, across threads and processes,
+    so one of them fills the file while the others wait for it. Nested locks on the same path
+    in one thread are fine. The lock files live in a hidden `.locks` directory next to the
+    cache files, one per cached file, so they don't clutter the cache listing.
+
+    with cache_lock(loader.local_file(loader.filename)):
+        ...
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock_file = os.path.join(os.path.dirname(self.path), '.locks', os.path.basename(self.path) + '.lock')
+        with _locks_guard:
+            # [thread lock, depth, lock file]
+            self.entry = _locks.setdefault(self.path, [threading.RLock(), 0, None])
+
+    def __enter__(self):
+        entry = self.entry
+        entry[0].acquire()
+        if entry[1] == 0:
+            try:
+                if not os.path.isdir(os.path.dirname(self.lock_file)):
+                    os.makedirs(os.path.dirname(self.lock_file))
+            except OSError: # made by someone else
+                pass
+            entry[2] = open(self.lock_file, 'a')
+            if fcntl is not None:
+                fcntl.flock(entry[2].fileno(), fcntl.LOCK_EX) # blocks until the other process is done
+        entry[1] += 1
+        return self
+
+    def __exit__(self, *a):
+        entry = self.entry
+        entry[1] -= 1
+        if entry[1] == 0:
+            if fcntl is not None:
+                fcntl.flock(entry[2].fileno(), fcntl.LOCK_UN)
+            entry[2].close() # the lock file stays, removing it would race with the next locker
+            entry[2] = None
+        entry[0].release()
+
+
+def _atomic_write(path, write):
+    '''Call write(tmp) with a temporary path next to `path`, then move the result(s) in
+    place with a rename, so readers only ever see complete files. The temporary path keeps
+    the extension (pandas picks excel engines by it), and every file written next to it
+    (e.g. a shapefile's .dbf, .shx, .prj) is moved too.'''
+    root, ext = os.path.splitext(path)
+    tmp_root = '{}.{}-{}.part'.format(root, os.getpid(), threading.current_thread().ident)
+    try:
+        write(tmp_root + ext)
+        for tmp in glob.glob(_glob_escape(tmp_root) + '.*'):
+            _replace(tmp, root + tmp[len(tmp_root):])
+    finally:
+        for tmp in glob.glob(_glob_escape(tmp_root) + '.*'): # failed writes
+            os.remove(tmp)
+
+_replace = os.replace if hasattr(os, 'replace') else os.rename
+_glob_escape = glob.escape if hasattr(glob, 'escape') else (lambda p: p)
+
+
+
 # Abstract class
 class BaseLoader(object):
     __metaclass__ = ABCMeta
@@ -263,6 +572,7 @@ class BaseLoader(object):
         self.read(socket, **kw)
         return self
 
+    @instrument('from_cache')
     def from_cache(self, filename=None, **kw):
         '''Load file from cache. Assumed that it exists
 
@@ -272,8 +582,8 @@ class BaseLoader(object):
         Returns self (chainable)
         '''
         if self.is_cached(filename):
-            print('Loaded from cache:', self.local_file(filename or self.filename))
-            self.read(self.local_file(filename or self.filename), **kw)
+            print('Loaded from cache:', self.cache_path(filename))
+            self.read(self.cache_path(filename), **kw)
         return self
 
     def save_cache(self, filename=None, overwrite=False, **kw):
@@ -285,12 +595,15 @@ class BaseLoader(object):
             **kw: arguments to pass to the read function. For csv this is `read_csv`, for xlsx, `pd.read_excel`, etc.
         Returns self (chainable)
         '''
-        if self.has_df():
+        if not self.has_df():
             print('df is None')
-        elif overwrite or not self.is_cached():
-            print('Saving to cache:', self.local_file(filename or self.filename))
-            BaseLoader.ensure_directory(self, self.local_file())
-            self.save(self.local_file(filename or self.filename), **kw)
+        elif overwrite or not self.is_cached(filename):
+            path = self.cache_path(filename, write=True)
+            with cache_lock(path):
+                if overwrite or not self.is_cached(filename): # or it was saved while we waited
+                    print('Saving to cache:', path)
+                    BaseLoader.ensure_directory(self, self.local_file())
+                    _atomic_write(path, lambda tmp: self.save(tmp, **kw))
         return self
 
 
@@ -333,7 +646,15 @@ class BaseLoader(object):
         Usage:
         df = csvLoader(filename).cached_load(url).df
         '''
-        return self.from_cache().download(*a, **kw).save_cache()
+        # parallel parsing only applies to the cached file
+        cache_kw = {'parallel': kw.pop('parallel')} if kw.get('parallel') else {}
+        if self.from_cache(**cache_kw).has_df() or not self.filename:
+            return self.download(*a, **kw).save_cache()
+        # only one process downloads, the others wait for it and then load its cache file
+        with cache_lock(self.cache_path(write=True)):
+            if not self.is_cached():
+                return self.download(*a, **kw).save_cache()
+        return self.from_cache(**cache_kw)
 
 
     # Caching utilities
@@ -342,14 +663,19 @@ class BaseLoader(object):
         '''Get the path for a cached file'''
         return os.path.join(self.directory, self.basename, filename or '')
 
+    def cache_path(self, filename=None, write=False):
+        '''Get the path of a cached file, to read it or (write=True) to save it'''
+        return self.local_file(filename or self.filename)
+
     def is_cached(self, filename=None):
         '''Check if a cached file exists'''
-        return os.path.isfile(self.local_file(filename or self.filename))
+        return os.path.isfile(self.cache_path(filename))
 
 
 
     # File loaders
 
+    @instrument('open_file')
     def open_file(self, url=None, as_b=False):
         '''Create a file buffer from a url or path'''
         self.url = url or self.url or self.local_file(self.filename)
@@ -361,9 +687,87 @@ class BaseLoader(object):
             socket = open(self.url, 'rb' if as_b else 'r')
         return socket
 
+    @instrument('open_zip')
     def open_zip(self, url):
-        '''Open a zip archive as a zipfile object'''
-        return zipfile.ZipFile(io.BytesIO( self.open_file(url, as_b=True).read() ))
+        '''Open a zip archive as a zipfile object. Local archives are opened in place,
+        downloads are spooled to a temporary file instead of held in memory.'''
+        socket = self.open_file(url, as_b=True)
+        if not getattr(socket, 'seekable', lambda: False)():
+            spool = tempfile.TemporaryFile() # deleted once the zipfile is garbage collected
+            shutil.copyfileobj(socket, spool, 2**20)
+            socket.close()
+            spool.seek(0)
+            socket = spool
+        return zipfile.ZipFile(socket)
+
+    def extract(self, z, directory=None, members=None, workers=4):
+        '''Decompress the members of a zip archive, `workers` at a time. Each member is
+        streamed straight into its file (written as .part, then renamed).
+
+        Arguments:
+            z (zipfile.ZipFile): the archive
+            directory (str): where to extract to (default: the cache directory)
+            members (list): names of the members to extract (default: all)
+            workers (int): number of members decompressed at the same time
+        Returns the list of extracted paths
+        '''
+        directory = directory or self.local_file()
+        infos = [i for i in z.infolist() if (members is None or i.filename in members)
+                 and not i.filename.endswith('/')]
+
+        def extract_one(info):
+            path = os.path.join(directory, *info.filename.split('/'))
+            if not os.path.normpath(path).startswith(os.path.normpath(directory)): # ../ in a member name
+                raise ValueError('Unsafe path in zip archive: {}'.format(info.filename))
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError: # made by another worker
+                    pass
+            part = '{}.{}.part'.format(path, os.getpid()) # other processes may extract the same archive
+            with z.open(info) as src, open(part, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 2**20)
+            _replace(part, path)
+            return path
+
+        if workers <= 1 or len(infos) <= 1:
+            return [extract_one(i) for i in infos]
+        from multiprocessing.pool import ThreadPool # zlib lets go of the GIL while inflating
+        pool = ThreadPool(min(workers, len(infos)))
+        try:
+            return pool.map(extract_one, infos)
+        finally:
+            pool.close()
+
+    def load_members(self, url=None, members=None, workers=4, **kw):
+        '''Load several files of a zip archive (e.g. a bundle of monthly csvs). The members
+        that aren't cached yet are extracted to the cache, then all of them are read `workers`
+        at a time. Assigns an ordered dict of {member: df} to `self.dfs`
+
+        Arguments:
+            url (str): The url of the zip archive. Can be remote or local
+            members (list): names of the members to load (default: all those with the loader's extension)
+            workers (int): number of members extracted and read at the same time
+            **kw: Arguments to pass to `pd.read_csv` or whatever loader
+        Returns self (chainable)
+        '''
+        if members is None or not all(self.is_cached(m) for m in members):
+            z = self.open_zip(url)
+            members = members or [n for n in z.namelist() if n.endswith(self.extension)]
+            self.extract(z, members=[m for m in members if not self.is_cached(m)], workers=workers)
+
+        def read_one(member):
+            loader = self.__class__(filename=member)
+            loader.read(self.local_file(member), **kw)
+            return loader.get_df()
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(workers, len(members))))
+        try:
+            self.dfs = odict(zip(members, pool.map(read_one, members)))
+        finally:
+            pool.close()
+        return self
 
     def open_socket(self, url=None, filename=None, is_zip=False, ith=0, as_b=False):
         '''Create a file buffer from a url or path, expanding a zip if requested'''
@@ -403,7 +807,9 @@ class BaseLoader(object):
 
     def set_df(self, df):
         '''Assign df or multiple dfs'''
-        if isinstance(df, pd.DataFrame):
+        if df is None: # don't import pandas just to check
+            pass
+        elif isinstance(df, pd.DataFrame):
             self.df = df
         elif hasattr(df, '__getitem__'):
             self.dfs = df # Assumed to be an ordered dict, dict, or list.
@@ -436,13 +842,71 @@ class BaseLoader(object):
         ).from_cache().load_sheet('Sheet 1').to('csv').save_cache()
         '''
         if isinstance(cls, str):
-            subclasses = {c.__name__: c for c in self.__class__.__subclasses__()}
-            cls = subclasses.get(cls + 'Loader')
+            try:
+                cls = BaseLoader.loader_class(cls)
+            except ValueError:
+                return None
         if issubclass(cls, BaseLoader):
-            return cls(filename=self.filename, url=self.url, df=self.get_df())
+            filename = self.filename
+            if filename and cls.extension: # data.xlsx -> data.csv
+                filename = os.path.splitext(filename)[0] + cls.extension
+            return cls(filename=filename, url=self.url, df=self.get_df())
         else:
             return None
 
+    def convert_cache(self, cls, filename=None, chunksize=100000, **kw):
+        '''Convert the cached file of this loader to another format, a chunk at a time,
+        without loading it into self.df. See convert(...)
+
+        Arguments:
+            cls (str or BaseLoader subclass): the loader of the new format
+            filename (str): the name of the new cached file (default: same name, new extension)
+            chunksize (int): rows per chunk
+            **kw: passed to this loader's iter_chunks
+
+        Returns a loader of the new file (not loaded, call .from_cache() to load it)
+        '''
+        cls = BaseLoader.loader_class(cls) if isinstance(cls, str) else cls
+        filename = filename or os.path.splitext(self.filename)[0] + cls.extension
+        convert(self.cache_path(), cls().local_file(filename), chunksize,
+                src_loader=self.__class__, dst_loader=cls, **kw)
+        return cls(filename=filename, url=self.url)
+
+    @classmethod
+    def loader_class(cls, name):
+        '''Find a loader class by name ('csv' or 'csvLoader') or extension ('.csv' or 'data.csv')'''
+        def subclasses(c):
+            for sub in c.__subclasses__():
+                yield sub
+                for subsub in subclasses(sub):
+                    yield subsub
+        loaders = list(subclasses(BaseLoader))
+        for c in loaders:
+            if name in (c.__name__, c.__name__[:-len('Loader')]):
+                return c
+        base = _strip_codec(name) # data.csv.zst -> data.csv
+        for c in loaders:
+            if c.extension and base.lower().endswith(c.extension):
+                return c
+        raise ValueError('No loader for {}'.format(name))
+
+
+    # Streaming - used by convert(...)
+
+    def iter_chunks(self, file, chunksize=100000, **kw):
+        '''Yield the data of a file as DataFrame chunks. Loaders that can't read
+        in chunks read the whole file and yield it at once.'''
+        self.read(file, **kw)
+        df = self.get_df()
+        if isinstance(df, dict): # the first sheet
+            df = list(df.values())[0]
+        yield df
+
+    def writer(self, file, **kw):
+        '''Something to write DataFrame chunks to a file with, with write(df) and close().
+        Loaders that can't write in chunks put the chunks together and save them at once.'''
+        return _SaveWriter(self, file, **kw)
+
 
 
     # Extra methods
@@ -474,6 +938,145 @@ class BaseLoader(object):
 
 
 
+# Chunk writers
+class _SaveWriter(object):
+    '''Puts the chunks together and saves them with the loader when closed'''
+    def __init__(self, loader, file, **kw):
+        self.loader, self.file, self.kw, self.chunks = loader, file, kw, []
+
+    def write(self, df):
+        self.chunks.append(df)
+
+    def close(self):
+        if self.chunks:
+            self.loader.df = pd.concat(self.chunks, ignore_index=True) if len(self.chunks) > 1 else self.chunks[0]
+            self.loader.save(self.file, **self.kw)
+
+
+class _CsvWriter(object):
+    '''Appends chunks to a csv (a path or an open text file, e.g. sys.stdout), with the header of the first one'''
+    def __init__(self, file, **kw):
+        self.own = not hasattr(file, 'write')
+        self.f, self.kw, self.header = open_compressed(file, 'wt') if self.own else file, kw, True
+
+    def write(self, df):
+        df.to_csv(self.f, index=False, header=self.header, **self.kw)
+        self.header = False
+
+    def close(self):
+        if self.own:
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+def _to_arrow(df):
+    '''Arrow table of a chunk. The geometry of GeoDataFrames is stored as WKB, with GeoParquet metadata.'''
+    geo = None
+    if type(df).__name__ == 'GeoDataFrame': # without importing geopandas
+        col = df.geometry.name
+        geo = {'version': '1.0.0', 'primary_column': col, 'columns': {col: {
+            'encoding': 'WKB', 'geometry_types': [], 'crs': df.crs.to_json_dict() if df.crs else None}}}
+        wkb = df.geometry.to_wkb()
+        df = pd.DataFrame(df)
+        df[col] = wkb
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if geo:
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'geo'] = json.dumps(geo).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+    return table
+
+
+def _from_arrow(table, metadata=None):
+    '''DataFrame of an arrow table, or a GeoDataFrame if it has GeoParquet metadata'''
+    df = table.to_pandas()
+    geo = (metadata or table.schema.metadata or {}).get(b'geo')
+    if geo:
+        geo = json.loads(geo.decode('utf-8'))
+        col = geo['primary_column']
+        crs = geo['columns'][col].get('crs')
+        if isinstance(crs, dict):
+            crs = importlib.import_module('pyproj').CRS.from_json_dict(crs)
+        df = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkb(df[col], index=df.index, crs=crs), crs=crs)
+    return df
+
+
+class _ParquetWriter(object):
+    '''Appends chunks to a parquet file as row groups, with the schema of the first one'''
+    def __init__(self, file, compression='snappy', **kw):
+        self.file, self.compression, self.kw, self.w = file, compression, kw, None
+
+    def write(self, df):
+        table = _to_arrow(df)
+        if self.w is None:
+            # columns of only None have no type yet, assume strings. Typed columns
+            # (e.g. float64 all NaN) keep their type.
+            schema = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                                for f in table.schema], metadata=table.schema.metadata)
+            self.w = pq.ParquetWriter(self.file, schema, compression=self.compression, **self.kw)
+        if not table.schema.equals(self.w.schema, check_metadata=False):
+            if table.schema.names != self.w.schema.names:
+                raise ValueError("A chunk has the columns {}, the first chunk {}".format(
+                    table.schema.names, self.w.schema.names))
+            for field, given in zip(self.w.schema, table.schema):
+                text = lambda t: pa.types.is_string(t) or pa.types.is_large_string(t)
+                if given.type != field.type and not pa.types.is_null(given.type) and not (
+                        text(given.type) and text(field.type)):
+                    raise ValueError("Column {!r} is {} in a chunk but {} in the first chunk. "
+                                     "Set the column types with dtype=... when reading.".format(
+                                         field.name, given.type, field.type))
+            table = table.cast(self.w.schema) # only columns of None and string/large_string left
+        self.w.write_table(table)
+
+    def close(self):
+        if self.w is not None:
+            self.w.close()
+
+
+def convert(src, dst, chunksize=100000, src_loader=None, dst_loader=None, **kw):
+    '''Convert a file to another format a chunk at a time, so only one chunk is in memory
+
+    Arguments:
+        src (str): the file. A relative path that doesn't exist is taken from the cache directory
+        dst (str): the new file, or '-' to write csv to stdout. A relative path goes in the cache
+            directory, unless its directory exists relative to the current one
+        chunksize (int): rows per chunk
+        src_loader, dst_loader (str or BaseLoader subclass): the loaders of the formats (default: by extension)
+        **kw: passed to the source loader's iter_chunks (e.g. sep or dtype for csv, sheet for xlsx)
+    Returns the number of rows converted
+    '''
+    get = lambda c, path: (BaseLoader.loader_class(c) if isinstance(c, str) else c) if c else BaseLoader.loader_class(path)
+    reader = get(src_loader, src)()
+    src = src if os.path.isabs(src) or os.path.exists(src) else reader.local_file(src)
+
+    rows = [0]
+    def write(writer):
+        try:
+            for chunk in reader.iter_chunks(src, chunksize=chunksize, **kw):
+                writer.write(chunk)
+                rows[0] += len(chunk)
+        finally:
+            writer.close()
+
+    if dst == '-':
+        if dst_loader is not None and not issubclass(get(dst_loader, dst), csvLoader):
+            raise ValueError('Only csv can be written to stdout')
+        write(_CsvWriter(sys.stdout))
+        return rows[0]
+
+    target = get(dst_loader, dst)()
+    directory = os.path.dirname(dst)
+    if not os.path.isabs(dst) and not (directory and os.path.isdir(directory)):
+        dst = target.local_file(dst)
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    with cache_lock(dst):
+        _atomic_write(dst, lambda tmp: write(target.writer(tmp)))
+    return rows[0]
+
+
+
 class csvLoader(BaseLoader):
     extension = '.csv'
     '''
@@ -504,23 +1107,234 @@ class csvLoader(BaseLoader):
         url='http://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=csv', filename='API_SP.POP.TOTL_DS2_en_csv_v2.csv'
     ).from_cache().download(is_zip=True, skiprows=3).save_cache().df
     '''
+    compression = None # store the cache file compressed: 'zstd', 'lz4' or 'gzip' (see CODECS)
+
+    def cache_path(self, filename=None, write=False):
+        '''The cache file, with the suffix of `self.compression`. When reading, a cache file
+        saved with another (or no) compression is used too.'''
+        path = self.local_file(filename or self.filename)
+        wanted = path + CODECS[self.compression][0] if self.compression else path
+        if write:
+            return wanted
+        for p in [wanted, path] + [path + suffix for suffix, _ in CODECS.values()]:
+            if os.path.isfile(p):
+                return p
+        return wanted
+
+    def save_cache(self, filename=None, overwrite=False, compression=None, **kw):
+        '''save file to PUIDATA directory. See BaseLoader.save_cache
 
-    def read(self, file, **kw):
-        '''Loads dataframe from file or file-like object'''
-        self.df = pd.read_csv(file, **kw)
+        Arguments:
+            compression (str): compress the cache file with 'zstd', 'lz4' or 'gzip'
+                (default: self.compression). from_cache finds and decompresses it.
+        '''
+        if compression:
+            self.compression = compression
+        return super(csvLoader, self).save_cache(filename, overwrite, **kw)
+
+    def cached_load(self, *a, **kw):
+        '''See BaseLoader.cached_load
+
+        Arguments:
+            compression (str): store the cache file compressed with 'zstd', 'lz4' or 'gzip'
+                (sets self.compression, it isn't passed to pd.read_csv)
+        '''
+        compression = kw.pop('compression', None)
+        if compression:
+            self.compression = compression
+        return super(csvLoader, self).cached_load(*a, **kw)
+
+    @instrument('read')
+    def read(self, file, parallel=None, chunks=False, **kw):
+        '''Loads dataframe from file or file-like object
+
+        Arguments:
+            parallel (int): split an uncompressed csv file into this many newline aligned byte
+                ranges and parse them in as many processes. Files with quoted newlines can't be split.
+                Falls back to a single pd.read_csv for sockets, compressed files and the kw that
+                depend on row positions (skiprows, nrows, ...).
+            chunks (bool): with parallel, keep the parsed ranges as a list in self.dfs instead of
+                concatenating them in self.df
+            **kw: passed to pd.read_csv
+        '''
+        if parallel and parallel > 1 and _splittable(file, kw):
+            dfs = read_csv_parallel(file, parallel, **kw)
+            if chunks:
+                self.df, self.dfs = None, dfs
+            else:
+                self.df = pd.concat(dfs, ignore_index=kw.get('index_col') in (None, False))
+        elif _codec(file) and 'compression' not in kw:
+            with open_compressed(file) as f:
+                self.df = pd.read_csv(f, **kw)
+        else:
+            self.df = pd.read_csv(file, **kw)
 
 
+    @instrument('save')
     def save(self, file, **kw):
-        '''Saves file to location'''
-        self.df.to_csv(file, index=False, **kw)
+        '''Saves file to location (compressed by its suffix, see CODECS)'''
+        if _codec(file) and 'compression' not in kw:
+            with open_compressed(file, 'wt') as f:
+                self.df.to_csv(f, index=False, **kw)
+        else:
+            self.df.to_csv(file, index=False, **kw)
+
+    def iter_chunks(self, file, chunksize=100000, **kw):
+        '''Yield the csv `chunksize` rows at a time'''
+        f = open_compressed(file) if _codec(file) and 'compression' not in kw else file
+        try:
+            for chunk in pd.read_csv(f, chunksize=chunksize, **kw):
+                yield chunk
+        finally:
+            if f is not file:
+                f.close()
+
+    def writer(self, file, **kw):
+        return _CsvWriter(file, **kw)
+
+
+
+# Compressed cache files
+#########################
+
+# compression: (suffix, module it needs)
+CODECS = odict([
+    ('zstd', ('.zst', zstandard)),
+    ('lz4', ('.lz4', lz4frame)),
+    ('gzip', ('.gz', None)),
+])
+
+def _codec(path):
+    '''The compression of a file by its suffix, or None'''
+    for name, (suffix, _) in CODECS.items():
+        if isinstance(path, str) and path.lower().endswith(suffix):
+            return name
+    return None
+
+def _strip_codec(path):
+    '''The path without its compression suffix: data.csv.zst -> data.csv'''
+    codec = _codec(path)
+    return path[:-len(CODECS[codec][0])] if codec else path
+
+def open_compressed(path, mode='rb', compression=None, level=None):
+    '''Open a file, compressed with the codec of its suffix (.zst, .lz4, .gz) or `compression`.
+
+    Arguments:
+        path (str or file object): the file (a file object needs `compression`)
+        mode (str): 'rb', 'wb', 'rt' or 'wt' (text is utf-8)
+        compression (str): 'zstd', 'lz4' or 'gzip' (default: by suffix, uncompressed if none)
+        level (int): compression level (default: fast levels, zstd 3, lz4 0, gzip 1)
+    '''
+    codec = compression or _codec(path)
+    binary = mode.replace('t', '').replace('b', '') + 'b'
+    if codec is None and not isinstance(path, str):
+        return path
+    if codec is None:
+        return io.open(path, mode, encoding=None if 'b' in mode else 'utf-8', newline=None if 'b' in mode else '')
+    if codec not in CODECS:
+        raise ValueError('Unknown compression {!r}, use one of {}'.format(codec, list(CODECS)))
+    module = CODECS[codec][1]
+    if module is not None and not module.available():
+        raise ImportError("compression='{}' needs the {} package".format(codec, module._name.split('.')[0]))
+
+    if codec == 'zstd':
+        f = zstandard.open(path, binary, cctx=zstandard.ZstdCompressor(level=3 if level is None else level))
+    elif codec == 'lz4':
+        f = lz4frame.open(path, binary, compression_level=level or 0)
+    else:
+        f = gzip.open(path, binary, compresslevel=level or 1)
+    return f if 'b' in mode else io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+
+# pd.read_csv arguments that depend on where the rows are in the file
+_POSITIONAL_KW = ('skiprows', 'skipfooter', 'nrows', 'chunksize', 'iterator', 'header', 'names', 'comment')
+_COMPRESSED = ('.gz', '.bz2', '.zip', '.xz', '.zst', '.lz4')
+
+def _splittable(file, kw):
+    '''Whether a csv can be parsed in byte ranges'''
+    return (isinstance(file, str) and os.path.isfile(file)
+            and not file.lower().endswith(_COMPRESSED)
+            and kw.get('compression') in (None, 'infer')
+            and not any(kw.get(k) is not None for k in _POSITIONAL_KW if k != 'header')
+            and kw.get('header', 'infer') in ('infer', 0))
+
+
+def _byte_ranges(path, n, start=0):
+    '''Split a file from start into n ranges that end on a newline'''
+    size = os.path.getsize(path)
+    offsets = [start]
+    with open(path, 'rb') as f:
+        for i in range(1, n):
+            f.seek(max(start + (size - start) * i // n, offsets[-1]))
+            f.readline() # move to the start of the next row
+            offsets.append(min(f.tell(), size))
+    offsets.append(size)
+    return [(a, b) for a, b in zip(offsets[:-1], offsets[1:]) if b > a]
+
+
+def _read_range(args):
+    '''Parse one byte range of a csv with the columns of the file'''
+    path, start, end, names, kw = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return pd.read_csv(io.BytesIO(data), header=None, names=names, **kw)
+
+
+def read_csv_parallel(path, processes, **kw):
+    '''Parse a csv file in `processes` worker processes, one newline aligned byte range each.
+    The header is read once, and every range is parsed with the same column names
+    and read_csv arguments (dtype, usecols, parse_dates, ...).
+
+    Each range infers its own dtypes, so a column can come out as numbers in one range and
+    text in another (zip codes: '00501' ... 'A0001'). Those columns are parsed again as str
+    in every range, like a single read_csv of the whole file does.
+
+    Returns the list of DataFrames of each range, in order
+    '''
+    from multiprocessing import Pool
+    with open(path, 'rb') as f:
+        f.readline()
+        header_end = f.tell()
+    header_kw = {k: kw[k] for k in ('sep', 'delimiter', 'encoding', 'quotechar', 'escapechar', 'engine') if k in kw}
+    names = list(pd.read_csv(path, nrows=0, **header_kw).columns)
+    ranges = _byte_ranges(path, processes, header_end)
+    if len(ranges) <= 1:
+        return [pd.read_csv(path, **kw)]
+    kw = {k: v for k, v in kw.items() if k != 'header'} # the ranges have no header, names are given
+
+    pool = Pool(min(processes, len(ranges)))
+    try:
+        dfs = pool.map(_read_range, [(path, a, b, names, kw) for a, b in ranges])
+        mixed = _mixed_columns(dfs)
+        if mixed:
+            dtype = kw.get('dtype')
+            dtype = dict(dtype) if isinstance(dtype, dict) else {c: dtype for c in names} if dtype is not None else {}
+            dtype.update((c, str) for c in mixed)
+            kw = dict(kw, dtype=dtype)
+            dfs = pool.map(_read_range, [(path, a, b, names, kw) for a, b in ranges])
+        return dfs
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _mixed_columns(dfs):
+    '''Columns parsed as text in some DataFrames and as something else in others'''
+    text = lambda dtype: pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)
+    kinds = {}
+    for df in dfs:
+        for column, dtype in df.dtypes.items():
+            kinds.setdefault(column, set()).add(text(dtype))
+    return [c for c, k in kinds.items() if len(k) > 1]
 
 
 
 class xlsxLoader(BaseLoader):
     extension = '.xlsx'
 
-    def __init__(self, filename=None, url=None, sheets=None):
-        BaseLoader.__init__(self, filename, url)
+    def __init__(self, filename=None, url=None, sheets=None, df=None):
+        BaseLoader.__init__(self, filename, url, df)
         self.sheets = sheets
 
 
@@ -566,18 +1380,70 @@ class xlsxLoader(BaseLoader):
             self.sheet_name = sheet
         return self
 
+    @instrument('read')
     def read(self, file, sheets=None, **kw):
         '''Read xlsx file'''
+        if hasattr(file, 'read') and not getattr(file, 'seekable', lambda: False)():
+            file = io.BytesIO(file.read()) # xlsx are zip archives, which need to seek
         reader = pd.ExcelFile(file)
         sheets = sheets or self.sheets or reader.sheet_names
-        self.dfs = odict([(sh, pd.read_excel(reader, sheetname=sh, **kw)) for sh in sheets])
+        self.dfs = odict([(sh, pd.read_excel(reader, sheet_name=sh, **kw)) for sh in sheets])
 
+    @instrument('save')
     def save(self, file, **kw):
-        '''Write xlsx file'''
+        '''Write xlsx file (a single df, e.g. from to('xlsx'), goes to Sheet1)'''
         writer = pd.ExcelWriter(file)
-        for name, df in self.dfs.items():
-            df.to_excel(writer, name, index=False, **kw)
-        writer.save()
+        for name, df in (self.dfs.items() if len(self.dfs) else [('Sheet1', self.df)]):
+            df.to_excel(writer, sheet_name=name, index=False, **kw)
+        writer.close()
+
+    def iter_chunks(self, file, chunksize=100000, sheet=None, **kw):
+        '''Yield the rows of a sheet (default: the first) `chunksize` at a time, read with
+        openpyxl in read only mode. The first row is the header.'''
+        import openpyxl
+        wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            rows = (wb[sheet] if sheet else wb.worksheets[0]).iter_rows(values_only=True)
+            columns = list(next(rows, ()))
+            n = len(columns)
+            batch, empty = [], True
+            for row in rows:
+                # rows whose last cells are empty come back shorter than the header
+                batch.append(row[:n] + (None,) * (n - len(row)))
+                if len(batch) >= chunksize:
+                    yield pd.DataFrame(batch, columns=columns)
+                    batch, empty = [], False
+            if batch or empty:
+                yield pd.DataFrame(batch, columns=columns)
+        finally:
+            wb.close()
+
+    def writer(self, file, sheet='Sheet1', **kw):
+        return _XlsxWriter(file, sheet)
+
+
+class _XlsxWriter(object):
+    '''Appends chunks to one sheet of a workbook, with openpyxl in write only mode'''
+    max_rows = 1048576 # rows of an excel sheet, the header included
+
+    def __init__(self, file, sheet='Sheet1'):
+        import openpyxl
+        self.file, self.wb = file, openpyxl.Workbook(write_only=True)
+        self.ws, self.header, self.rows = self.wb.create_sheet(sheet), True, 0
+
+    def write(self, df):
+        self.rows += len(df) + self.header
+        if self.rows > self.max_rows:
+            raise ValueError('An xlsx sheet holds at most {:,} rows with the header, this data has more. '
+                             'Convert it to csv or parquet instead.'.format(self.max_rows))
+        if self.header:
+            self.ws.append([str(c) for c in df.columns])
+            self.header = False
+        for row in df.astype(object).where(df.notnull(), None).itertuples(index=False):
+            self.ws.append(list(row))
+
+    def close(self):
+        self.wb.save(self.file)
 
 
 
@@ -587,13 +1453,13 @@ class shpLoader(BaseLoader):
     _basename = ''
 
     def __init__(self, *a, **kw):
-        # Only allow class if geopandas is loaded
-        if 'geopandas' not in sys.modules:
+        # Only allow class if geopandas can be loaded
+        if not gpd.available():
             raise ImportError('shpLoader depends on geopandas, which could not be loaded.')
         super(shpLoader, self).__init__(*a, **kw)
 
 
-    def download(self, url=None, filename=None, is_zip=True, **kw):
+    def download(self, url=None, filename=None, is_zip=True, workers=4, **kw):
         '''Load xlsx from either url or file
         Assigns an ordered dict of dataframes to `self.dfs`
 
@@ -601,6 +1467,7 @@ class shpLoader(BaseLoader):
             url (str): The url to get the csv from. Can be remote or local
             filename (str): The filename to get from the zip file. If a previous filename was not specified,
                 it will be used for saving the cache file too. The file will be stored in
+            workers (int): number of archive members (.shp, .dbf, .shx, ...) decompressed at the same time
             **kw: Arguments to pass to `pd.read_csv`
 
         Returns self (chainable)
@@ -610,7 +1477,7 @@ class shpLoader(BaseLoader):
 
         if is_zip:
             z = self.open_zip(url)
-            z.extractall(self.local_file())
+            self.extract(z, self.local_file(), workers=workers)
         else:
             socket = self.open_socket(url, filename, is_zip=is_zip, ith=ith, as_b=True)
             with open(self.local_file(filename or self.filename), 'r') as f:
@@ -618,15 +1485,31 @@ class shpLoader(BaseLoader):
         self.read(self.local_file(filename or self.filename), **kw)
         return self
 
+    @instrument('read')
     def read(self, file, **kw):
         '''Load from file-like object'''
         self.df = gpd.GeoDataFrame.from_file(file, **kw)
 
+    @instrument('save')
     def save(self, file, **kw):
         '''Simplistic implementation. There could be errors with CRS and I'm not
         sure how it works with the auxilliary shapefile data (.dbf, .prj, .shx, ...).'''
         self.df.to_file(file, driver='ESRI Shapefile')
 
+    def iter_chunks(self, file, chunksize=100000, **kw):
+        '''Yield the features `chunksize` at a time'''
+        start = 0
+        while True:
+            chunk = gpd.read_file(file, rows=slice(start, start + chunksize), **kw)
+            if len(chunk) or not start:
+                yield chunk
+            if len(chunk) < chunksize:
+                break
+            start += chunksize
+
+    def writer(self, file, **kw):
+        return _ShpWriter(file)
+
 
     def cached_load(self, *a, **kw):
         '''Helper to load csv checking and saving to cache. See `from_csv`'''
@@ -640,11 +1523,63 @@ class shpLoader(BaseLoader):
         return self
 
 
+class _ShpWriter(object):
+    '''Appends chunks of features to a shapefile'''
+    def __init__(self, file):
+        self.file, self.mode = file, 'w'
+
+    def write(self, df):
+        df.to_file(self.file, driver='ESRI Shapefile', mode=self.mode)
+        self.mode = 'a'
+
+    def close(self):
+        pass
+
+
+
+
+class parquetLoader(BaseLoader):
+    extension = '.parquet'
+    '''
+    Columnar files (needs pyarrow). GeoDataFrames are saved as GeoParquet (WKB
+    geometry + `geo` metadata) and read back as GeoDataFrames.
+
+    df = csvLoader(filename='data.csv').convert_cache('parquet').from_cache().df
+    '''
+
+    def __init__(self, *a, **kw):
+        if not pa.available():
+            raise ImportError('parquetLoader depends on pyarrow, which could not be loaded.')
+        super(parquetLoader, self).__init__(*a, **kw)
+
+    @instrument('read')
+    def read(self, file, columns=None, **kw):
+        '''Load from a parquet file, optionally only some columns'''
+        self.df = _from_arrow(pq.read_table(file, columns=columns, **kw))
+
+    @instrument('save')
+    def save(self, file, **kw):
+        '''Write a parquet file'''
+        writer = _ParquetWriter(file, **kw)
+        writer.write(self.df)
+        writer.close()
+
+    def iter_chunks(self, file, chunksize=100000, columns=None, **kw):
+        '''Yield the rows `chunksize` at a time'''
+        pf = pq.ParquetFile(file)
+        metadata = pf.schema_arrow.metadata
+        for batch in pf.iter_batches(batch_size=chunksize, columns=columns):
+            yield _from_arrow(pa.Table.from_batches([batch]), metadata)
+
+    def writer(self, file, **kw):
+        return _ParquetWriter(file, **kw)
+
 
 
 class customLoader(csvLoader):
     extension = ''
     _parser = lambda file: file
+    _stream = None # options of a stream parser
 
     @classmethod
     def parser(cls, func):
@@ -653,29 +1588,236 @@ class customLoader(csvLoader):
         instance._parser = func
         return instance
 
+    @classmethod
+    def stream_parser(cls, func=None, lines=True, encoding='utf-8', chunk_size=2**16, header=False, batch=100000):
+        '''Enables custom parsing of a file as a stream. The function gets an iterator
+        and yields records or DataFrame chunks.
+
+        Arguments:
+            lines (bool): give the function decoded lines (without the newline). If False, byte chunks
+            encoding (str): encoding of the lines
+            chunk_size (int): size of the byte chunks
+            header (bool): the first record is the column names
+            batch (int): number of records put in each DataFrame chunk
+        '''
+        def decorator(func):
+            instance = cls.parser(func)
+            instance._stream = dict(lines=lines, encoding=encoding, chunk_size=chunk_size,
+                                    header=header, batch=batch)
+            return instance
+        return decorator(func) if func is not None else decorator
+
 
     def download(self, url=None, filename=None, is_zip=False, ith=0, **kw):
         if self.has_df(): # return from cache if it exists
             return self
 
+        if self._stream is not None:
+            socket = self.open_socket(url, filename, is_zip, ith, as_b=True)
+            self.read_stream(socket)
+            return self
+
         socket = self.open_socket(url, filename, is_zip)
         result = self._parser(socket) # run custom parser
 
         # Convert result to dataframe
         if isinstance(result, pd.DataFrame):
-            df = result # already dataframe
+            self.df = result # already dataframe
         elif hasattr(result, 'read'):
-            df = self.read(result) # is file-like
+            self.read(result) # is file-like
         elif isinstance(result, str):
-            df = self.read(io.StringIO(result)) # is a string
-        elif isinstance(result, [dict, list, odict]):
-            df = pd.DataFrame(result) # is some form that DataFrame can take
+            self.read(io.StringIO(result)) # is a string
+        elif isinstance(result, (dict, list, odict)):
+            self.df = pd.DataFrame(result) # is some form that DataFrame can take
         else:
             raise TypeError('Returned object could not be converted to dataframe.')
-        self.df = df
         return self
 
 
+    def _iter_stream(self, socket):
+        '''Lines or byte chunks of a binary file-like object'''
+        opts = self._stream
+        if not opts['lines']:
+            return iter(lambda: socket.read(opts['chunk_size']), b'')
+        try:
+            text = io.TextIOWrapper(socket, encoding=opts['encoding'], newline='')
+        except AttributeError: # python 2 sockets aren't io objects
+            text = codecs.getreader(opts['encoding'])(socket)
+        return (line.rstrip('\r\n') for line in text)
+
+    @instrument('read')
+    def read_stream(self, socket):
+        '''Run the stream parser over a binary file-like object, putting the records it yields
+        together `batch` at a time and appending each chunk to the cache file as it is ready.
+        The DataFrame is then read back from the cache file, so it has the same dtypes as when
+        it is loaded from the cache later.'''
+        opts = self._stream
+        path = self.cache_path(write=True)
+        BaseLoader.ensure_directory(self, self.local_file())
+
+        def write(tmp): # only complete files are ever in the cache
+            written, records, columns = [0], [], None
+            with open_compressed(tmp, 'wt', compression=_codec(path)) as f:
+                def flush(df):
+                    df.to_csv(f, index=False, header=not written[0])
+                    written[0] += 1
+
+                for item in self._parser(self._iter_stream(socket)):
+                    if isinstance(item, pd.DataFrame):
+                        if records:
+                            flush(pd.DataFrame(records, columns=columns))
+                            records = []
+                        flush(item)
+                    elif opts['header'] and columns is None:
+                        columns = list(item)
+                    else:
+                        records.append(item)
+                        if len(records) >= opts['batch']:
+                            flush(pd.DataFrame(records, columns=columns))
+                            records = []
+                if records or not written[0]:
+                    flush(pd.DataFrame(records, columns=columns))
+
+        _atomic_write(path, write)
+        self.read(path)
+
+
+
+
+# Prefetching
+#################
+
+def read_manifest(path):
+    '''The dataset specs of a prefetch manifest, YAML (needs PyYAML) or JSON:
+    a list of specs, or {'datasets': [specs]}. See the module docs.'''
+    with io.open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.lower().endswith('.json'):
+        data = json.loads(text)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            try:
+                data = json.loads(text) # json is yaml too
+            except ValueError:
+                raise ImportError('Reading a YAML manifest needs PyYAML (pip install pyyaml), or write it as JSON.')
+        else:
+            data = yaml.safe_load(text)
+    return (data or {}).get('datasets', []) if isinstance(data, dict) else data
+
+def _validators(url):
+    '''What tells whether a dataset changed: ETag and Last-Modified of a url (HEAD request),
+    size and mtime of a local file. Empty if the server doesn't say.'''
+    if os.path.isfile(url):
+        return {'size': os.path.getsize(url), 'mtime': os.path.getmtime(url)}
+    request = urllib.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib.urlopen(request, timeout=60)
+    except Exception: # no HEAD, no validators: download it
+        return {}
+    headers = response.info()
+    response.close()
+    return {k: v for k, v in [('etag', headers.get('ETag')), ('last_modified', headers.get('Last-Modified')),
+                              ('size', headers.get('Content-Length'))] if v is not None}
+
+def _sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.isfile(path) else None
+
+def refresh(spec, force=False):
+    '''Bring the cache file of one manifest spec up to date, then its derived caches
+
+    Arguments:
+        spec (dict): url, and optionally name, loader, filename, is_zip, ith, options, read, derived
+        force (bool): download even if the url didn't change
+    Returns a report: an ordered dict of name, status (new, updated, unchanged - downloaded
+    but identical, not modified - not downloaded, or error), rows, MB, seconds, derived and error
+    '''
+    t0 = time.time()
+    report = odict([('name', spec.get('name') or spec.get('filename') or spec.get('url')), ('status', None),
+                    ('rows', None), ('MB', None), ('seconds', None), ('derived', []), ('error', None)])
+    try:
+        if spec.get('is_zip') and not spec.get('filename'):
+            raise ValueError('filename (the member to load from the zip) is needed with is_zip')
+        cls = BaseLoader.loader_class(spec.get('loader') or spec.get('filename') or spec['url'])
+        loader = cls(filename=spec.get('filename'), url=spec['url'])
+        loader.setup(**spec.get('options') or {})
+        path = loader.cache_path(write=True)
+        meta_path = path + '.meta.json'
+
+        with cache_lock(path):
+            meta = {}
+            if os.path.isfile(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            validators = _validators(loader.url)
+            cached = os.path.isfile(path)
+            if cached and not force and validators and meta.get('url') == loader.url and meta.get('validators') == validators:
+                report['status'] = 'not modified'
+            else:
+                before = _mtime(path)
+                kw = dict(spec.get('read') or {})
+                if spec.get('is_zip'):
+                    kw['is_zip'] = True
+                if 'ith' in spec:
+                    kw['ith'] = spec['ith']
+                loader.download(url=loader.url, **kw)
+                if _mtime(path) == before: # shapefiles and streaming loaders fill the cache themselves
+                    loader.save_cache(overwrite=True)
+                sha1 = _sha1(path)
+                report['status'] = 'new' if not cached else 'unchanged' if sha1 == meta.get('sha1') else 'updated'
+                report['rows'] = _nrows(loader)
+                meta = {'url': loader.url, 'validators': validators, 'sha1': sha1, 'rows': report['rows'],
+                        'fetched': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                def write_meta(tmp):
+                    with open(tmp, 'w') as f:
+                        json.dump(meta, f, indent=2)
+                _atomic_write(meta_path, write_meta)
+            report['rows'] = meta.get('rows')
+            report['MB'] = os.path.getsize(path) / 1e6
+
+        for target in spec.get('derived') or []:
+            target = BaseLoader.loader_class(target)
+            filename = os.path.splitext(loader.filename)[0] + target.extension
+            if force or report['status'] in ('new', 'updated') or not target(filename=filename).is_cached():
+                loader.convert_cache(target, filename)
+                report['derived'].append(filename)
+    except Exception as e:
+        report['status'], report['error'] = 'error', '{}: {}'.format(type(e).__name__, e)
+    report['seconds'] = time.time() - t0
+    return report
+
+def prefetch(specs, workers=4, force=False, file=None):
+    '''Refresh the cache files of several datasets, `workers` at a time, and print what changed.
+    See refresh(...) and the module docs for the specs. Returns the list of reports.'''
+    from multiprocessing.pool import ThreadPool
+    file = file or sys.stdout
+    if workers > 1 and len(specs) > 1:
+        pool = ThreadPool(min(workers, len(specs)))
+        try:
+            reports = pool.map(lambda spec: refresh(spec, force), specs)
+        finally:
+            pool.close()
+    else:
+        reports = [refresh(spec, force) for spec in specs]
+
+    print('{:<32} {:<13} {:>10} {:>9} {:>8}  {}'.format('dataset', 'status', 'rows', 'MB', 'seconds', 'derived'), file=file)
+    for r in reports:
+        print('{:<32} {:<13} {:>10} {:>9} {:>8.1f}  {}'.format(
+            r['name'][:32], r['status'], r['rows'] if r['rows'] is not None else '',
+            '{:.1f}'.format(r['MB']) if r['MB'] is not None else '', r['seconds'],
+            r['error'] or ', '.join(r['derived'])), file=file)
+    return reports
+
+
 
 if __name__ == '__main__':
 
@@ -686,10 +1828,44 @@ if __name__ == '__main__':
                 print('  ', f)
 
         disp_cache_list(csvLoader)
+        for suffix, _ in CODECS.values():
+            for f in csvLoader.list_cache(ext=csvLoader.extension + suffix):
+                print('  ', f)
         disp_cache_list(xlsxLoader)
         disp_cache_list(shpLoader, '*')
 
 
+    if sys.argv[1] == 'convert':
+        # python puidata.py convert src dst [chunksize]
+        # python puidata.py convert src - [chunksize]             - as csv to stdout
+        # python puidata.py convert '*.csv' .parquet [chunksize]  - every matching cached file (.csv.zst, ... too)
+        src, dst = sys.argv[2:4]
+        chunksize = int(sys.argv[4]) if len(sys.argv) > 4 else 100000
+        if dst.startswith('.'):
+            directory = os.getenv(BaseLoader.envvar, BaseLoader.default_dir)
+            pairs = odict() # new file: source, the uncompressed source first
+            for pattern in [src] + [src + suffix for suffix, _ in CODECS.values()]:
+                for f in sorted(glob.glob(os.path.join(directory, pattern))):
+                    new = os.path.splitext(_strip_codec(f))[0] + dst
+                    if new != f:
+                        pairs.setdefault(new, f)
+            pairs = [(a, b) for b, a in pairs.items()]
+        else:
+            pairs = [(src, dst)]
+        for a, b in pairs:
+            t0 = time.time()
+            rows = convert(a, b, chunksize)
+            print('{} -> {}: {} rows in {:.2f}s'.format(a, b, rows, time.time() - t0),
+                  file=sys.stderr if b == '-' else sys.stdout)
+
+
+    if sys.argv[1] == 'prefetch':
+        # python puidata.py prefetch manifest.yaml [workers] [--force]
+        args = [a for a in sys.argv[2:] if a != '--force']
+        reports = prefetch(read_manifest(args[0]), int(args[1]) if len(args) > 1 else 4, force='--force' in sys.argv)
+        sys.exit(1 if any(r['status'] == 'error' for r in reports) else 0)
+
+
     if sys.argv[1] == 'test':
         # Running tests on assignment 5 data
 
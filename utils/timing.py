@@ -0,0 +1,24 @@
+'''
+Timing helpers shared by the benchmarks of the homework scripts.
+
+The HW folders aren't packages, so they put this directory on the path first:
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+    import timing
+'''
+from __future__ import print_function
+import time
+
+
+def best(func, repeat=3):
+    '''Best wall time in seconds of calling func() `repeat` times'''
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    print('{:.4f}s'.format(best(lambda: sum(range(10**6)))))